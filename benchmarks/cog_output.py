@@ -0,0 +1,111 @@
+""" Benchmark of the final output writers: write time, file size and downstream read time of a synthetic high priority
+    forest carbon raster (sparse integer carbon values, the rest NoData) written as
+
+    - plain: float32, uncompressed, striped (what ArcGIS saves by default),
+    - tiled: float32, LZW, 256 x 256 tiles (the previous engine output),
+    - cog: Cloud Optimized GeoTIFF with overviews in the fitted data type (carbon_engine.CogWriter).
+
+    python benchmarks/cog_output.py --size 8192 --density 0.15
+"""
+
+import argparse
+import os
+import sys
+import tempfile
+import time
+import types
+
+import numpy as np
+import rasterio
+from rasterio.crs import CRS
+from rasterio.transform import from_origin
+from rasterio.windows import Window
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from carbon_engine import CogWriter, fit_dtype, iter_windows  # noqa: E402
+from carbon_engine.blocks import DEFAULT_BLOCK_SIZE, default_nodata, output_profile  # noqa: E402
+
+NODATA = default_nodata(np.float32)
+
+
+def synthetic_block(window, density, seed):
+
+    """ Clustered forest carbon for one window: patches of 64 x 64 cells are forest with probability density, and the
+        carbon of a patch varies by a few Mg C/ha around its own level.
+    """
+
+    rng = np.random.default_rng([seed, window.row_off, window.col_off])
+    shape = (window.height // 64 + 1, window.width // 64 + 1)
+    patches = np.where(rng.random(shape) < density, rng.integers(20, 380, shape), 0)
+    levels = np.kron(patches, np.ones((64, 64), dtype=np.int64))[:window.height, :window.width]
+    carbon = (levels + rng.integers(0, 20, levels.shape)).astype(np.float32)
+    return np.where((levels > 0) & (rng.random(levels.shape) < 0.7), carbon, NODATA)
+
+
+def write_plain(path, grid, windows, blocks):
+    profile = output_profile(grid, np.float32, NODATA)
+    for option in ("tiled", "blockxsize", "blockysize", "compress"):
+        profile.pop(option)
+    with rasterio.open(path, "w", **profile) as dst:
+        for window in windows:
+            dst.write(blocks(window), 1, window=window)
+
+
+def write_tiled(path, grid, windows, blocks):
+    with rasterio.open(path, "w", **output_profile(grid, np.float32, NODATA)) as dst:
+        for window in windows:
+            dst.write(blocks(window), 1, window=window)
+
+
+def write_cog(path, grid, windows, blocks):
+    dtype, nodata = fit_dtype(20, 399)
+    with CogWriter(path, grid, dtype, nodata, window_size=DEFAULT_BLOCK_SIZE) as dst:
+        for window in windows:
+            values = blocks(window)
+            dst.write(values, window, values != NODATA)
+
+
+def read_times(path, size):
+
+    """ Seconds to read a 1/16 resolution preview of the whole extent and a 512 x 512 window at full resolution. """
+
+    with rasterio.open(path) as src:
+        start = time.perf_counter()
+        src.read(1, out_shape=(size // 16, size // 16))
+        preview = time.perf_counter() - start
+        start = time.perf_counter()
+        src.read(1, window=Window(size // 3, size // 3, 512, 512))
+        window = time.perf_counter() - start
+    return preview, window
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--size", type=int, default=8192, help="Width and height of the raster in cells.")
+    parser.add_argument("--density", type=float, default=0.15, help="Fraction of 64 x 64 patches that are forest.")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--dir", help="Directory for the test files (default: a temporary directory).")
+    args = parser.parse_args(argv)
+
+    grid = types.SimpleNamespace(width=args.size, height=args.size, crs=CRS.from_epsg(4326),
+                                 transform=from_origin(-180, 90, 0.01, 0.01))
+    windows = list(iter_windows(args.size, args.size, DEFAULT_BLOCK_SIZE))
+
+    def blocks(window):
+        return synthetic_block(window, args.density, args.seed)
+
+    with tempfile.TemporaryDirectory(dir=args.dir) as tmp:
+        print("{:<8} {:>10} {:>12} {:>12} {:>12}".format("writer", "write s", "size MB", "preview s", "window s"))
+        for name, writer in (("plain", write_plain), ("tiled", write_tiled), ("cog", write_cog)):
+            path = os.path.join(tmp, name + ".tif")
+            start = time.perf_counter()
+            writer(path, grid, windows, blocks)
+            write_time = time.perf_counter() - start
+            preview, window = read_times(path, args.size)
+            print("{:<8} {:>10.2f} {:>12.1f} {:>12.3f} {:>12.4f}".format(
+                name, write_time, os.path.getsize(path) / 1024 ** 2, preview, window))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,373 @@
+""" Benchmark of the NumPy engine on synthetic global-scale inputs, step by step.
+
+    Generates stand-ins for the inputs of identify_high_priority_carbon_forests.py at each size (size x size cells of
+    a geographic grid over 180 x 180 degrees):
+
+    - forest: FAO structural forms 1-12 in patches, with more forest towards the equator, 0 = NoData,
+    - aboveground and belowground carbon (int16 Mg C/ha, -1 = NoData) on a grid offset from the forest grid,
+    - ecoregions: RESOLVE-like polygons (a jittered lattice of ~840 ecoregions with ECO_ID, ECO_NAME and BIOME_NAME),
+
+    and times each step of the stepwise engine (mask, reclassify, zones, percentile, per-cell carbon, threshold,
+    filter) and the fused pipeline (one sweep run with the filter) with a RunProfiler. The results of all sizes are
+    written to a JSON file. Given a baseline (the results file of an earlier run), every step is compared with it and
+    the benchmark exits with status 1 if any step is slower than --tolerance times its baseline.
+
+    python benchmarks/pipeline_steps.py --sizes 1000 10000 40000 --output results.json --baseline baseline.json
+"""
+
+import argparse
+import datetime
+import json
+import os
+import platform
+import shutil
+import sys
+import tempfile
+
+import numpy as np
+import rasterio
+from rasterio.crs import CRS
+from rasterio.transform import from_origin
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from carbon_engine import CogWriter, EcoregionFilter, EcoregionGrid, RunProfiler, carbon_in_each_forest_cell, \
+    filter_output, fit_dtype, iter_windows, rasterize_ecoregions, run_sweep, zonal_percentile  # noqa: E402
+from carbon_engine.blocks import DEFAULT_BLOCK_SIZE, default_nodata, output_profile, read_aligned, read_indexed, \
+    window_indices  # noqa: E402
+from carbon_engine.kernels import carbon_above_threshold, combine_zones, read_clipped_carbon, \
+    reclassify_forest  # noqa: E402
+
+CRS_WGS84 = CRS.from_epsg(4326)
+EXTENT_DEGREES = 180.0
+PATCH_CELLS = 32
+LATTICE = 29  # 29 x 29 = 841 ecoregions (RESOLVE 2017 has 846).
+
+BIOMES = (
+    "Tropical & Subtropical Moist Broadleaf Forests",
+    "Tropical & Subtropical Dry Broadleaf Forests",
+    "Tropical & Subtropical Coniferous Forests",
+    "Tropical & Subtropical Grasslands, Savannas & Shrublands",
+    "Mangroves",
+    "Deserts & Xeric Shrublands",
+    "Flooded Grasslands & Savannas",
+    "Mediterranean Forests, Woodlands & Scrub",
+    "Temperate Broadleaf & Mixed Forests",
+    "Temperate Conifer Forests",
+    "Temperate Grasslands, Savannas & Shrublands",
+    "Montane Grasslands & Shrublands",
+    "Boreal Forests/Taiga",
+    "Tundra",
+)
+
+# The biomes of the script's filter (biomes_to_include).
+BIOMES_TO_INCLUDE = BIOMES[:3] + BIOMES[8:10] + BIOMES[12:13]
+
+
+def _uniform(a, b, seed):
+
+    """ Deterministic pseudo-random numbers in [0, 1) of integer arrays a and b (splitmix64 finalizer). """
+
+    with np.errstate(over="ignore"):
+        x = (a.astype(np.int64).astype(np.uint64) * np.uint64(0x9E3779B97F4A7C15) ^
+             (b.astype(np.int64).astype(np.uint64) + np.uint64(seed) * np.uint64(0xD1B54A32D192ED03)))
+        x ^= x >> np.uint64(30)
+        x *= np.uint64(0xBF58476D1CE4E5B9)
+        x ^= x >> np.uint64(27)
+        x *= np.uint64(0x94D049BB133111EB)
+        x ^= x >> np.uint64(31)
+    return (x >> np.uint64(11)).astype(np.float64) / 2.0 ** 53
+
+
+def _cell_centres(transform, window):
+    rows, cols = window_indices(window)
+    return transform.c + (cols + 0.5) * transform.a, transform.f + (rows + 0.5) * transform.e
+
+
+def forest_block(transform, window, seed):
+
+    """ FAO structural forms of one window: 32 x 32 cell patches of one class, forest more likely near the equator. """
+
+    x, y = _cell_centres(transform, window)
+    patch_size = PATCH_CELLS * transform.a
+    patch_x, patch_y = np.meshgrid(np.floor(x / patch_size), np.floor(y / patch_size))
+    forest_fraction = 0.15 + 0.45 * np.cos(np.radians(y))[:, None]
+    forested = _uniform(patch_x, patch_y, seed) < forest_fraction
+    classes = 1 + (_uniform(patch_x, patch_y, seed + 1) * 12).astype(np.int64)
+    rows, cols = window_indices(window)
+    cols, rows = np.meshgrid(cols, rows)
+    cell_forest = _uniform(rows, cols, seed + 2) < 0.8
+    return np.where(forested & cell_forest, classes, 0).astype(np.uint8)
+
+
+def carbon_block(transform, window, seed, scale):
+
+    """ Carbon of one window: a level per patch (in the forest patch geometry) plus noise, 3% NoData. """
+
+    x, y = _cell_centres(transform, window)
+    patch_size = PATCH_CELLS * transform.a
+    patch_x, patch_y = np.meshgrid(np.floor(x / patch_size), np.floor(y / patch_size))
+    levels = 20 + _uniform(patch_x, patch_y, seed + 3) * 360
+    rows, cols = window_indices(window)
+    cols, rows = np.meshgrid(cols, rows)
+    noise = _uniform(rows, cols, seed + 4 + scale)
+    carbon = ((levels + noise * 20) / scale).astype(np.int16)
+    return np.where(noise < 0.03, -1, carbon).astype(np.int16)
+
+
+def write_raster(path, width, height, transform, dtype, nodata, block, block_size):
+    grid = argparse.Namespace(width=width, height=height, crs=CRS_WGS84, transform=transform)
+    with rasterio.open(path, "w", **output_profile(grid, dtype, nodata)) as dst:
+        for window in iter_windows(width, height, block_size):
+            dst.write(block(window), 1, window=window)
+
+
+def write_ecoregions(path, seed):
+
+    """ RESOLVE-like ecoregion polygons: a LATTICE x LATTICE lattice over the extent whose inner vertices and edge
+        midpoints are jittered (shared by neighbours, so the polygons tile the extent), with a biome by latitude band.
+    """
+
+    import fiona
+
+    rng = np.random.default_rng(seed)
+    spacing = EXTENT_DEGREES / LATTICE
+    lines = np.arange(LATTICE + 1) * spacing
+
+    def jitter(shape, fixed_rows, fixed_cols):
+        offsets = rng.uniform(-0.2, 0.2, shape + (2,)) * spacing
+        offsets[fixed_rows, :, 1] = 0
+        offsets[:, fixed_cols, 0] = 0
+        return offsets
+
+    edges = [0, -1]
+    vertices = (np.stack(np.meshgrid(lines - 90, 90 - lines), axis=-1) +
+                jitter((LATTICE + 1, LATTICE + 1), edges, edges))
+    across = (np.stack(np.meshgrid(lines[:-1] + spacing / 2 - 90, 90 - lines), axis=-1) +
+              jitter((LATTICE + 1, LATTICE), edges, []))
+    down = (np.stack(np.meshgrid(lines - 90, 90 - lines[:-1] - spacing / 2), axis=-1) +
+            jitter((LATTICE, LATTICE + 1), [], edges))
+
+    schema = {"geometry": "Polygon", "properties": {"ECO_ID": "int", "ECO_NAME": "str", "BIOME_NAME": "str"}}
+    with fiona.open(path, "w", driver="ESRI Shapefile", crs="EPSG:4326", schema=schema) as dst:
+        for i in range(LATTICE):
+            for j in range(LATTICE):
+                ring = [vertices[i, j], across[i, j], vertices[i, j + 1], down[i, j + 1], vertices[i + 1, j + 1],
+                        across[i + 1, j], vertices[i + 1, j], down[i, j], vertices[i, j]]
+                band = abs(i - LATTICE // 2) * len(BIOMES) // (LATTICE // 2 + 1)
+                eco_id = i * LATTICE + j + 1
+                dst.write({
+                    "geometry": {"type": "Polygon", "coordinates": [[tuple(map(float, xy)) for xy in ring]]},
+                    "properties": {"ECO_ID": eco_id, "ECO_NAME": "Ecoregion {}".format(eco_id),
+                                   "BIOME_NAME": BIOMES[(band + int(rng.integers(0, 2))) % len(BIOMES)]},
+                })
+
+
+def generate_inputs(directory, size, seed, block_size):
+
+    """ Writes the synthetic inputs of one size to directory (reused if they are there with the same settings). """
+
+    settings = {"size": size, "seed": seed, "version": 1}
+    settings_path = os.path.join(directory, "inputs.json")
+    inputs = {
+        "forest": os.path.join(directory, "forest.tif"),
+        "aboveground": os.path.join(directory, "aboveground_carbon.tif"),
+        "belowground": os.path.join(directory, "belowground_carbon.tif"),
+        "ecoregions": os.path.join(directory, "ecoregions.shp"),
+    }
+    if os.path.exists(settings_path):
+        with open(settings_path) as f:
+            if json.load(f) == settings:
+                return inputs
+        shutil.rmtree(directory)
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+
+    print(" -> Generating the {0} x {0} inputs...".format(size))
+    res = EXTENT_DEGREES / size
+    forest_transform = from_origin(-90, 90, res, res)
+    carbon_transform = from_origin(-90 - 0.37 * res, 90 + 0.61 * res, res, res)
+    write_raster(inputs["forest"], size, size, forest_transform, np.uint8, 0,
+                 lambda window: forest_block(forest_transform, window, seed), block_size)
+    for name, scale in (("aboveground", 1), ("belowground", 4)):
+        write_raster(inputs[name], size + 1, size + 1, carbon_transform, np.int16, -1,
+                     lambda window: carbon_block(carbon_transform, window, seed, scale), block_size)
+    write_ecoregions(inputs["ecoregions"], seed)
+
+    with open(settings_path, "w") as f:
+        json.dump(settings, f)
+    return inputs
+
+
+def mask_step(inputs, output, block_size):
+
+    """ 1-2. Combined carbon clipped to the forest pixels, on the forest grid. """
+
+    with rasterio.open(inputs["forest"]) as forest_src, rasterio.open(inputs["aboveground"]) as above_src, \
+            rasterio.open(inputs["belowground"]) as below_src:
+        nodata = default_nodata(np.int32)
+        with rasterio.open(output, "w", **output_profile(forest_src, np.int32, nodata)) as dst:
+            for window in iter_windows(forest_src.width, forest_src.height, block_size):
+                forest_valid = read_indexed(forest_src, *window_indices(window))[1]
+                carbon, valid = read_clipped_carbon([above_src, below_src], forest_src, window, forest_valid)
+                dst.write(np.where(valid & forest_valid, carbon, nodata).astype(np.int32), 1, window=window)
+
+
+def reclassify_step(inputs, output, block_size):
+
+    """ 3. Forest structural forms reclassified to the four forest classes. """
+
+    with rasterio.open(inputs["forest"]) as forest_src:
+        nodata = default_nodata(np.int16)
+        with rasterio.open(output, "w", **output_profile(forest_src, np.int16, nodata)) as dst:
+            for window in iter_windows(forest_src.width, forest_src.height, block_size):
+                forest, valid = read_indexed(forest_src, *window_indices(window))
+                dst.write(np.where(valid, reclassify_forest(forest, valid), nodata).astype(np.int16), 1, window=window)
+
+
+def zones_step(inputs, ecoregion_grid, forest_reclassified, output, block_size, workers):
+
+    """ 4. Ecoregion IDs burned onto the forest grid and combined with the forest classes. """
+
+    rasterize_ecoregions(inputs["ecoregions"], inputs["forest"], ecoregion_grid, block_size=block_size,
+                         workers=workers).close()
+    with rasterio.open(forest_reclassified) as classes_src, rasterio.open(inputs["forest"]) as forest_src:
+        with EcoregionGrid(ecoregion_grid) as grid:
+            nodata = default_nodata(np.int32)
+            with rasterio.open(output, "w", **output_profile(forest_src, np.int32, nodata)) as dst:
+                for window in iter_windows(forest_src.width, forest_src.height, block_size):
+                    classes, classes_valid = read_indexed(classes_src, *window_indices(window))
+                    eco_ids, eco_valid = read_aligned(grid, forest_src.transform, window)
+                    zones, valid = combine_zones(eco_ids, eco_valid, classes, classes_valid)
+                    dst.write(np.where(valid, zones, nodata).astype(np.int32), 1, window=window)
+
+
+def threshold_step(cells, thresholds, output, block_size):
+
+    """ 7. Con(carbon > threshold, carbon), written as a COG. """
+
+    dtype, nodata = fit_dtype(0, 32767)
+    output_nodata = default_nodata(np.float32)
+    with rasterio.open(cells) as cells_src, rasterio.open(thresholds) as thresholds_src:
+        with CogWriter(output, cells_src, dtype, nodata, window_size=block_size) as dst:
+            for window in iter_windows(cells_src.width, cells_src.height, block_size):
+                carbon, carbon_valid = read_indexed(cells_src, *window_indices(window))
+                zone_thresholds, thresholds_valid = read_indexed(thresholds_src, *window_indices(window))
+                values = carbon_above_threshold(carbon, carbon_valid, zone_thresholds, thresholds_valid, output_nodata)
+                dst.write(values, window, values != output_nodata)
+
+
+def run_size(inputs, work, size, args):
+
+    """ Runs every step on the inputs of one size. Returns {step name: measurements}. """
+
+    def path(name):
+        return os.path.join(work, name)
+
+    ecoregion_filter = EcoregionFilter(BIOMES_TO_INCLUDE, ["Ecoregion {}".format(eco_id)
+                                                           for eco_id in range(1, LATTICE * LATTICE + 1, 7)])
+    profiler = RunProfiler(path("run_report.json"), config=dict(vars(args), size=size))
+    with profiler:
+        with profiler.step("mask"):
+            mask_step(inputs, path("carbon_clipped_to_forest.tif"), args.block_size)
+        with profiler.step("reclassify"):
+            reclassify_step(inputs, path("forest_reclassified.tif"), args.block_size)
+        with profiler.step("zones"):
+            zones_step(inputs, path("ecoregion_ids.npy"), path("forest_reclassified.tif"), path("zones.tif"),
+                       args.block_size, args.workers)
+        with profiler.step("percentile"):
+            zonal_percentile(path("zones.tif"), path("carbon_clipped_to_forest.tif"), path("thresholds.tif"),
+                             args.percentile, block_size=args.block_size)
+        with profiler.step("per_cell_carbon"):
+            carbon_in_each_forest_cell(inputs["forest"], path("carbon_clipped_to_forest.tif"),
+                                       path("carbon_in_each_forest_cell.tif"), args.block_size)
+        with profiler.step("threshold"):
+            threshold_step(path("carbon_in_each_forest_cell.tif"), path("thresholds.tif"), path("final.tif"),
+                           args.block_size)
+        with profiler.step("filter"):
+            filter_output(path("final.tif"), path("carbon_in_each_forest_cell.tif"), path("ecoregion_ids.npy"),
+                          ecoregion_filter, path("final_filtered.tif"), args.block_size)
+        with profiler.step("fused"):
+            run_sweep(inputs["forest"], {"combined": [inputs["aboveground"], inputs["belowground"]]},
+                      path("ecoregion_ids.npy"), [("combined", args.percentile)], [path("fused.tif")],
+                      block_size=args.block_size, workers=args.workers, ecoregion_filter=ecoregion_filter)
+
+    return {step.pop("name"): step for step in profiler.steps}
+
+
+def compare(results, baseline, tolerance, min_seconds):
+
+    """ Prints each step against the baseline. Returns the (size, step) of the steps that regressed. """
+
+    regressions = []
+    print("\n{:>6} {:<24} {:>10} {:>10} {:>7}".format("size", "step", "wall s", "base s", "ratio"))
+    for size, result in results["sizes"].items():
+        base_steps = baseline.get("sizes", {}).get(size, {}).get("steps", {})
+        for name, step in result["steps"].items():
+            base = base_steps.get(name)
+            if base is None:
+                print("{:>6} {:<24} {:>10.2f} {:>10} {:>7}".format(size, name, step["wall_seconds"], "-", "-"))
+                continue
+            ratio = step["wall_seconds"] / max(base["wall_seconds"], 1e-6)
+            regressed = ratio > tolerance and step["wall_seconds"] - base["wall_seconds"] > min_seconds
+            print("{:>6} {:<24} {:>10.2f} {:>10.2f} {:>7.2f}{}".format(
+                size, name, step["wall_seconds"], base["wall_seconds"], ratio, "  REGRESSION" if regressed else ""))
+            if regressed:
+                regressions.append((size, name))
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--sizes", type=int, nargs="+", default=[1000, 10000, 40000],
+                        help="Width and height of the synthetic grids in cells (default: 1000 10000 40000).")
+    parser.add_argument("--percentile", type=float, default=50)
+    parser.add_argument("--block-size", type=int, default=DEFAULT_BLOCK_SIZE)
+    parser.add_argument("--workers", type=int, default=1)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--data-dir", help="Keep the generated inputs here and reuse them on later runs (default: a "
+                                           "temporary directory).")
+    parser.add_argument("--output", default="benchmark_results.json", help="Results JSON (default: %(default)s).")
+    parser.add_argument("--baseline", help="Results JSON of an earlier run to compare with.")
+    parser.add_argument("--tolerance", type=float, default=1.25,
+                        help="A step regressed if it's slower than this times its baseline (default: %(default)s).")
+    parser.add_argument("--min-seconds", type=float, default=0.5,
+                        help="... and by more than this many seconds (default: %(default)s).")
+    args = parser.parse_args(argv)
+
+    results = {
+        "created": datetime.datetime.now().isoformat(),
+        "host": {"platform": platform.platform(), "python": sys.version.split()[0], "cpu_count": os.cpu_count()},
+        "config": {"percentile": args.percentile, "block_size": args.block_size, "workers": args.workers,
+                   "seed": args.seed},
+        "sizes": {},
+    }
+    tmp = None if args.data_dir else tempfile.mkdtemp(prefix="carbon_benchmark_")
+    try:
+        for size in args.sizes:
+            print("\nSize {0} x {0}".format(size))
+            inputs = generate_inputs(os.path.join(args.data_dir or tmp, "inputs_{}".format(size)), size, args.seed,
+                                     args.block_size)
+            work = tempfile.mkdtemp(prefix="work_{}_".format(size), dir=args.data_dir or tmp)
+            try:
+                results["sizes"][str(size)] = {"cells": size * size, "steps": run_size(inputs, work, size, args)}
+            finally:
+                shutil.rmtree(work, ignore_errors=True)
+    finally:
+        if tmp:
+            shutil.rmtree(tmp, ignore_errors=True)
+
+    with open(args.output, "w") as f:
+        json.dump(results, f, indent=1)
+    print("\nResults written to {}".format(args.output))
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = compare(results, json.load(f), args.tolerance, args.min_seconds)
+        if regressions:
+            print("\n{} step(s) slower than {} x the baseline".format(len(regressions), args.tolerance))
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
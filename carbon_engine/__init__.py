@@ -0,0 +1,19 @@
+""" Block-windowed NumPy engine for the high priority forest carbon analysis. Reads rasters window by window so that
+    peak memory depends on the block size rather than the global extent, and runs without an ArcGIS license.
+"""
+
+from .blocks import DEFAULT_BLOCK_SIZE, iter_windows, read_aligned
+from .cache import StepCache
+from .checkpoint import Checkpoint
+from .cells import carbon_in_each_forest_cell
+from .cog import CogWriter, convert_to_cog, fit_dtype
+from .ecoregions import EcoregionGrid, rasterize_ecoregions, read_ecoregion_table, zone_parity
+from .filtering import EcoregionFilter, filter_output, read_ecoregions_of_interest
+from .incremental import run_incremental
+from .pipeline import percentile_label, run_fused_pipeline, run_sweep, sweep_outputs, sweep_zone_stats
+from .profiling import RunProfiler
+from .region import Region
+from .scheduler import TileScheduler
+from .staging import StagingArea
+from .zonal import ZonalHistogram, ZonalSketch, load_histogram, zonal_histogram, zonal_percentile
+from .zone_stats import ZoneStats
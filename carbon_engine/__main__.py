@@ -0,0 +1,333 @@
+""" Command line entry point for the fused pipeline, e.g.:
+
+    python -m carbon_engine --forest Structural_forms_for_FAO_report.tif --carbon belowground_biomass_carbon_2010.tif
+        --ecoregions ecoregions_raster.tif --percentile 50 --output high_priority_forest_carbon.tif --workers 64
+
+    or, for a sweep over several carbon types and percentiles in one run:
+
+    python -m carbon_engine --forest Structural_forms_for_FAO_report.tif --ecoregions ecoregions_raster.tif
+        --aboveground aboveground_biomass_carbon_2010.tif --belowground belowground_biomass_carbon_2010.tif
+        --sweep belowground:50 combined:75 --output-dir Outputs
+
+    Batches of runs described in run spec files are run with python -m carbon_engine.batch (see batch.py).
+"""
+
+import argparse
+import datetime
+import os
+
+from . import profiling
+from .blocks import DEFAULT_BLOCK_SIZE
+from .cache import StepCache
+from .checkpoint import DEFAULT_INTERVAL
+from .ecoregions import rasterize_ecoregions
+from .filtering import EcoregionFilter, read_ecoregions_of_interest
+from .incremental import run_incremental
+from .pipeline import run_fused_pipeline, run_sweep, sweep_outputs, sweep_zone_stats
+from .profiling import RunProfiler
+from .region import Region
+from .scheduler import DEFAULT_READ_AHEAD, default_workers
+from .staging import StagingArea
+
+
+def parse_run(text):
+
+    """ Parses a CARBON_TYPE:PERCENTILE sweep run. """
+
+    carbon_type, _, percentile = text.partition(":")
+    try:
+        return carbon_type, float(percentile)
+    except ValueError:
+        raise argparse.ArgumentTypeError("sweep runs look like belowground:50, got {}".format(text))
+
+
+def sweep_carbon_sources(args):
+
+    """ Carbon rasters of each carbon type of a sweep. """
+
+    return {"aboveground": [args.aboveground], "belowground": [args.belowground],
+            "combined": [args.aboveground, args.belowground]}
+
+
+def stage_inputs(args):
+
+    """ Replaces the input paths of the parsed arguments with their local copies in --staging-dir. """
+
+    max_bytes = int(args.staging_max_gb * 1024 ** 3) if args.staging_max_gb else None
+    staging = StagingArea(args.staging_dir, max_bytes=max_bytes)
+    for name in ("forest", "aboveground", "belowground", "ecoregion_polygons", "region_polygons"):
+        if getattr(args, name):
+            setattr(args, name, staging.stage(getattr(args, name)))
+    if args.carbon:
+        args.carbon = [staging.stage(path) for path in args.carbon]
+    if not args.ecoregions.lower().endswith(".npy"):  # A .npy grid is written by the run.
+        args.ecoregions = staging.stage(args.ecoregions)
+
+
+def zone_stats_paths(args):
+
+    """ Zone statistics store of each carbon type: <output>_zone_stats.npz, or one per carbon type in --output-dir. """
+
+    if args.sweep:
+        return sweep_zone_stats(args.output_dir, args.sweep)
+    return {"carbon": os.path.splitext(args.output)[0] + "_zone_stats.npz"}
+
+
+def region_of(args):
+
+    """ The Region of --region-bbox, --region-ecoregions or --region-polygons, or None. """
+
+    if args.region_bbox:
+        return Region(bounds=args.region_bbox)
+    if args.region_ecoregions:
+        return Region(ecoregions=args.region_ecoregions)
+    if args.region_polygons:
+        return Region(polygons=args.region_polygons)
+    return None
+
+
+def zone_stats_sources(args):
+
+    """ Zone statistics store of each carbon type to take the thresholds from (--zone-stats-from), or None. """
+
+    if not args.zone_stats_from:
+        return None
+    if args.sweep:
+        return sweep_zone_stats(args.zone_stats_from, args.sweep)
+    return {"carbon": args.zone_stats_from}
+
+
+def run(args, cache, ecoregion_filter):
+
+    """ Runs the pipeline (incremental, sweep or single run) for the parsed arguments. """
+
+    if args.staging_dir:
+        with profiling.step("staging"):
+            stage_inputs(args)
+
+    if args.ecoregion_polygons:
+        with profiling.step("rasterize_ecoregions"):
+            rasterize_ecoregions(args.ecoregion_polygons, args.forest, args.ecoregions, block_size=args.block_size,
+                                 workers=args.workers).close()
+
+    if args.manifest_dir:
+        if args.sweep:
+            carbon_sources, runs, outputs = sweep_carbon_sources(args), args.sweep, sweep_outputs(args.output_dir, args.sweep)
+        else:
+            carbon_sources, runs, outputs = {"carbon": args.carbon}, [("carbon", args.percentile)], [args.output]
+        zone_stats = zone_stats_paths(args) if args.zone_stats else None
+        run_incremental(
+            forest=args.forest,
+            carbon_sources=carbon_sources,
+            ecoregions=args.ecoregions,
+            runs=runs,
+            outputs=outputs,
+            manifest_dir=args.manifest_dir,
+            bounds=args.changed_bounds,
+            block_size=args.block_size,
+            workers=args.workers,
+            read_ahead=args.read_ahead,
+            zone_stats=zone_stats,
+        )
+    elif args.sweep:
+        run_sweep(
+            forest=args.forest,
+            carbon_sources=sweep_carbon_sources(args),
+            ecoregions=args.ecoregions,
+            runs=args.sweep,
+            outputs=sweep_outputs(args.output_dir, args.sweep),
+            debug_dir=args.debug_dir,
+            block_size=args.block_size,
+            workers=args.workers,
+            cache=cache,
+            relative_accuracy=args.approximate,
+            ecoregion_filter=ecoregion_filter,
+            checkpoint_dir=args.checkpoint_dir,
+            checkpoint_interval=args.checkpoint_minutes * 60,
+            read_ahead=args.read_ahead,
+            zone_stats=zone_stats_paths(args) if args.zone_stats else None,
+            region=region_of(args),
+            zone_stats_from=zone_stats_sources(args),
+        )
+    else:
+        run_fused_pipeline(
+            forest=args.forest,
+            carbon=args.carbon,
+            ecoregions=args.ecoregions,
+            percentile=args.percentile,
+            output=args.output,
+            debug_dir=args.debug_dir,
+            block_size=args.block_size,
+            workers=args.workers,
+            cache=cache,
+            relative_accuracy=args.approximate,
+            ecoregion_filter=ecoregion_filter,
+            checkpoint_dir=args.checkpoint_dir,
+            checkpoint_interval=args.checkpoint_minutes * 60,
+            read_ahead=args.read_ahead,
+            zone_stats=zone_stats_paths(args)["carbon"] if args.zone_stats else None,
+            region=region_of(args),
+            zone_stats_from=args.zone_stats_from,
+        )
+
+
+def build_parser():
+
+    """ The argument parser of the command line (also used to check the runs of a batch, see carbon_engine.batch). """
+
+    parser = argparse.ArgumentParser(prog="python -m carbon_engine", description=__doc__.split("\n")[0])
+    parser.add_argument("--forest", required=True, help="FAO structural forms raster (defines the analysis grid).")
+    parser.add_argument("--carbon", nargs="+",
+                        help="Carbon raster. Give two rasters (aboveground, belowground) for combined carbon.")
+    parser.add_argument("--ecoregions", required=True,
+                        help="Rasterized ecoregions on the forest grid, or a persisted ecoregion grid (.npy).")
+    parser.add_argument("--ecoregion-polygons",
+                        help="Ecoregion polygons (e.g. RESOLVE) to burn into the --ecoregions .npy grid by ECO_ID, "
+                             "if it isn't there yet.")
+    parser.add_argument("--percentile", type=float, default=50, help="Percentile threshold (default: 50).")
+    parser.add_argument("--output", help="Final output GeoTIFF.")
+    parser.add_argument("--sweep", nargs="+", type=parse_run, metavar="CARBON_TYPE:PERCENTILE",
+                        help="Run a sweep instead, e.g. belowground:50 combined:75. Needs --output-dir and the "
+                             "--aboveground/--belowground rasters of the carbon types used.")
+    parser.add_argument("--aboveground", help="Aboveground carbon raster (sweep).")
+    parser.add_argument("--belowground", help="Belowground carbon raster (sweep).")
+    parser.add_argument("--output-dir", help="Directory of the sweep outputs.")
+    parser.add_argument("--workers", type=int, default=default_workers(),
+                        help="Number of worker processes (default: one per CPU).")
+    parser.add_argument("--read-ahead", type=int, default=DEFAULT_READ_AHEAD,
+                        help="With --workers 1, the number of tiles read ahead by threads while a tile is processed "
+                             "(default: {}).".format(DEFAULT_READ_AHEAD))
+    parser.add_argument("--block-size", type=int, default=DEFAULT_BLOCK_SIZE,
+                        help="Tile size in cells (default: {}).".format(DEFAULT_BLOCK_SIZE))
+    parser.add_argument("--debug-dir", help="Also write the intermediate rasters to this directory.")
+    parser.add_argument("--approximate", type=float, metavar="RELATIVE_ACCURACY",
+                        help="Use approximate per-zone quantile sketches with this relative accuracy (e.g. 0.01) "
+                             "instead of exact histograms, e.g. for float carbon. Not with --manifest-dir.")
+    parser.add_argument("--cache-dir", help="Cache the per-zone histograms here, so reruns with other percentiles "
+                                            "skip the first pass.")
+    parser.add_argument("--cache-max-gb", type=float, help="Size limit of the cache (default: no limit).")
+    parser.add_argument("--staging-dir",
+                        help="Copy the inputs here (e.g. a local SSD) and read the copies, so inputs on a network share "
+                             "are only read over the network once. Copies are reused until their source changes.")
+    parser.add_argument("--staging-max-gb", type=float,
+                        help="Size limit of the staging directory (default: no limit).")
+    parser.add_argument("--manifest-dir", help="Incremental mode: only recompute the windows and zones that changed "
+                                               "since the run recorded here (the first run records it).")
+    parser.add_argument("--changed-bounds", nargs=4, type=float, metavar=("LEFT", "BOTTOM", "RIGHT", "TOP"),
+                        help="Incremental mode: the inputs only changed within these bounds (forest CRS).")
+    parser.add_argument("--filter-biomes", nargs="+", default=[], metavar="BIOME_NAME",
+                        help="Also write <output>_filtered.tif, masked to the ecoregions of these biomes (and those "
+                             "selected from --ecoregions-of-interest). Needs an --ecoregions .npy grid.")
+    parser.add_argument("--ecoregions-of-interest", metavar="CSV",
+                        help="Filter: ecoregion names (first column); those with more forest carbon than their median "
+                             "are kept.")
+    parser.add_argument("--checkpoint-dir",
+                        help="Journal the progress of the run here; rerunning the same command after a crash resumes "
+                             "from the last checkpoint. Not with --debug-dir or --manifest-dir.")
+    parser.add_argument("--checkpoint-minutes", type=float, default=DEFAULT_INTERVAL / 60,
+                        help="Minutes between checkpoints (default: {:g}).".format(DEFAULT_INTERVAL / 60))
+    region = parser.add_mutually_exclusive_group()
+    region.add_argument("--region-bbox", nargs=4, type=float, metavar=("LEFT", "BOTTOM", "RIGHT", "TOP"),
+                        help="Only compute this region (forest CRS): the outputs cover it and hold the values of a "
+                             "global run. Pass 1 still covers the ecoregions that have cells in it (see "
+                             "--zone-stats-from). Needs an --ecoregions .npy grid.")
+    region.add_argument("--region-ecoregions", nargs="+", metavar="ECO_NAME",
+                        help="Only compute these ecoregions (names or ECO_IDs), like --region-bbox.")
+    region.add_argument("--region-polygons",
+                        help="Only compute the cells whose centres are in these polygons (a polygon layer in any CRS), "
+                             "like --region-bbox.")
+    parser.add_argument("--zone-stats-from", metavar="STORE",
+                        help="Take the per-zone histograms from the zone statistics store of a global run of the same "
+                             "inputs instead of running pass 1 (for a --sweep, the --output-dir of a global sweep). "
+                             "Not with filtering.")
+    parser.add_argument("--no-zone-stats", dest="zone_stats", action="store_false",
+                        help="Don't write the per-zone statistics store (<output>_zone_stats.npz, or "
+                             "high_priority_forest_carbon_zone_stats_<carbon type>.npz in --output-dir; query it with "
+                             "python -m carbon_engine.query).")
+    parser.add_argument("--report", help="JSON run report with the time, CPU, memory, I/O and tiles/s of each step "
+                                         "(default: <output>_run_report.json, or run_report.json in --output-dir).")
+    parser.add_argument("--profile-step", metavar="STEP",
+                        help="Run this step under cProfile (e.g. pass_2; use --workers 1 --read-ahead 0 to see inside "
+                             "the tiles).")
+    return parser
+
+
+def check_args(parser, args):
+
+    """ Checks the combination of the parsed arguments (parser.error if it isn't valid). """
+
+    if args.sweep:
+        carbon_sources = sweep_carbon_sources(args)
+        for carbon_type, percentile in args.sweep:
+            if carbon_type not in carbon_sources:
+                parser.error("unknown carbon type: {}".format(carbon_type))
+            if not all(carbon_sources[carbon_type]):
+                parser.error("the {} sweep runs need their carbon rasters".format(carbon_type))
+        if not args.output_dir:
+            parser.error("--sweep needs --output-dir")
+    elif not args.carbon or not args.output:
+        parser.error("--carbon and --output are required (unless running a --sweep)")
+    if args.ecoregion_polygons and not args.ecoregions.lower().endswith(".npy"):
+        parser.error("--ecoregion-polygons needs an --ecoregions .npy grid to write")
+    if args.approximate and args.manifest_dir:
+        parser.error("--approximate can't be combined with --manifest-dir")
+    if args.changed_bounds and not args.manifest_dir:
+        parser.error("--changed-bounds needs --manifest-dir")
+    if args.checkpoint_dir and (args.debug_dir or args.manifest_dir):
+        parser.error("--checkpoint-dir can't be combined with --debug-dir or --manifest-dir")
+    if args.region_bbox or args.region_ecoregions or args.region_polygons:
+        if args.manifest_dir:
+            parser.error("a region can't be combined with --manifest-dir")
+        if not args.ecoregions.lower().endswith(".npy"):
+            parser.error("a region needs an --ecoregions .npy grid (see --ecoregion-polygons)")
+    if args.zone_stats_from and (args.manifest_dir or args.filter_biomes or args.ecoregions_of_interest):
+        parser.error("--zone-stats-from can't be combined with --manifest-dir or filtering")
+    if args.filter_biomes or args.ecoregions_of_interest:
+        if args.manifest_dir:
+            parser.error("--filter-biomes and --ecoregions-of-interest can't be combined with --manifest-dir")
+        if not args.ecoregions.lower().endswith(".npy"):
+            parser.error("filtering needs an --ecoregions .npy grid (see --ecoregion-polygons)")
+
+
+def default_report(args):
+
+    """ --report, or <output>_run_report.json (run_report.json in --output-dir for a sweep). """
+
+    if args.report:
+        return args.report
+    if args.sweep:
+        return os.path.join(args.output_dir, "run_report.json")
+    return os.path.splitext(args.output)[0] + "_run_report.json"
+
+
+def main(argv=None):
+
+    parser = build_parser()
+    args = parser.parse_args(argv)
+    check_args(parser, args)
+
+    ecoregion_filter = None
+    if args.filter_biomes or args.ecoregions_of_interest:
+        ecoregions_of_interest = []
+        if args.ecoregions_of_interest:
+            ecoregions_of_interest = read_ecoregions_of_interest(args.ecoregions_of_interest)
+        ecoregion_filter = EcoregionFilter(args.filter_biomes, ecoregions_of_interest)
+
+    cache = None
+    if args.cache_dir:
+        max_bytes = int(args.cache_max_gb * 1024 ** 3) if args.cache_max_gb else None
+        cache = StepCache(args.cache_dir, max_bytes=max_bytes)
+
+    start_time = datetime.datetime.now()
+    print("\nStart Time: " + str(start_time))
+
+    with RunProfiler(default_report(args), config=dict(vars(args)), profile_step=args.profile_step):
+        run(args, cache, ecoregion_filter)
+
+    end_time = datetime.datetime.now()
+    print("End Time: " + str(end_time))
+    print("Duration: " + str(end_time - start_time))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,358 @@
+""" Batch runs from run spec files (TOML, or YAML with PyYAML installed), e.g. for the nightly scenarios:
+
+    python -m carbon_engine.batch scenarios.toml --workers 64 --parallel-runs 4
+
+    A spec holds the settings of python -m carbon_engine, named as its options with underscores (forest, carbon,
+    ecoregions, percentile, output, sweep, cache_dir, ...). A spec file is a single run, or a batch: a [defaults] table
+    shared by a list of [[runs]] (each with an optional name):
+
+        [defaults]
+        forest = "/data/Structural_forms_for_FAO_report.tif"
+        ecoregions = "/data/ecoregion_ids.npy"
+        ecoregion_polygons = "/data/RESOLVE_Biomes_and_Ecoregions_2017.shp"
+        cache_dir = "/scratch/carbon_cache"
+
+        [[runs]]
+        name = "belowground_50"
+        carbon = ["/data/belowground_biomass_carbon_2010.tif"]
+        percentile = 50
+        output = "/outputs/high_priority_forest_carbon_50th_percentile_belowground.tif"
+
+        [[runs]]
+        name = "sweep"
+        aboveground = "/data/aboveground_biomass_carbon_2010.tif"
+        belowground = "/data/belowground_biomass_carbon_2010.tif"
+        sweep = ["belowground:75", "combined:50", "combined:75"]
+        output_dir = "/outputs/sweep"
+
+    Every run is checked before anything starts. The stages the runs have in common are done once, before the runs:
+    staging the inputs and rasterizing each ecoregion grid. The runs then start in order, each in its own process
+    (logging to <output>.log, or run.log in output_dir), as long as the worker budget (--workers) and --parallel-runs
+    allow. A run gets its share of the budget unless its spec sets workers. Runs with the same cache_dir that need the
+    per-zone histograms of the same inputs (the zones of the same forest and ecoregions, with the same carbon) run one
+    after the other, so the later ones load the histograms from the cache instead of redoing pass 1. A checkpoint_dir
+    or manifest_dir is per run (a subdirectory named after the run).
+"""
+
+import argparse
+import datetime
+import os
+import subprocess
+import sys
+import time
+
+from .__main__ import build_parser, check_args, default_report, stage_inputs, sweep_carbon_sources
+from .ecoregions import rasterize_ecoregions
+from .pipeline import sweep_outputs
+from .scheduler import default_workers
+
+try:
+    import tomllib
+except ImportError:  # Python < 3.11
+    try:
+        import tomli as tomllib
+    except ImportError:
+        tomllib = None
+
+try:
+    import yaml
+except ImportError:
+    yaml = None
+
+_PACKAGE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+class SpecError(ValueError):
+    pass
+
+
+def read_spec_file(path):
+
+    """ The runs of a spec file, as a list of (name, settings) with the [defaults] merged in. """
+
+    extension = os.path.splitext(path)[1].lower()
+    if extension == ".toml":
+        if tomllib is None:
+            raise SpecError("{}: TOML run specs need Python 3.11 or the tomli package".format(path))
+        with open(path, "rb") as f:
+            try:
+                spec = tomllib.load(f)
+            except ValueError as e:
+                raise SpecError("{}: {}".format(path, e))
+    elif extension in (".yaml", ".yml"):
+        if yaml is None:
+            raise SpecError("{}: YAML run specs need the PyYAML package".format(path))
+        with open(path) as f:
+            try:
+                spec = yaml.safe_load(f) or {}
+            except yaml.YAMLError as e:
+                raise SpecError("{}: {}".format(path, e))
+    else:
+        raise SpecError("{}: run specs are .toml, .yaml or .yml files".format(path))
+
+    stem = os.path.splitext(os.path.basename(path))[0]
+    if "runs" not in spec:
+        settings = dict(spec)
+        return [(str(settings.pop("name", stem)), settings)]
+    defaults = spec.get("defaults", {})
+    unknown = set(spec) - {"defaults", "runs"}
+    if unknown:
+        raise SpecError("{}: a batch only holds [defaults] and [[runs]], not {}".format(path, ", ".join(sorted(unknown))))
+    runs = []
+    for i, run in enumerate(spec["runs"], 1):
+        settings = dict(defaults, **run)
+        runs.append((str(settings.pop("name", "{}_{}".format(stem, i))), settings))
+    return runs
+
+
+def _format(value):
+    if isinstance(value, (list, tuple)):  # A sweep run: [carbon type, percentile].
+        return ":".join(str(part) for part in value)
+    return str(value)
+
+
+def _options(parser):
+    return [action for action in parser._actions if action.option_strings and action.dest != "help"]
+
+
+def spec_argv(parser, settings):
+
+    """ Command line arguments of the settings of a run. """
+
+    options = {action.dest: action for action in _options(parser)}
+    argv = []
+    for key, value in settings.items():
+        action = options.get(key.replace("-", "_"))
+        if action is None:
+            raise SpecError("unknown setting: {}".format(key))
+        if action.nargs == 0:  # A flag, e.g. zone_stats = false for --no-zone-stats.
+            if value != action.default:
+                argv.append(action.option_strings[0])
+        elif value is not None:
+            argv.append(action.option_strings[0])
+            argv.extend(_format(item) for item in (value if isinstance(value, list) else [value]))
+    return argv
+
+
+def args_argv(parser, args):
+
+    """ Command line arguments that reproduce the parsed arguments args. """
+
+    argv = []
+    for action in _options(parser):
+        value = getattr(args, action.dest)
+        if value == action.default or value is None:
+            continue
+        argv.append(action.option_strings[0])
+        if action.nargs != 0:
+            argv.extend(_format(item) for item in (value if isinstance(value, list) else [value]))
+    return argv
+
+
+class BatchRun:
+
+    """ A run of a batch: its name, parsed arguments and the runs it waits for. """
+
+    def __init__(self, name, args, explicit_workers):
+        self.name = name
+        self.args = args
+        self.explicit_workers = explicit_workers
+        self.after = []
+        self.process = None
+        self.log = None
+        self.started = None
+        self.duration = None
+        self.returncode = None
+
+    def outputs(self):
+        args = self.args
+        if args.sweep:
+            return sweep_outputs(args.output_dir, args.sweep)
+        return [args.output]
+
+    def log_path(self):
+        if self.args.sweep:
+            return os.path.join(self.args.output_dir, "run.log")
+        return os.path.splitext(self.args.output)[0] + ".log"
+
+    def histogram_keys(self):
+
+        """ Identity of the per-zone histograms of each carbon type of the run in its cache (none without one). """
+
+        args = self.args
+        if not args.cache_dir:
+            return set()
+        if args.sweep:
+            carbon_sources = sweep_carbon_sources(args)
+            carbon = [carbon_sources[carbon_type] for carbon_type, percentile in args.sweep]
+        else:
+            carbon = [args.carbon]
+        return {(os.path.abspath(args.cache_dir), os.path.abspath(args.forest), os.path.abspath(args.ecoregions),
+                 tuple(os.path.abspath(path) for path in paths), args.approximate) for paths in carbon}
+
+
+def plan_batch(spec_files, workers, parallel_runs):
+
+    """ Parses and checks the runs of the spec files (SpecError if one isn't valid) and sets their workers, their
+        per run directories and the runs they wait for.
+    """
+
+    parser = build_parser()
+
+    def error(message):
+        raise SpecError(message)
+
+    parser.error = error
+
+    runs = []
+    for path in spec_files:
+        for name, settings in read_spec_file(path):
+            try:
+                args = parser.parse_args(spec_argv(parser, settings))
+                check_args(parser, args)
+            except SpecError as e:
+                raise SpecError("run {} ({}): {}".format(name, path, e))
+            runs.append(BatchRun(name, args, "workers" in settings))
+
+    names, outputs = set(), {}
+    for run in runs:
+        if run.name in names:
+            raise SpecError("two runs are named {}".format(run.name))
+        names.add(run.name)
+        for output in run.outputs() + [run.log_path(), default_report(run.args)]:
+            output = os.path.abspath(output)
+            if output in outputs:
+                raise SpecError("runs {} and {} both write {}".format(outputs[output], run.name, output))
+            outputs[output] = run.name
+
+    share = max(1, workers // max(1, min(parallel_runs, len(runs))))
+    for i, run in enumerate(runs):
+        run.args.workers = min(run.args.workers, workers) if run.explicit_workers else share
+        for name in ("checkpoint_dir", "manifest_dir"):
+            if getattr(run.args, name):
+                setattr(run.args, name, os.path.join(getattr(run.args, name), run.name))
+        keys = run.histogram_keys()
+        run.after = [other for other in runs[:i] if keys & other.histogram_keys()]
+    return runs
+
+
+def run_shared_stages(runs, workers):
+
+    """ Stages the inputs and rasterizes the ecoregion grids of the runs, once for all runs that share them. """
+
+    for run in runs:
+        if run.args.staging_dir:
+            stage_inputs(run.args)
+            run.args.staging_dir = None
+
+    rasterized = set()
+    for run in runs:
+        args = run.args
+        if args.ecoregion_polygons:
+            grid = (args.ecoregion_polygons, args.forest, os.path.abspath(args.ecoregions))
+            if grid not in rasterized:
+                rasterize_ecoregions(args.ecoregion_polygons, args.forest, args.ecoregions,
+                                     block_size=args.block_size, workers=workers).close()
+                rasterized.add(grid)
+            args.ecoregion_polygons = None
+
+
+def _start(run, parser):
+    log_path = run.log_path()
+    if not os.path.isdir(os.path.dirname(os.path.abspath(log_path))):
+        os.makedirs(os.path.dirname(os.path.abspath(log_path)))
+    env = dict(os.environ)
+    env["PYTHONPATH"] = os.pathsep.join(filter(None, [_PACKAGE_DIR, env.get("PYTHONPATH")]))
+    run.log = open(log_path, "w")
+    run.started = datetime.datetime.now()
+    run.process = subprocess.Popen([sys.executable, "-u", "-m", "carbon_engine"] + args_argv(parser, run.args),
+                                   stdout=run.log, stderr=subprocess.STDOUT, env=env)
+    print(" -> Started {} ({} workers), log: {}".format(run.name, run.args.workers, log_path))
+
+
+def run_batch(runs, workers, parallel_runs, poll_interval=1.0):
+
+    """ Runs the runs (see plan_batch and run_shared_stages), at most parallel_runs and workers worker processes at a
+        time. A failed run doesn't stop the others. Returns the runs that failed.
+    """
+
+    parser = build_parser()
+    pending, running, finished = list(runs), [], []
+    try:
+        while pending or running:
+            for run in list(running):
+                if run.process.poll() is not None:
+                    run.returncode = run.process.returncode
+                    run.duration = datetime.datetime.now() - run.started
+                    run.log.close()
+                    running.remove(run)
+                    finished.append(run)
+                    if run.returncode:
+                        print(" -> {} failed (exit code {}), see {}".format(run.name, run.returncode, run.log_path()))
+                    else:
+                        print(" -> {} finished in {}".format(run.name, run.duration))
+
+            used = sum(run.args.workers for run in running)
+            for run in list(pending):
+                if len(running) >= parallel_runs:
+                    break
+                if any(other not in finished for other in run.after):
+                    continue
+                if running and used + run.args.workers > workers:
+                    break  # Start the runs in order, so a large run isn't passed over indefinitely.
+                _start(run, parser)
+                pending.remove(run)
+                running.append(run)
+                used += run.args.workers
+            if running:
+                time.sleep(poll_interval)
+    finally:
+        for run in running:
+            run.process.terminate()
+            run.process.wait()
+            run.log.close()
+    return [run for run in finished if run.returncode]
+
+
+def main(argv=None):
+
+    parser = argparse.ArgumentParser(prog="python -m carbon_engine.batch",
+                                     description="Runs the pipeline for the runs of one or more run spec files.")
+    parser.add_argument("specs", nargs="+", metavar="SPEC", help="Run spec files (.toml, .yaml or .yml).")
+    parser.add_argument("--workers", type=int, default=default_workers(),
+                        help="Worker processes shared by the runs (default: one per CPU).")
+    parser.add_argument("--parallel-runs", type=int, default=1,
+                        help="Maximum number of runs at the same time (default: 1).")
+    parser.add_argument("--dry-run", action="store_true",
+                        help="Check the runs and print their commands without running anything.")
+    args = parser.parse_args(argv)
+
+    try:
+        runs = plan_batch(args.specs, args.workers, args.parallel_runs)
+    except SpecError as e:
+        parser.error(str(e))
+
+    if args.dry_run:
+        run_parser = build_parser()
+        for run in runs:
+            after = " (after {})".format(", ".join(other.name for other in run.after)) if run.after else ""
+            print("{}{}: python -m carbon_engine {}".format(run.name, after,
+                                                           subprocess.list2cmdline(args_argv(run_parser, run.args))))
+        return
+
+    start_time = datetime.datetime.now()
+    print("\nStart Time: " + str(start_time))
+
+    run_shared_stages(runs, args.workers)
+    failed = run_batch(runs, args.workers, args.parallel_runs)
+
+    end_time = datetime.datetime.now()
+    print("End Time: " + str(end_time))
+    print("Duration: " + str(end_time - start_time))
+    if failed:
+        print("{} of {} runs failed: {}".format(len(failed), len(runs), ", ".join(run.name for run in failed)))
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
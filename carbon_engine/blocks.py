@@ -0,0 +1,133 @@
+""" Block-windowed raster access for the NumPy engine.
+
+    Rasters are read one window at a time so that peak memory depends on the block size rather than on the size of the
+    (global) inputs. Values from a raster on another grid are sampled onto the grid being processed by nearest cell
+    centre, which is what the Spatial Analyst tools do when a snap raster is set and the cell sizes match.
+"""
+
+import numpy as np
+from rasterio.windows import Window
+
+DEFAULT_BLOCK_SIZE = 2048
+
+
+def iter_windows(width, height, block_size=DEFAULT_BLOCK_SIZE):
+
+    """ Yields the windows that tile a width x height grid, in row-major order. """
+
+    for row_off in range(0, height, block_size):
+        for col_off in range(0, width, block_size):
+            yield Window(col_off, row_off, min(block_size, width - col_off), min(block_size, height - row_off))
+
+
+def window_indices(window):
+
+    """ Returns the row and column indices covered by a window. """
+
+    rows = np.arange(window.row_off, window.row_off + window.height, dtype=np.int64)
+    cols = np.arange(window.col_off, window.col_off + window.width, dtype=np.int64)
+    return rows, cols
+
+
+def map_indices(dst_transform, rows, cols, src_transform):
+
+    """ Maps rows and columns of the destination grid to the source grid cells that contain their cell centres. """
+
+    for transform in (dst_transform, src_transform):
+        if transform.b != 0 or transform.d != 0:
+            raise ValueError("Rotated rasters are not supported: {}".format(transform))
+
+    if dst_transform.almost_equals(src_transform):
+        return rows, cols
+
+    y = dst_transform.f + (rows + 0.5) * dst_transform.e
+    x = dst_transform.c + (cols + 0.5) * dst_transform.a
+    src_rows = np.floor((y - src_transform.f) / src_transform.e).astype(np.int64)
+    src_cols = np.floor((x - src_transform.c) / src_transform.a).astype(np.int64)
+    return src_rows, src_cols
+
+
+def _is_range(indices):
+    return indices.size > 0 and indices[-1] - indices[0] + 1 == indices.size and np.all(np.diff(indices) == 1)
+
+
+def read_indexed(src, rows, cols, band=1):
+
+    """ Reads the cells at rows x cols of an open raster. Returns (data, valid) arrays of shape (len(rows), len(cols)).
+        Cells outside the raster and NoData cells are flagged as not valid.
+    """
+
+    row_in = (rows >= 0) & (rows < src.height)
+    col_in = (cols >= 0) & (cols < src.width)
+
+    if not row_in.any() or not col_in.any():
+        data = np.zeros((rows.size, cols.size), dtype=src.dtypes[band - 1])
+        return data, np.zeros(data.shape, dtype=bool)
+
+    r0, r1 = int(rows[row_in].min()), int(rows[row_in].max()) + 1
+    c0, c1 = int(cols[col_in].min()), int(cols[col_in].max()) + 1
+    block = src.read(band, window=Window(c0, r0, c1 - c0, r1 - r0), masked=True)
+    data = np.ma.getdata(block)
+    valid = ~np.ma.getmaskarray(block)
+
+    if row_in.all() and col_in.all() and _is_range(rows) and _is_range(cols):
+        return data, valid
+
+    r = np.clip(rows - r0, 0, r1 - r0 - 1)
+    c = np.clip(cols - c0, 0, c1 - c0 - 1)
+    data = data[np.ix_(r, c)]
+    valid = valid[np.ix_(r, c)] & row_in[:, None] & col_in[None, :]
+    return data, valid
+
+
+class ReadCache:
+
+    """ Memoizes read_indexed, e.g. so that a carbon raster used by several carbon types is read once per window. """
+
+    def __init__(self):
+        self._reads = {}
+
+    def read(self, src, rows, cols):
+        key = (src.name, rows.tobytes(), cols.tobytes())
+        if key not in self._reads:
+            self._reads[key] = read_indexed(src, rows, cols)
+        return self._reads[key]
+
+
+def read_aligned(src, dst_transform, window, band=1):
+
+    """ Reads src sampled onto the cells of a window of the destination grid. """
+
+    rows, cols = window_indices(window)
+    return read_indexed(src, *map_indices(dst_transform, rows, cols, src.transform), band=band)
+
+
+def default_nodata(dtype):
+
+    """ NoData value used for engine outputs of the given dtype. """
+
+    dtype = np.dtype(dtype)
+    if np.issubdtype(dtype, np.integer):
+        return np.iinfo(dtype).max if np.issubdtype(dtype, np.unsignedinteger) else np.iinfo(dtype).min
+    return float(np.finfo(np.float32).min)
+
+
+def output_profile(src, dtype, nodata):
+
+    """ GeoTIFF creation options for an engine output on the grid of src. """
+
+    return {
+        "driver": "GTiff",
+        "width": src.width,
+        "height": src.height,
+        "count": 1,
+        "crs": src.crs,
+        "transform": src.transform,
+        "dtype": np.dtype(dtype).name,
+        "nodata": nodata,
+        "tiled": True,
+        "blockxsize": 256,
+        "blockysize": 256,
+        "compress": "lzw",
+        "BIGTIFF": "IF_SAFER",
+    }
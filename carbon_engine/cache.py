@@ -0,0 +1,221 @@
+""" Content-addressed cache of intermediate results.
+
+    Each step declares its inputs (paths) and parameters. The cache key is a hash of the step name, the identity of
+    every input (path, size and modification time of its files) and the parameters, so a result is reused only if
+    nothing it depends on has changed. An input that is itself a cache entry is identified by its key, so changing an
+    upstream parameter invalidates everything downstream of it. Entries are directories under the cache directory;
+    the least recently used ones are evicted once the cache grows beyond max_bytes.
+
+    The entries a process uses are pinned with a marker file in the entry, so runs sharing a cache directory (e.g. the
+    parallel runs of a batch) never evict each other's entries. The markers are removed when the process exits; those
+    left by a process that crashed are ignored after PIN_HOURS.
+"""
+
+import atexit
+import fnmatch
+import hashlib
+import json
+import os
+import shutil
+import time
+import uuid
+
+_COMPLETE = ".complete"
+_PIN_PREFIX = ".pin_"
+PIN_HOURS = 72
+
+# Files that ArcGIS creates in a geodatabase while it's open, which say nothing about its contents.
+IGNORED_FILES = ("*.lock",)
+
+
+def existing_input(path):
+
+    """ The path itself if it exists, or the .gdb it's in (a raster or feature class in a file geodatabase isn't a
+        path of its own). Raises FileNotFoundError for anything else, e.g. a mistyped input.
+    """
+
+    path = os.path.abspath(path)
+    existing = path
+    while not os.path.exists(existing) and os.path.dirname(existing) != existing:
+        existing = os.path.dirname(existing)
+    if existing != path and not (existing.lower().endswith(".gdb") and os.path.isdir(existing)):
+        raise FileNotFoundError("input not found: {}".format(path))
+    return existing
+
+
+def _ignored(name):
+    return any(fnmatch.fnmatch(name.lower(), pattern) for pattern in IGNORED_FILES)
+
+
+def fingerprint(path):
+
+    """ Identity of an input: its absolute path plus the size and modification time of each of its files (but the
+        lock files of a geodatabase).
+    """
+
+    existing = existing_input(path)
+    if os.path.isfile(existing):
+        files = [existing]
+    else:
+        files = sorted(os.path.join(root, name) for root, dirs, names in os.walk(existing) for name in names
+                       if not _ignored(name))
+
+    stats = []
+    for file_path in files:
+        stat = os.stat(file_path)
+        stats.append([os.path.relpath(file_path, existing), stat.st_size, stat.st_mtime_ns])
+    return {"path": os.path.abspath(path), "files": stats}
+
+
+def _size(path):
+    return sum(os.path.getsize(os.path.join(root, name)) for root, dirs, names in os.walk(path) for name in names)
+
+
+class CacheEntry:
+
+    """ Directory holding the outputs of one step for one set of inputs and parameters. """
+
+    def __init__(self, cache, key):
+        self.cache = cache
+        self.key = key
+        self.directory = os.path.join(cache.cache_dir, key)
+
+    @property
+    def complete(self):
+        return os.path.exists(os.path.join(self.directory, _COMPLETE))
+
+    def path(self, filename):
+
+        """ Path of an output of the step inside the entry. """
+
+        return os.path.join(self.directory, filename)
+
+    def create(self):
+
+        """ Creates the entry directory before the step writes its outputs. """
+
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory)
+        self.cache.pin(self)
+
+    def touch(self):
+
+        """ Marks the entry as used now (for LRU eviction). """
+
+        os.utime(os.path.join(self.directory, _COMPLETE))
+
+    def commit(self):
+
+        """ Marks the outputs as complete and evicts old entries if the cache is over its size limit. """
+
+        with open(os.path.join(self.directory, _COMPLETE), "w") as f:
+            json.dump({"size": _size(self.directory), "created": time.time()}, f)
+        self.cache.evict()
+
+
+class StepCache:
+
+    """ Cache of step outputs under cache_dir, limited to max_bytes (None for no limit). Entries in use by this or any
+        other process (see pin) are never evicted.
+    """
+
+    def __init__(self, cache_dir, max_bytes=None):
+        self.cache_dir = os.path.abspath(cache_dir)
+        self.max_bytes = max_bytes
+        self._pin_name = _PIN_PREFIX + uuid.uuid4().hex
+        self._pinned = set()
+        if not os.path.isdir(self.cache_dir):
+            os.makedirs(self.cache_dir)
+        atexit.register(self.release)
+
+    def _identity(self, path):
+        path = os.path.abspath(path)
+        try:
+            in_cache = path != self.cache_dir and os.path.commonpath([path, self.cache_dir]) == self.cache_dir
+        except ValueError:  # On another drive.
+            in_cache = False
+        if in_cache:
+            return {"entry": os.path.relpath(path, self.cache_dir)}
+        return fingerprint(path)
+
+    def key(self, step, inputs=(), params=None):
+
+        """ Cache key of a step with the given input paths and parameters. """
+
+        description = {
+            "step": step,
+            "inputs": [self._identity(path) for path in inputs],
+            "params": params or {},
+        }
+        digest = hashlib.sha256(json.dumps(description, sort_keys=True, default=str).encode("utf-8")).hexdigest()
+        return "{}_{}".format(step, digest[:24])
+
+    def entry(self, step, inputs=(), params=None):
+
+        """ Cache entry of a step. If entry.complete, its outputs can be used as they are. """
+
+        entry = CacheEntry(self, self.key(step, inputs, params))
+        if entry.complete:
+            self.pin(entry)
+            entry.touch()
+        return entry
+
+    def pin(self, entry):
+
+        """ Marks an entry as in use by this cache until release() (called when the process exits). """
+
+        with open(entry.path(self._pin_name), "w"):
+            pass
+        self._pinned.add(entry.key)
+
+    def release(self):
+
+        """ Unpins the entries pinned by this cache. """
+
+        for key in self._pinned:
+            try:
+                os.remove(os.path.join(self.cache_dir, key, self._pin_name))
+            except OSError:
+                pass
+        self._pinned.clear()
+
+    def _in_use(self, directory):
+        expired = time.time() - PIN_HOURS * 3600
+        for name in os.listdir(directory):
+            if name.startswith(_PIN_PREFIX):
+                try:
+                    if os.path.getmtime(os.path.join(directory, name)) > expired:
+                        return True
+                except OSError:  # Released meanwhile.
+                    pass
+        return False
+
+    def evict(self):
+
+        """ Removes the least recently used entries until the cache fits in max_bytes. """
+
+        if self.max_bytes is None:
+            return
+
+        entries = []
+        for key in os.listdir(self.cache_dir):
+            directory = os.path.join(self.cache_dir, key)
+            if not os.path.isdir(directory):
+                continue
+            marker = os.path.join(directory, _COMPLETE)
+            if os.path.exists(marker):
+                with open(marker) as f:
+                    size = json.load(f)["size"]
+                last_used = os.path.getmtime(marker)
+            else:
+                size, last_used = _size(directory), 0  # Left over from an interrupted step.
+            entries.append((last_used, key, size))
+
+        total = sum(size for last_used, key, size in entries)
+        for last_used, key, size in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            if self._in_use(os.path.join(self.cache_dir, key)):
+                continue
+            shutil.rmtree(os.path.join(self.cache_dir, key), ignore_errors=True)
+            total -= size
@@ -0,0 +1,134 @@
+""" Checkpoint journal of a long run, so that a run that dies partway (a dropped network share, a preempted node) can
+    be restarted where it stopped.
+
+    The journal (journal.json in the checkpoint directory) records how many tiles of each pass are done and the
+    snapshot of the partial accumulator state at that point. The windows of a pass are processed in a fixed order and
+    their results merged in that order, so "done" is always a prefix of the windows: a restarted run loads the
+    snapshot and carries on with the next window, and skips the passes that are finished. The journal also holds a
+    signature of the run (its inputs, outputs and parameters); a journal of another run is discarded.
+
+    Checkpoints are written at most every interval seconds (and at the end of each pass), so a crash loses at most
+    that much work plus the tiles in flight. The journal is replaced atomically, and a new snapshot is complete on
+    disk before the journal points to it.
+
+    The checkpoint directory may hold other files (e.g. it's the output directory): only the journal and the snapshot
+    directories of the passes (<pass>_<tiles done>) are ever removed, and the directory itself only if the checkpoint
+    created it and it's empty once they're gone.
+"""
+
+import json
+import os
+import re
+import shutil
+import time
+
+from .cache import fingerprint
+
+_JOURNAL = "journal.json"
+DEFAULT_INTERVAL = 600
+
+
+def run_signature(inputs, outputs, params=None):
+
+    """ Signature of a run: the identity of its inputs (see cache.fingerprint), its outputs and its parameters. """
+
+    return json.loads(json.dumps({
+        "inputs": [fingerprint(path) for path in inputs],
+        "outputs": [os.path.abspath(path) for path in outputs],
+        "params": params or {},
+    }, sort_keys=True, default=str))
+
+
+class Checkpoint:
+
+    """ Journal of a run in directory. signature: see run_signature. interval: minimum seconds between checkpoints. """
+
+    def __init__(self, directory, signature, interval=DEFAULT_INTERVAL):
+        self.directory = os.path.abspath(directory)
+        self.signature = signature
+        self.interval = interval
+        self._passes = {}
+        self._created = not os.path.isdir(self.directory)
+        self._saved = time.monotonic()
+
+        journal = os.path.join(self.directory, _JOURNAL)
+        if os.path.exists(journal):
+            with open(journal) as f:
+                state = json.load(f)
+            self._created = state.get("created_directory", False)
+            if state.get("signature") == signature:
+                self._passes = state["passes"]
+            else:
+                print(" -> The checkpoint in {} is of another run, starting over".format(self.directory))
+                self._remove(state.get("passes", {}))
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory)
+
+    def _remove(self, passes):
+
+        """ Removes the journal and the snapshots of passes, including those of unfinished checkpoints. """
+
+        for path in (os.path.join(self.directory, _JOURNAL), os.path.join(self.directory, _JOURNAL + ".tmp")):
+            if os.path.exists(path):
+                os.remove(path)
+        snapshot = re.compile("^({})_[0-9]+$".format("|".join(re.escape(name) for name in passes)))
+        for name in os.listdir(self.directory) if passes else []:
+            if snapshot.match(name) and os.path.isdir(os.path.join(self.directory, name)):
+                shutil.rmtree(os.path.join(self.directory, name), ignore_errors=True)
+
+    def done(self, name):
+
+        """ Number of tiles of pass name that are done (0 if it hasn't been checkpointed). """
+
+        return self._passes.get(name, {}).get("done", 0)
+
+    def snapshot(self, name):
+
+        """ Directory of the accumulator snapshot of pass name at its last checkpoint, or None. """
+
+        snapshot = self._passes.get(name, {}).get("snapshot")
+        return os.path.join(self.directory, snapshot) if snapshot else None
+
+    def due(self):
+
+        """ Whether interval seconds have passed since the last checkpoint. """
+
+        return time.monotonic() - self._saved >= self.interval
+
+    def save(self, name, done, write_snapshot=None):
+
+        """ Records that the first done tiles of pass name are done. write_snapshot(directory), if given, writes the
+            accumulator state after those tiles to directory.
+        """
+
+        old_snapshot = self.snapshot(name)
+        state = {"done": done}
+        if write_snapshot is not None:
+            state["snapshot"] = "{}_{}".format(name, done)
+            directory = os.path.join(self.directory, state["snapshot"])
+            if os.path.isdir(directory):
+                shutil.rmtree(directory)
+            os.makedirs(directory)
+            write_snapshot(directory)
+
+        self._passes[name] = state
+        path = os.path.join(self.directory, _JOURNAL)
+        with open(path + ".tmp", "w") as f:
+            json.dump({"signature": self.signature, "passes": self._passes, "saved": time.time(),
+                       "created_directory": self._created}, f, indent=1)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(path + ".tmp", path)
+        if old_snapshot and old_snapshot != self.snapshot(name):
+            shutil.rmtree(old_snapshot, ignore_errors=True)
+        self._saved = time.monotonic()
+
+    def finish(self):
+
+        """ Removes the journal and the snapshots once the run is complete (and the directory, if the checkpoint created
+            it and nothing else is in it).
+        """
+
+        self._remove(self._passes)
+        if self._created and not os.listdir(self.directory):
+            os.rmdir(self.directory)
@@ -0,0 +1,288 @@
+""" Cloud Optimized GeoTIFF output.
+
+    The final rasters are mostly NoData, so they are written as internally tiled, compressed COGs with overviews, in
+    the smallest data type that holds their values. Windows are streamed into a temporary tiled GeoTIFF and the
+    overview levels are built while the windows go by, so the overviews don't need the input data to be read again.
+    Each overview cell is the mean of the valid full resolution cells it covers: the sums and counts of the cells are
+    carried down the levels, rather than averaging the averages of the level below.
+
+    On close, GDAL's COG driver copies the full resolution and the overview levels into the COG layout. That copy
+    reads and recompresses everything written so far, so it costs about as much time again as streaming the parts
+    (benchmarks/cog_output.py measures it).
+"""
+
+import math
+import os
+import shutil
+from xml.sax.saxutils import escape
+
+import numpy as np
+import rasterio
+import rasterio.shutil
+from rasterio.windows import Window
+
+from .blocks import DEFAULT_BLOCK_SIZE, default_nodata, iter_windows
+from .profiling import count_tiles
+
+COG_BLOCK_SIZE = 512
+
+# Integer data types tried by fit_dtype, smallest first.
+_INTEGER_DTYPES = (np.uint8, np.uint16, np.int16, np.uint32, np.int32)
+
+_GDAL_TYPE_NAMES = {
+    "uint8": "Byte",
+    "uint16": "UInt16",
+    "int16": "Int16",
+    "uint32": "UInt32",
+    "int32": "Int32",
+    "float32": "Float32",
+    "float64": "Float64",
+}
+
+
+def fit_dtype(value_min, value_max, integer=True):
+
+    """ Smallest data type that holds value_min..value_max plus its NoData value (default_nodata()). Returns
+        (dtype, nodata). Non-integer values are written as float32.
+    """
+
+    if integer:
+        for dtype in _INTEGER_DTYPES:
+            info = np.iinfo(dtype)
+            nodata = default_nodata(dtype)
+            if info.min <= value_min and value_max <= info.max and not value_min <= nodata <= value_max:
+                return np.dtype(dtype), nodata
+    return np.dtype(np.float32), default_nodata(np.float32)
+
+
+def overview_factors(width, height, block_size=COG_BLOCK_SIZE):
+
+    """ Overview decimation factors (2, 4, 8, ...) until the smallest level fits in one block, like the COG driver. """
+
+    factors = []
+    factor = 2
+    while math.ceil(width / (factor // 2)) > block_size or math.ceil(height / (factor // 2)) > block_size:
+        factors.append(factor)
+        factor *= 2
+    return factors
+
+
+def _sum_2x2(sums, counts):
+
+    """ Halves the resolution of a block of sums and counts of valid cells: each cell gets the totals of its 2 x 2
+        parent cells.
+    """
+
+    height, width = sums.shape
+    padded_shape = (height + height % 2, width + width % 2)
+    padded_sums = np.zeros(padded_shape, dtype=np.float64)
+    padded_counts = np.zeros(padded_shape, dtype=np.int64)
+    padded_sums[:height, :width] = sums
+    padded_counts[:height, :width] = counts
+    return (padded_sums.reshape(padded_shape[0] // 2, 2, padded_shape[1] // 2, 2).sum(axis=(1, 3)),
+            padded_counts.reshape(padded_shape[0] // 2, 2, padded_shape[1] // 2, 2).sum(axis=(1, 3)))
+
+
+def _mean(sums, counts):
+    return sums / np.maximum(counts, 1), counts > 0
+
+
+class CogWriter:
+
+    """ Writes a raster on the grid of like (an open dataset, or anything with its width, height, crs and transform)
+        window by window into a COG at path.
+
+        Windows must be those of iter_windows(width, height, window_size); overview levels whose factor divides
+        window_size are built as the windows are written, the (small) remaining ones on close from the sums and counts
+        of the last of those, which are kept in a part of their own. Use as a context manager: the COG is only created
+        if the block exits without an exception.
+
+        With resume, the parts left by an interrupted writer (see flush and suspend) or kept by close are reopened and
+        written to further, if they are there; resumed tells whether they were. parts_dir: where the parts are kept
+        (default: next to path).
+    """
+
+    def __init__(self, path, like, dtype, nodata, window_size=DEFAULT_BLOCK_SIZE, compress="DEFLATE",
+                 block_size=COG_BLOCK_SIZE, resume=False, parts_dir=None):
+        self.path = path
+        self.dtype = np.dtype(dtype)
+        self.nodata = nodata
+        self.compress = compress
+        self.block_size = block_size
+        self.width, self.height = like.width, like.height
+        self.crs, self.transform = like.crs, like.transform
+
+        self.factors = overview_factors(self.width, self.height, block_size)
+        self._streamed = [factor for factor in self.factors if window_size % factor == 0]
+        self._parts_dir = parts_dir or path + ".parts"
+        # Sums (band 1) and counts (band 2) of the last streamed level, for the levels built on close.
+        self._weighted = bool(self._streamed) and len(self._streamed) < len(self.factors)
+        names = ["base.tif"] + ["overview_{}.tif".format(factor) for factor in self._streamed]
+        names += ["weights.tif"] if self._weighted else []
+
+        self.resumed = resume and all(os.path.exists(os.path.join(self._parts_dir, name)) for name in names)
+        if self.resumed:
+            self._base, self._levels, self._weights = self._reopen_parts()
+            return
+        if os.path.isdir(self._parts_dir):
+            shutil.rmtree(self._parts_dir)
+        os.makedirs(self._parts_dir)
+        self._base = self._open_part("base.tif", 1)
+        self._levels = [self._open_part("overview_{}.tif".format(factor), factor) for factor in self._streamed]
+        self._weights = None
+        if self._weighted:
+            self._weights = self._open_part("weights.tif", self._streamed[-1], np.float64, count=2)
+
+    def _reopen_parts(self):
+        base = rasterio.open(os.path.join(self._parts_dir, "base.tif"), "r+")
+        levels = [rasterio.open(os.path.join(self._parts_dir, "overview_{}.tif".format(factor)), "r+")
+                  for factor in self._streamed]
+        weights = rasterio.open(os.path.join(self._parts_dir, "weights.tif"), "r+") if self._weighted else None
+        return base, levels, weights
+
+    def _open_part(self, filename, factor, dtype=None, count=1):
+        dtype = self.dtype if dtype is None else np.dtype(dtype)
+        return rasterio.open(os.path.join(self._parts_dir, filename), "w", driver="GTiff",
+                             width=math.ceil(self.width / factor), height=math.ceil(self.height / factor), count=count,
+                             crs=self.crs, transform=self.transform * self.transform.scale(factor),
+                             dtype=dtype.name, nodata=self.nodata if dtype == self.dtype else None, tiled=True,
+                             blockxsize=self.block_size, blockysize=self.block_size, compress="lzw",
+                             BIGTIFF="IF_SAFER")
+
+    def _cast(self, values, valid):
+        if np.issubdtype(self.dtype, np.integer):
+            values = np.rint(values)
+        return np.where(valid, values, self.nodata).astype(self.dtype)
+
+    def write(self, values, window, valid=None):
+
+        """ Writes one window. Cells where valid is False (default: where values equal nodata) become nodata. """
+
+        if valid is None:
+            valid = values != self.nodata
+        self._base.write(self._cast(values, valid), 1, window=window)
+
+        sums, counts = np.where(valid, values, 0).astype(np.float64), valid.astype(np.int64)
+        for factor, level in zip(self._streamed, self._levels):
+            sums, counts = _sum_2x2(sums, counts)
+            level_window = Window(window.col_off // factor, window.row_off // factor, sums.shape[1], sums.shape[0])
+            level.write(self._cast(*_mean(sums, counts)), 1, window=level_window)
+        if self._weights is not None:
+            self._weights.write(np.stack([sums, counts]), window=level_window)
+
+    def flush(self):
+
+        """ Makes sure everything written so far is on disk (by closing and reopening the parts). """
+
+        self.suspend()
+        self._base, self._levels, self._weights = self._reopen_parts()
+
+    def _finish_levels(self):
+
+        """ Builds the levels that couldn't be streamed from the sums and counts of the last streamed level (or the
+            full resolution).
+        """
+
+        parts = ["overview_{}.tif".format(factor) for factor in self._streamed]
+        remaining = self.factors[len(self._streamed):]
+        if not remaining:
+            return parts
+
+        if self._weighted:
+            with rasterio.open(os.path.join(self._parts_dir, "weights.tif")) as src:
+                sums, counts = src.read(1), src.read(2).astype(np.int64)
+        else:
+            with rasterio.open(os.path.join(self._parts_dir, "base.tif")) as src:
+                block = src.read(1, masked=True)
+            counts = (~np.ma.getmaskarray(block)).astype(np.int64)
+            sums = np.where(counts > 0, np.ma.getdata(block), 0).astype(np.float64)
+        for factor in remaining:
+            sums, counts = _sum_2x2(sums, counts)
+            parts.append("overview_{}.tif".format(factor))
+            with self._open_part(parts[-1], factor) as level:
+                level.write(self._cast(*_mean(sums, counts)), 1)
+        return parts
+
+    def _write_vrt(self, overview_parts):
+
+        """ VRT of the full resolution part with the overview parts as its overviews. """
+
+        overviews = "".join(
+            "<Overview><SourceFilename relativeToVRT=\"1\">{}</SourceFilename><SourceBand>1</SourceBand></Overview>"
+            .format(part) for part in overview_parts)
+        xml = (
+            "<VRTDataset rasterXSize=\"{width}\" rasterYSize=\"{height}\">"
+            "<SRS>{srs}</SRS><GeoTransform>{transform}</GeoTransform>"
+            "<VRTRasterBand dataType=\"{data_type}\" band=\"1\"><NoDataValue>{nodata!r}</NoDataValue>"
+            "<SimpleSource><SourceFilename relativeToVRT=\"1\">base.tif</SourceFilename><SourceBand>1</SourceBand>"
+            "</SimpleSource>{overviews}</VRTRasterBand></VRTDataset>"
+        ).format(width=self.width, height=self.height, srs=escape(self.crs.to_wkt()) if self.crs else "",
+                 transform=", ".join(repr(value) for value in self.transform.to_gdal()),
+                 data_type=_GDAL_TYPE_NAMES[self.dtype.name], nodata=self.nodata, overviews=overviews)
+        vrt = os.path.join(self._parts_dir, "cog.vrt")
+        with open(vrt, "w") as f:
+            f.write(xml)
+        return vrt
+
+    def close(self, keep_parts=False):
+
+        """ Assembles the COG from the parts and removes them, or keeps them (keep_parts) for a later writer to resume
+            and update some of the windows.
+        """
+
+        self.suspend()
+        vrt = self._write_vrt(self._finish_levels())
+        rasterio.shutil.copy(vrt, self.path, driver="COG", COMPRESS=self.compress,
+                             BLOCKSIZE=self.block_size, OVERVIEWS="FORCE_USE_EXISTING", BIGTIFF="IF_SAFER",
+                             NUM_THREADS="ALL_CPUS")
+        if not keep_parts:
+            shutil.rmtree(self._parts_dir)
+
+    def suspend(self):
+
+        """ Closes the parts without writing the COG, so that a later writer can resume them. """
+
+        for dst in [self._base] + self._levels + ([self._weights] if self._weights is not None else []):
+            dst.close()
+
+    def abort(self):
+
+        """ Closes the parts and removes them without writing the COG. """
+
+        self.suspend()
+        shutil.rmtree(self._parts_dir, ignore_errors=True)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+
+
+def convert_to_cog(src_path, dst_path, block_size=DEFAULT_BLOCK_SIZE):
+
+    """ Rewrites a raster (e.g. an ArcGIS output) as a COG in the smallest data type that holds its values. Reads it
+        twice: once for the value range, once to write it.
+    """
+
+    with rasterio.open(src_path) as src:
+        windows = list(iter_windows(src.width, src.height, block_size))
+        value_min, value_max, integer = np.inf, -np.inf, True
+        for window in windows:
+            block = src.read(1, window=window, masked=True)
+            values = block.compressed()
+            if values.size:
+                value_min, value_max = min(value_min, values.min()), max(value_max, values.max())
+                integer = integer and bool(np.all(values == np.rint(values)))
+        if value_min > value_max:
+            value_min = value_max = 0
+        dtype, nodata = fit_dtype(value_min, value_max, integer)
+
+        with CogWriter(dst_path, src, dtype, nodata, window_size=block_size) as dst:
+            for window in windows:
+                count_tiles()
+                block = src.read(1, window=window, masked=True)
+                dst.write(np.ma.getdata(block), window, ~np.ma.getmaskarray(block))
@@ -0,0 +1,395 @@
+""" Vectorized ecoregion rasterization.
+
+    Burns the integer ecoregion IDs (ECO_ID) of the RESOLVE polygons onto the forest grid window by window, with the
+    CELL_CENTER semantics of PolygonToRaster: a cell gets the ID of the polygon that contains its centre. Because the
+    values are the ecoregion IDs themselves, a zone ID (ecoregion * ZONE_CLASS_SLOTS + forest class) decodes to its
+    ecoregion and forest class with decode_zones(), without a raster attribute table.
+
+    The result is persisted as a .npy file (memory-mapped when it is read again) with a .json sidecar holding the grid,
+    the ID -> name and biome lookup, the extent (rows and columns) of each ecoregion and a checksum of the polygons of
+    each ecoregion. An EcoregionGrid reads like a single band rasterio dataset, so the .npy path can be used wherever
+    the pipeline takes the ecoregions raster.
+
+    When the polygons change (e.g. corrected boundaries of one ecoregion), the checksums tell which ecoregions changed,
+    and only the windows covering their old extents and new polygons are burned again. The same checksums let an
+    incremental run (see incremental.py) locate the cells that changed without reading the grid.
+"""
+
+import functools
+import hashlib
+import json
+import os
+
+import numpy as np
+import rasterio
+from affine import Affine
+from rasterio import features, windows
+from rasterio.crs import CRS
+
+from .blocks import DEFAULT_BLOCK_SIZE, iter_windows, read_aligned, read_indexed, window_indices
+from .cache import fingerprint
+from .kernels import combine_zones, decode_zones, reclassify_forest
+from .scheduler import TileScheduler
+
+ECOREGION_NODATA = -1
+
+
+def _split_feature_class(path):
+
+    """ (dataset, layer) of a feature class path: a feature class in a file geodatabase is the .gdb and its name. """
+
+    parent = os.path.dirname(path)
+    if parent.lower().endswith(".gdb"):
+        return parent, os.path.basename(path)
+    return path, None
+
+
+def sidecar_path(path):
+    return os.path.splitext(path)[0] + ".json"
+
+
+def read_ecoregion_table(polygons, id_field="ECO_ID", name_field="ECO_NAME", biome_field="BIOME_NAME"):
+
+    """ {ecoregion ID: {"name": ..., "biome": ...}} from the attributes of the ecoregion polygons. """
+
+    import fiona
+
+    dataset, layer = _split_feature_class(polygons)
+    table = {}
+    with fiona.open(dataset, layer=layer, ignore_geometry=True) as src:
+        for feature in src:
+            properties = feature.properties
+            table[int(properties[id_field])] = {"name": properties.get(name_field),
+                                                "biome": properties.get(biome_field)}
+    return table
+
+
+class _EcoregionPolygons:
+
+    """ Ecoregion polygons (in the CRS of the grid) with their IDs and bounding boxes. """
+
+    def __init__(self, polygons, id_field, crs_wkt):
+        import fiona
+        from fiona.transform import transform_geom
+
+        dataset, layer = _split_feature_class(polygons)
+        self.geometries, self.ids, bounds = [], [], []
+        with fiona.open(dataset, layer=layer) as src:
+            reproject = bool(crs_wkt and src.crs_wkt) and CRS.from_wkt(src.crs_wkt) != CRS.from_wkt(crs_wkt)
+            for feature in src:
+                if feature.geometry is None:
+                    continue
+                geometry = feature.geometry
+                if reproject:
+                    geometry = transform_geom(src.crs_wkt, crs_wkt, geometry)
+                self.geometries.append(geometry)
+                self.ids.append(int(feature.properties[id_field]))
+                bounds.append(features.bounds(geometry))
+        self.bounds = np.array(bounds, dtype=np.float64).reshape(-1, 4)
+
+
+def _geometry_checksums(polygons):
+
+    """ {ecoregion ID (str): checksum of its geometries} of an _EcoregionPolygons. """
+
+    digests = {}
+    for eco_id, geometry in zip(polygons.ids, polygons.geometries):
+        geometry = getattr(geometry, "__geo_interface__", geometry)
+        digest = digests.setdefault(str(eco_id), hashlib.blake2b(digest_size=16))
+        digest.update(json.dumps(geometry, sort_keys=True).encode())
+    return {eco_id: digest.hexdigest() for eco_id, digest in sorted(digests.items())}
+
+
+def _changed_ids(old_checksums, new_checksums):
+
+    """ IDs (str) of the ecoregions whose polygons changed, appeared or disappeared. """
+
+    return sorted(eco_id for eco_id in set(old_checksums) | set(new_checksums)
+                  if old_checksums.get(eco_id) != new_checksums.get(eco_id))
+
+
+def _cell_extent(bounds, transform, width, height):
+
+    """ [row_start, col_start, row_stop, col_stop] of the grid cells overlapped by (left, bottom, right, top). """
+
+    left, bottom, right, top = bounds
+    cols, rows = zip(*[~transform * (x, y) for x, y in ((left, top), (right, bottom))])
+    row_start, row_stop = max(int(np.floor(min(rows))), 0), min(int(np.ceil(max(rows))), height)
+    col_start, col_stop = max(int(np.floor(min(cols))), 0), min(int(np.ceil(max(cols))), width)
+    return [row_start, col_start, max(row_stop, row_start), max(col_stop, col_start)]
+
+
+def _rasterize_tile(transform, dtype, polygons, window):
+
+    """ Ecoregion IDs of one window. Only the polygons whose bounding boxes overlap the window are burned. """
+
+    left, bottom, right, top = windows.bounds(window, transform)
+    overlap = ((polygons.bounds[:, 0] <= right) & (polygons.bounds[:, 2] >= left) &
+               (polygons.bounds[:, 1] <= top) & (polygons.bounds[:, 3] >= bottom))
+    shape = (int(window.height), int(window.width))
+    if not overlap.any():
+        return np.full(shape, ECOREGION_NODATA, dtype=dtype)
+    shapes = [(polygons.geometries[i], polygons.ids[i]) for i in np.flatnonzero(overlap)]
+    return features.rasterize(shapes, out_shape=shape, transform=windows.transform(window, transform),
+                              fill=ECOREGION_NODATA, all_touched=False, dtype=dtype)
+
+
+def _update_extents(extents, tile, window, nodata=ECOREGION_NODATA):
+
+    """ Grows the [row_start, col_start, row_stop, col_stop] extent of each ecoregion ID of tile (at window). """
+
+    present_ids = np.flatnonzero(np.bincount((tile.ravel().astype(np.int64) - nodata)))
+    for eco_id in present_ids[present_ids > 0] + nodata:
+        present = tile == eco_id
+        rows = np.flatnonzero(present.any(axis=1)) + int(window.row_off)
+        cols = np.flatnonzero(present.any(axis=0)) + int(window.col_off)
+        extent = [int(rows[0]), int(cols[0]), int(rows[-1]) + 1, int(cols[-1]) + 1]
+        old = extents.get(int(eco_id))
+        if old is not None:
+            extent = [min(old[0], extent[0]), min(old[1], extent[1]), max(old[2], extent[2]), max(old[3], extent[3])]
+        extents[int(eco_id)] = extent
+
+
+def _write_sidecar(path, sidecar):
+    with open(sidecar_path(path) + ".tmp", "w") as f:
+        json.dump(sidecar, f, indent=1)
+    os.replace(sidecar_path(path) + ".tmp", sidecar_path(path))
+
+
+def _previous_sidecar(output, source, dtype):
+
+    """ Sidecar of the grid at output if it can be updated for other polygons: rasterized onto the same grid, with
+        the same ID field and data type and with the checksums of its polygons. None otherwise.
+    """
+
+    if not (os.path.exists(output) and os.path.exists(sidecar_path(output))):
+        return None
+    with open(sidecar_path(output)) as f:
+        sidecar = json.load(f)
+    old_source = sidecar.get("source", {})
+    if old_source.get("like") != source["like"] or old_source.get("id_field") != source["id_field"]:
+        return None
+    if "checksums" not in sidecar or "extents" not in sidecar:
+        return None
+    if np.load(output, mmap_mode="r").dtype != dtype:
+        return None
+    return sidecar
+
+
+def rasterize_ecoregions(polygons, like, output, id_field="ECO_ID", name_field="ECO_NAME", biome_field="BIOME_NAME",
+                         block_size=DEFAULT_BLOCK_SIZE, workers=1):
+
+    """ Burns the ecoregion IDs of polygons onto the grid of the raster like and saves them to output (.npy) with a
+        .json sidecar. If output already holds the same polygons on the same grid, it is reused as it is; if it holds
+        other polygons on the same grid, only the windows of the ecoregions whose polygons changed are burned again.
+        Returns the EcoregionGrid.
+    """
+
+    source = {"polygons": fingerprint(polygons), "like": fingerprint(like), "id_field": id_field}
+    source = json.loads(json.dumps(source))
+    if os.path.exists(output) and os.path.exists(sidecar_path(output)):
+        with open(sidecar_path(output)) as f:
+            if json.load(f).get("source") == source:
+                print(" -> Using the persisted ecoregion grid {}".format(output))
+                return EcoregionGrid(output)
+
+    table = read_ecoregion_table(polygons, id_field, name_field, biome_field)
+    dtype = np.dtype(np.int16 if not table or max(table) <= np.iinfo(np.int16).max else np.int32)
+    with rasterio.open(like) as like_src:
+        width, height, transform, crs = like_src.width, like_src.height, like_src.transform, like_src.crs
+    setup_args = (polygons, id_field, crs.to_wkt() if crs else None)
+    grid_polygons = _EcoregionPolygons(*setup_args)
+    checksums = _geometry_checksums(grid_polygons)
+    grid_windows = list(iter_windows(width, height, block_size))
+
+    previous = _previous_sidecar(output, source, dtype)
+    if previous is not None:
+        changed = _changed_ids(previous["checksums"], checksums)
+        footprints = [previous["extents"][eco_id] for eco_id in changed if eco_id in previous["extents"]]
+        footprints += [_cell_extent(bounds, transform, width, height)
+                       for eco_id, bounds in zip(grid_polygons.ids, grid_polygons.bounds) if str(eco_id) in changed]
+        grid_windows = [window for window in grid_windows if any(
+            extent[0] < window.row_off + window.height and window.row_off < extent[2] and
+            extent[1] < window.col_off + window.width and window.col_off < extent[3] for extent in footprints)]
+        print(" -> Rasterizing the {} ecoregion(s) whose polygons changed: {} window(s)...".format(
+            len(changed), len(grid_windows)))
+        extents = {int(eco_id): extent for eco_id, extent in previous["extents"].items() if eco_id not in changed}
+    else:
+        print(" -> Rasterizing {} ecoregions ({}) window by window...".format(len(table), id_field))
+        extents = {}
+    del grid_polygons
+
+    # The sidecar is removed first and written last, so an interrupted run leaves no usable grid.
+    if os.path.exists(sidecar_path(output)):
+        os.remove(sidecar_path(output))
+    if previous is not None:
+        ids = np.load(output, mmap_mode="r+")
+    else:
+        ids = np.lib.format.open_memmap(output, mode="w+", dtype=dtype, shape=(height, width))
+    task = functools.partial(_rasterize_tile, transform, dtype)
+    for window, tile in zip(grid_windows, TileScheduler(workers).map(_EcoregionPolygons, setup_args, task,
+                                                                      grid_windows)):
+        ids[window.toslices()] = tile
+        _update_extents(extents, tile, window)
+    ids.flush()
+    del ids
+
+    _write_sidecar(output, {
+        "transform": list(transform)[:6],
+        "crs": crs.to_wkt() if crs else None,
+        "nodata": ECOREGION_NODATA,
+        "id_field": id_field,
+        "source": source,
+        "ecoregions": {str(eco_id): row for eco_id, row in sorted(table.items())},
+        "extents": {str(eco_id): extent for eco_id, extent in sorted(extents.items())},
+        "checksums": checksums,
+    })
+    return EcoregionGrid(output)
+
+
+def ecoregion_extents(path, block_size=DEFAULT_BLOCK_SIZE):
+
+    """ {ecoregion ID: (row_start, col_start, row_stop, col_stop)} of the cells of each ecoregion of a persisted grid.
+        A grid rasterized before the extents were recorded is scanned once, and its extents added to the sidecar.
+    """
+
+    with open(sidecar_path(path)) as f:
+        sidecar = json.load(f)
+    if "extents" not in sidecar:
+        print(" -> Recording the extent of each ecoregion of {}...".format(path))
+        ids = np.load(path, mmap_mode="r")
+        extents = {}
+        for window in iter_windows(ids.shape[1], ids.shape[0], block_size):
+            _update_extents(extents, np.asarray(ids[window.toslices()]), window, sidecar["nodata"])
+        sidecar["extents"] = {str(eco_id): extent for eco_id, extent in sorted(extents.items())}
+        _write_sidecar(path, sidecar)
+    return {int(eco_id): tuple(extent) for eco_id, extent in sidecar["extents"].items()}
+
+
+def ecoregion_state(path):
+
+    """ {"transform", "extents", "checksums"} of a persisted grid (see rasterize_ecoregions): enough to tell later
+        which of its cells another version of the polygons can change (see changed_bounds). None if path isn't a
+        persisted grid, or one rasterized before the checksums of its polygons were recorded.
+    """
+
+    if not path.lower().endswith(".npy") or not os.path.exists(sidecar_path(path)):
+        return None
+    with open(sidecar_path(path)) as f:
+        sidecar = json.load(f)
+    if "checksums" not in sidecar or "extents" not in sidecar:
+        return None
+    return {"transform": sidecar["transform"], "extents": sidecar["extents"], "checksums": sidecar["checksums"]}
+
+
+def changed_bounds(old, new):
+
+    """ (left, bottom, right, top) of the old and new extents of each ecoregion whose polygons changed between two
+        ecoregion_state()s of a grid; outside of them the grid is the same. None if either state is missing or they
+        are on different grids.
+    """
+
+    if old is None or new is None or old["transform"] != new["transform"]:
+        return None
+    transform = Affine(*new["transform"])
+    bounds = []
+    for eco_id in _changed_ids(old["checksums"], new["checksums"]):
+        for state in (old, new):
+            if eco_id in state["extents"]:
+                row_start, col_start, row_stop, col_stop = state["extents"][eco_id]
+                bounds.append(windows.bounds(windows.Window(col_start, row_start, col_stop - col_start,
+                                                            row_stop - row_start), transform))
+    return bounds
+
+
+class EcoregionGrid:
+
+    """ Persisted ecoregion IDs (see rasterize_ecoregions), memory-mapped. ecoregions maps each ID to its name and
+        biome. Has the parts of a single band rasterio dataset the engine reads (read, width, height, transform, ...).
+    """
+
+    def __init__(self, path):
+        with open(sidecar_path(path)) as f:
+            sidecar = json.load(f)
+        self.name = path
+        self.ids = np.load(path, mmap_mode="r")
+        self.height, self.width = self.ids.shape
+        self.count = 1
+        self.dtypes = (self.ids.dtype.name,)
+        self.transform = Affine(*sidecar["transform"])
+        self.crs = CRS.from_wkt(sidecar["crs"]) if sidecar["crs"] else None
+        self.nodata = sidecar["nodata"]
+        self.ecoregions = {int(eco_id): row for eco_id, row in sidecar["ecoregions"].items()}
+
+    def read(self, band=1, window=None, masked=False):
+        data = np.array(self.ids[window.toslices()] if window is not None else self.ids)
+        return np.ma.masked_array(data, mask=data == self.nodata) if masked else data
+
+    def names(self, eco_ids):
+
+        """ Ecoregion name of each ID (None for unknown IDs). """
+
+        return [self.ecoregions.get(int(eco_id), {}).get("name") for eco_id in eco_ids]
+
+    def close(self):
+        self.ids = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+def open_ecoregions(path):
+
+    """ Opens the ecoregions input of the pipeline: a persisted EcoregionGrid (.npy) or any raster. """
+
+    if path.lower().endswith(".npy"):
+        return EcoregionGrid(path)
+    return rasterio.open(path)
+
+
+def zone_parity(combine_zones_raster, combine_lookup, ecoregions, forest, block_size=DEFAULT_BLOCK_SIZE):
+
+    """ Compares the zones of the engine (ecoregion grid + reclassified forest) with the output of the arcpy Combine
+        of the ECO_NAME raster and the reclassified forest. combine_lookup maps each Combine value to its (ecoregion
+        name, forest class), from the Combine and PolygonToRaster attribute tables. Returns the number of cells that
+        are zones in both, that decode to a different ecoregion or class, and that are zones in only one of them.
+    """
+
+    combine_values = np.array(sorted(combine_lookup), dtype=np.int64)
+    name_codes = {}
+    combine_names = np.array([name_codes.setdefault(combine_lookup[value][0], len(name_codes))
+                              for value in combine_values], dtype=np.int64)
+    combine_classes = np.array([combine_lookup[value][1] for value in combine_values], dtype=np.int64)
+
+    counts = {"cells": 0, "mismatched": 0, "only_combine": 0, "only_engine": 0}
+    with rasterio.open(forest) as forest_src, rasterio.open(combine_zones_raster) as combine_src, \
+            EcoregionGrid(ecoregions) as grid:
+
+        eco_ids = np.array(sorted(grid.ecoregions), dtype=np.int64)
+        eco_names = np.array([name_codes.setdefault(grid.ecoregions[eco_id]["name"], len(name_codes))
+                              for eco_id in eco_ids], dtype=np.int64)
+
+        for window in iter_windows(forest_src.width, forest_src.height, block_size):
+            forest_block, forest_valid = read_indexed(forest_src, *window_indices(window))
+            classes = reclassify_forest(forest_block, forest_valid)
+            eco_block, eco_valid = read_aligned(grid, forest_src.transform, window)
+            zones, zones_valid = combine_zones(eco_block, eco_valid, classes, forest_valid)
+            combine_block, combine_valid = read_aligned(combine_src, forest_src.transform, window)
+
+            combine_index = np.clip(np.searchsorted(combine_values, combine_block), 0, combine_values.size - 1)
+            combine_valid &= combine_values[combine_index] == combine_block
+            zone_eco_ids, zone_classes = decode_zones(zones)
+            eco_index = np.clip(np.searchsorted(eco_ids, zone_eco_ids), 0, eco_ids.size - 1)
+            zones_valid &= eco_ids[eco_index] == zone_eco_ids
+
+            both = zones_valid & combine_valid
+            differ = ((eco_names[eco_index] != combine_names[combine_index]) |
+                      (zone_classes != combine_classes[combine_index]))
+            counts["cells"] += int(both.sum())
+            counts["mismatched"] += int((both & differ).sum())
+            counts["only_combine"] += int((combine_valid & ~zones_valid).sum())
+            counts["only_engine"] += int((zones_valid & ~combine_valid).sum())
+    return counts
@@ -0,0 +1,225 @@
+""" Biome and ecoregion filter of the final output (filter_output).
+
+    Replaces the projection of the carbon to a 1 ha equal area grid, the zonal SUM per ecoregion of interest, the
+    MEDIAN statistics table, the Union of the selected polygons and ExtractByMask. The total forest carbon (Mg C) of
+    each ecoregion is summed on the native grid: the carbon density of each cell (Mg C/ha) is weighted by the area of
+    the cell in ha, which on a geographic grid only depends on its row (the area of the ellipsoid between the latitudes
+    of its edges). The ecoregions to keep become a lookup table over the ecoregion IDs, and the mask is that lookup
+    applied to the ecoregion ID of each cell as the output windows are written.
+"""
+
+import csv
+
+import numpy as np
+import rasterio
+
+from . import profiling
+from .blocks import DEFAULT_BLOCK_SIZE, iter_windows, read_aligned
+from .cog import CogWriter
+from .ecoregions import open_ecoregions
+
+# WGS84 ellipsoid (the datum of the forest, carbon and ecoregion data).
+_SEMI_MAJOR_AXIS = 6378137.0
+_FLATTENING = 1 / 298.257223563
+
+_SQUARE_METRES_PER_HA = 10000.0
+
+
+def _authalic_q(latitudes):
+
+    """ q(latitude) of the authalic latitude formulas: the area of the ellipsoid between the equator and a latitude
+        over a longitude range dl (radians) is b^2 * dl * q / 2.
+    """
+
+    e = np.sqrt(_FLATTENING * (2 - _FLATTENING))
+    sin = np.sin(np.radians(latitudes))
+    return sin / (1 - (e * sin) ** 2) + np.log((1 + e * sin) / (1 - e * sin)) / (2 * e)
+
+
+def row_areas_ha(transform, crs, row_off, height):
+
+    """ Area in ha of the cells of rows row_off..row_off + height of a north-up grid. On a geographic grid the area is
+        that of the WGS84 ellipsoid between the latitudes of the top and bottom edge of each row, on a projected
+        (equal area) grid it's the same for every row.
+    """
+
+    if crs is None or not crs.is_geographic:
+        metres = crs.linear_units_factor[1] if crs is not None else 1.0
+        return np.full(height, abs(transform.a * transform.e) * metres ** 2 / _SQUARE_METRES_PER_HA)
+
+    edges = np.clip(transform.f + transform.e * np.arange(row_off, row_off + height + 1, dtype=np.float64), -90, 90)
+    q = _authalic_q(edges)
+    semi_minor_axis = _SEMI_MAJOR_AXIS * (1 - _FLATTENING)
+    areas = semi_minor_axis ** 2 * abs(np.radians(transform.a)) * np.abs(np.diff(q)) / 2
+    return areas / _SQUARE_METRES_PER_HA
+
+
+class EcoregionCarbon:
+
+    """ Total carbon (Mg C) and number of cells with carbon of each ecoregion, indexed by ecoregion ID. """
+
+    def __init__(self):
+        self.totals = np.zeros(0, dtype=np.float64)
+        self.cells = np.zeros(0, dtype=np.int64)
+
+    def save(self, path):
+
+        """ Saves the totals to a compressed .npz file. """
+
+        np.savez_compressed(path, totals=self.totals, cells=self.cells)
+
+    @classmethod
+    def load(cls, path):
+
+        """ Loads totals saved with save(). """
+
+        totals = cls()
+        with np.load(path) as data:
+            totals.totals, totals.cells = data["totals"], data["cells"]
+        return totals
+
+    def _extend(self, size):
+        if size > self.totals.size:
+            self.totals = np.concatenate([self.totals, np.zeros(size - self.totals.size)])
+            self.cells = np.concatenate([self.cells, np.zeros(size - self.cells.size, dtype=np.int64)])
+
+    def update(self, eco_ids, carbon, areas_ha):
+
+        """ Adds carbon density (Mg C/ha) times cell area (ha) of cells with the given (non-negative) ecoregion IDs. """
+
+        if not eco_ids.size:
+            return
+        eco_ids = eco_ids.astype(np.int64)
+        size = int(eco_ids.max()) + 1
+        self._extend(size)
+        self.totals[:size] += np.bincount(eco_ids, weights=carbon.astype(np.float64) * areas_ha, minlength=size)
+        self.cells[:size] += np.bincount(eco_ids, minlength=size)
+
+    def merge(self, other):
+
+        """ Adds the totals of another EcoregionCarbon (e.g. of another window) to these. """
+
+        self._extend(other.totals.size)
+        self.totals[:other.totals.size] += other.totals
+        self.cells[:other.cells.size] += other.cells
+
+    def update_block(self, eco_ids, eco_valid, carbon, carbon_valid, transform, crs, window):
+
+        """ Adds the carbon of one window of a grid, given the ecoregion IDs of its cells. """
+
+        valid = eco_valid & carbon_valid & (eco_ids >= 0)
+        rows = np.nonzero(valid)[0]
+        areas = row_areas_ha(transform, crs, int(window.row_off), int(window.height))
+        self.update(eco_ids[valid], carbon[valid], areas[rows])
+
+
+def read_ecoregions_of_interest(path):
+
+    """ Ecoregion names (ECO_NAME) in the first column of a CSV, like the candidate list of filter_output. """
+
+    with open(path, newline="") as f:
+        return [row[0] for row in csv.reader(f) if row]
+
+
+class EcoregionFilter:
+
+    """ Ecoregions to keep in the filtered output: those of the biomes to include, plus the ecoregions of interest
+        whose total forest carbon is above the median total of the ecoregions of interest (only those that hold any
+        carbon count, like the zonal statistics table the median was taken from).
+    """
+
+    def __init__(self, biomes=(), ecoregions_of_interest=()):
+        self.biomes = set(biomes)
+        self.ecoregions_of_interest = set(ecoregions_of_interest)
+
+    def lookup(self, ecoregions, carbon):
+
+        """ Boolean lookup table over the ecoregion IDs (True = keep). ecoregions is the ID -> {"name", "biome"} table
+            of an EcoregionGrid, carbon the EcoregionCarbon of the forest carbon.
+        """
+
+        size = max(max(ecoregions, default=0) + 1, carbon.totals.size)
+        keep = np.zeros(size, dtype=bool)
+        totals = {}
+        for eco_id, row in ecoregions.items():
+            if row["biome"] in self.biomes:
+                keep[eco_id] = True
+            if row["name"] in self.ecoregions_of_interest and eco_id < carbon.cells.size and carbon.cells[eco_id]:
+                totals[row["name"]] = totals.get(row["name"], 0.0) + carbon.totals[eco_id]
+
+        missing = self.ecoregions_of_interest - set(row["name"] for row in ecoregions.values())
+        if missing:
+            print(" -> Ecoregions of interest not in the ecoregion table: {}".format(sorted(missing)))
+
+        selected = set()
+        if totals:
+            median = float(np.median(list(totals.values())))
+            selected = set(name for name, total in totals.items() if total > median)
+            print(" -> Median total forest carbon of {} ecoregions of interest: {:.6g} Mg C ({} above it)".format(
+                len(totals), median, len(selected)))
+        for eco_id, row in ecoregions.items():
+            if row["name"] in selected:
+                keep[eco_id] = True
+        print(" -> Keeping {} of {} ecoregions".format(int(keep.sum()), len(ecoregions)))
+        return keep
+
+
+def apply_lookup(keep, eco_ids, eco_valid):
+
+    """ Cells whose ecoregion ID is kept by the lookup table keep (see EcoregionFilter.lookup). """
+
+    in_table = eco_valid & (eco_ids >= 0) & (eco_ids < keep.size)
+    return in_table & keep[np.where(in_table, eco_ids, 0)]
+
+
+def ecoregion_table(ecoregions):
+
+    """ ID -> {"name", "biome"} table of a persisted ecoregion grid. A rasterized ecoregions raster has no table, so it
+        can't be filtered.
+    """
+
+    with open_ecoregions(ecoregions) as eco_src:
+        table = getattr(eco_src, "ecoregions", None)
+    if table is None:
+        raise ValueError("filtering needs a persisted ecoregion grid (.npy, see rasterize_ecoregions), got {}".format(
+            ecoregions))
+    return table
+
+
+def ecoregion_carbon(carbon, ecoregions, block_size=DEFAULT_BLOCK_SIZE):
+
+    """ EcoregionCarbon of a carbon density raster (e.g. carbon_in_each_forest_cell), in one pass over its grid. """
+
+    totals = EcoregionCarbon()
+    with rasterio.open(carbon) as carbon_src, open_ecoregions(ecoregions) as eco_src:
+        for window in iter_windows(carbon_src.width, carbon_src.height, block_size):
+            profiling.count_tiles()
+            block = carbon_src.read(1, window=window, masked=True)
+            eco_ids, eco_valid = read_aligned(eco_src, carbon_src.transform, window)
+            totals.update_block(eco_ids, eco_valid, np.ma.getdata(block), ~np.ma.getmaskarray(block),
+                                carbon_src.transform, carbon_src.crs, window)
+    return totals
+
+
+def filter_output(final_output, carbon_in_each_forest_cell, ecoregions, ecoregion_filter, output,
+                  block_size=DEFAULT_BLOCK_SIZE):
+
+    """ Writes the cells of final_output in the ecoregions kept by ecoregion_filter to output (a COG with the data
+        type of final_output). ecoregions is a persisted ecoregion grid (.npy, see rasterize_ecoregions); the totals
+        are those of carbon_in_each_forest_cell. One pass over each raster.
+    """
+
+    table = ecoregion_table(ecoregions)
+    print(" -> Summing the forest carbon of each ecoregion...")
+    with profiling.step("ecoregion_totals"):
+        totals = ecoregion_carbon(carbon_in_each_forest_cell, ecoregions, block_size)
+    keep = ecoregion_filter.lookup(table, totals)
+
+    print(" -> Writing the filtered output...")
+    with profiling.step("filtered_output"), rasterio.open(final_output) as src, open_ecoregions(ecoregions) as eco_src:
+        with CogWriter(output, src, src.dtypes[0], src.nodata, window_size=block_size) as dst:
+            for window in iter_windows(src.width, src.height, block_size):
+                profiling.count_tiles()
+                block = src.read(1, window=window, masked=True)
+                kept = apply_lookup(keep, *read_aligned(eco_src, src.transform, window))
+                dst.write(np.ma.getdata(block), window, ~np.ma.getmaskarray(block) & kept)
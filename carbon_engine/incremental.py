@@ -0,0 +1,417 @@
+""" Incremental recompute of the fused pipeline.
+
+    A run records a manifest next to its outputs: a checksum of every input in each window of the forest grid, the
+    per-zone histograms of each window and the zones found in each window. When an input changes (e.g. corrected
+    ecoregion boundaries or a reprocessed regional carbon tile), only the windows whose checksums differ are read in
+    full. Their old histograms are subtracted from the global ones and their new histograms added, the thresholds are
+    recomputed, and only the windows that changed or that hold a zone whose threshold changed are rewritten.
+
+    Only the inputs whose files changed are checksummed, and only in the windows of the edited area: a bounds hint, or
+    for an edit of the ecoregion grid alone, the extents of the ecoregions whose polygons changed (from the polygon
+    checksums of the grid, recorded in the manifest). A single-ecoregion edit then costs in proportion to the
+    footprint of that ecoregion, from rasterizing it (see rasterize_ecoregions) to rewriting the outputs.
+
+    The outputs are COGs like those of run_sweep. Their parts (full resolution and overview levels, see CogWriter) are
+    kept in the manifest directory, the rewritten windows are updated in them, and the COGs are assembled again from
+    them: that copy reads and writes the whole of each (compressed) output, the only cost of an update that grows with
+    the grid rather than with the edit.
+"""
+
+import functools
+import hashlib
+import json
+import os
+
+import numpy as np
+import rasterio
+from rasterio.windows import Window, bounds as window_bounds
+
+from . import profiling
+from .blocks import DEFAULT_BLOCK_SIZE, default_nodata, iter_windows
+from .cache import fingerprint
+from .cog import CogWriter
+from .ecoregions import changed_bounds, ecoregion_state
+from .kernels import FOREST_REMAP, ZONE_CLASS_SLOTS
+from .pipeline import (_HistogramSet, _Inputs, _accumulate_tile, _output_dtype, _threshold_tile, save_zone_stats,
+                       zone_thresholds)
+from .scheduler import DEFAULT_READ_AHEAD, TileScheduler
+from .zonal import ZonalHistogram
+
+_MANIFEST = "manifest.json"
+_CHECKSUMS = "checksums.npz"
+_TILE_ZONES = "tile_zones.npz"
+_DIGEST_SIZE = 16
+
+
+def _source_window(src, bounds, pad):
+
+    """ Window of src covering bounds (left, bottom, right, top) plus pad on each side, or None if they don't overlap.
+    """
+
+    left, bottom, right, top = bounds
+    transform = src.transform
+    cols = sorted([(left - pad - transform.c) / transform.a, (right + pad - transform.c) / transform.a])
+    rows = sorted([(top + pad - transform.f) / transform.e, (bottom - pad - transform.f) / transform.e])
+    col_off, col_end = max(int(np.floor(cols[0])), 0), min(int(np.ceil(cols[1])), src.width)
+    row_off, row_end = max(int(np.floor(rows[0])), 0), min(int(np.ceil(rows[1])), src.height)
+    if col_off >= col_end or row_off >= row_end:
+        return None
+    return Window(col_off, row_off, col_end - col_off, row_end - row_off)
+
+
+def _intersects(a, b):
+    return a[0] < b[2] and b[0] < a[2] and a[1] < b[3] and b[1] < a[3]
+
+
+def _input_sources(inputs):
+
+    """ Open dataset of each input, by the name it has in the manifest. """
+
+    sources = {"forest": inputs.forest, "ecoregions": inputs.ecoregions}
+    for carbon_srcs in inputs.carbon.values():
+        for src in carbon_srcs:
+            sources[src.name] = src
+    return sources
+
+
+def _checksum_tile(names, pad, inputs, window):
+
+    """ Checksum of the cells of each named input that can affect a window of the forest grid. pad (at least the
+        largest cell size of the inputs) covers the cells sampled across the window edges.
+    """
+
+    sources = _input_sources(inputs)
+    bounds = window_bounds(window, inputs.forest.transform)
+    checksums = np.zeros((len(names), _DIGEST_SIZE), dtype=np.uint8)
+    for i, name in enumerate(names):
+        digest = hashlib.blake2b(digest_size=_DIGEST_SIZE)
+        src_window = _source_window(sources[name], bounds, pad)
+        if src_window is not None:
+            block = sources[name].read(1, window=src_window, masked=True)
+            digest.update(np.ma.getdata(block).tobytes())
+            digest.update(np.ma.getmaskarray(block).tobytes())
+        checksums[i] = np.frombuffer(digest.digest(), dtype=np.uint8)
+    return checksums
+
+
+def _tile_state(names, pad, inputs, window):
+
+    """ Checksums and per-zone histograms of one window. """
+
+    return _checksum_tile(names, pad, inputs, window), _accumulate_tile(inputs, window)
+
+
+def _tile_path(manifest_dir, index, carbon_type, pending=False):
+    return os.path.join(manifest_dir, "tiles", "{}_{}{}.npz".format(index, carbon_type, ".pending" if pending else ""))
+
+
+def _tile_zones(histograms):
+
+    """ Zones with carbon in a window, over all carbon types. """
+
+    zone_ids = [histogram.zone_ids[histogram.counts.sum(axis=1) > 0] for histogram in histograms.values()]
+    return np.unique(np.concatenate(zone_ids)) if zone_ids else np.empty(0, dtype=np.int64)
+
+
+def _changed_zones(old, new):
+
+    """ Zones whose threshold appeared, disappeared or changed between two (zone_ids, thresholds). """
+
+    (old_ids, old_values), (new_ids, new_values) = old, new
+    common, old_index, new_index = np.intersect1d(old_ids, new_ids, assume_unique=True, return_indices=True)
+    return np.union1d(np.setxor1d(old_ids, new_ids), common[old_values[old_index] != new_values[new_index]])
+
+
+def _output_parts(manifest_dir, index):
+    return os.path.join(manifest_dir, "outputs", str(index))
+
+
+def _open_writers(manifest_dir, outputs, dtypes, grid, block_size, resume):
+
+    """ CogWriters of the outputs, with their parts kept in the manifest directory. With resume, the parts of the
+        recorded run are reopened, or None is returned if they are gone.
+    """
+
+    dsts = [CogWriter(output, grid, dtype, nodata, window_size=block_size, resume=resume,
+                      parts_dir=_output_parts(manifest_dir, index))
+            for index, (output, (dtype, nodata)) in enumerate(zip(outputs, dtypes))]
+    if resume and not all(dst.resumed for dst in dsts):
+        for dst in dsts:
+            dst.abort()
+        return None
+    return dsts
+
+
+def _write_tiles(inputs, runs, thresholds, dsts, windows, scheduler):
+
+    """ Pass 2 for the given windows, into the CogWriters dsts. The COGs are then assembled again from their parts,
+        which are kept for the next run (and on failure, for the run that redoes the update).
+    """
+
+    output_nodata = default_nodata(np.float32)
+    task = functools.partial(_threshold_tile, runs, thresholds, None)
+    try:
+        with profiling.step("pass_2"):
+            for window, (tile_outputs, _, _) in zip(windows, scheduler.map(_Inputs, inputs, task, windows)):
+                for dst, values in zip(dsts, tile_outputs):
+                    dst.write(values, window, values != output_nodata)
+    except BaseException:
+        for dst in dsts:
+            dst.suspend()
+        raise
+    with profiling.step("cog"):
+        for dst in dsts:
+            dst.close(keep_parts=True)
+
+
+class _Manifest:
+
+    """ State recorded by a run: signature, input fingerprints, output data types and the ecoregion_state() of the
+        ecoregion grid (manifest.json), per-window input checksums, the zones of each window and the global and
+        per-window histograms of each carbon type. The parts of the outputs are kept next to them (see _write_tiles).
+
+        New per-window histograms are written next to the recorded ones (save_tile) and only replace them in save(),
+        so a run interrupted before save() leaves the recorded state as it was and the next run redoes its update.
+    """
+
+    def __init__(self, manifest_dir, signature, fingerprints, checksums, tile_index, tile_zone_ids,
+                 output_dtypes=None, ecoregions=None):
+        self.manifest_dir = manifest_dir
+        self.signature = signature
+        self.fingerprints = fingerprints
+        self.output_dtypes = output_dtypes
+        self.ecoregions = ecoregions
+        self.checksums = checksums
+        self.tile_index = tile_index
+        self.tile_zone_ids = tile_zone_ids
+        self.pending_tiles = set()
+
+    @classmethod
+    def load(cls, manifest_dir):
+
+        """ The manifest in manifest_dir, or None if there isn't a complete one. """
+
+        if not os.path.exists(os.path.join(manifest_dir, _MANIFEST)):
+            return None
+        with open(os.path.join(manifest_dir, _MANIFEST)) as f:
+            manifest = json.load(f)
+        with np.load(os.path.join(manifest_dir, _CHECKSUMS)) as data:
+            checksums = data["checksums"]
+        with np.load(os.path.join(manifest_dir, _TILE_ZONES)) as data:
+            tile_index, tile_zone_ids = data["tile_index"], data["zone_ids"]
+        return cls(manifest_dir, manifest["signature"], manifest["fingerprints"], checksums, tile_index, tile_zone_ids,
+                   manifest.get("output_dtypes"), manifest.get("ecoregions"))
+
+    def histogram_path(self, carbon_type):
+        return os.path.join(self.manifest_dir, "histograms", "{}.npz".format(carbon_type))
+
+    def load_histograms(self, carbon_types):
+        return _HistogramSet((carbon_type, ZonalHistogram.load(self.histogram_path(carbon_type)))
+                             for carbon_type in carbon_types)
+
+    @staticmethod
+    def invalidate(manifest_dir):
+
+        """ Removes the manifest, e.g. before its per-window histograms are overwritten. """
+
+        manifest_path = os.path.join(manifest_dir, _MANIFEST)
+        if os.path.exists(manifest_path):
+            os.remove(manifest_path)
+
+    def save_tile(self, index, histograms):
+        for carbon_type, histogram in histograms.items():
+            histogram.save(_tile_path(self.manifest_dir, index, carbon_type, pending=True))
+            self.pending_tiles.add((index, carbon_type))
+
+    def load_tile(self, index, carbon_types):
+        return _HistogramSet((carbon_type, ZonalHistogram.load(_tile_path(self.manifest_dir, index, carbon_type)))
+                             for carbon_type in carbon_types)
+
+    def set_tile_zones(self, index, zone_ids):
+        keep = self.tile_index != index
+        self.tile_index = np.concatenate([self.tile_index[keep], np.full(zone_ids.size, index, dtype=np.int64)])
+        self.tile_zone_ids = np.concatenate([self.tile_zone_ids[keep], zone_ids.astype(np.int64)])
+
+    def tiles_with_zones(self, zone_ids):
+        return set(np.unique(self.tile_index[np.isin(self.tile_zone_ids, zone_ids)]).tolist())
+
+    def save(self, histograms):
+
+        """ Writes the per-window (see save_tile) and global histograms and the manifest. manifest.json is removed
+            first and written last, so an interrupted save leaves no manifest (and the next run rebuilds everything).
+        """
+
+        manifest_path = os.path.join(self.manifest_dir, _MANIFEST)
+        self.invalidate(self.manifest_dir)
+        for index, carbon_type in sorted(self.pending_tiles):
+            os.replace(_tile_path(self.manifest_dir, index, carbon_type, pending=True),
+                       _tile_path(self.manifest_dir, index, carbon_type))
+        self.pending_tiles.clear()
+        for carbon_type, histogram in histograms.items():
+            histogram.save(self.histogram_path(carbon_type))
+        np.savez(os.path.join(self.manifest_dir, _CHECKSUMS), checksums=self.checksums)
+        np.savez(os.path.join(self.manifest_dir, _TILE_ZONES), tile_index=self.tile_index, zone_ids=self.tile_zone_ids)
+        with open(manifest_path + ".tmp", "w") as f:
+            json.dump({"signature": self.signature, "fingerprints": self.fingerprints,
+                       "output_dtypes": self.output_dtypes, "ecoregions": self.ecoregions}, f, indent=1)
+        os.replace(manifest_path + ".tmp", manifest_path)
+
+
+def _dtype_record(output_dtypes):
+    return json.loads(json.dumps([[np.dtype(dtype).name, nodata] for dtype, nodata in output_dtypes]))
+
+
+def _edited_windows(windows, transform, pad, edited):
+
+    """ Indices of the windows that touch any of the edited (left, bottom, right, top) areas (plus pad). """
+
+    edited = [(left - pad, bottom - pad, right + pad, top + pad) for left, bottom, right, top in edited]
+    return [index for index, window in enumerate(windows)
+            if any(_intersects(window_bounds(window, transform), area) for area in edited)]
+
+
+def run_incremental(forest, carbon_sources, ecoregions, runs, outputs, manifest_dir, bounds=None,
+                    block_size=DEFAULT_BLOCK_SIZE, workers=1, read_ahead=DEFAULT_READ_AHEAD, zone_stats=None):
+
+    """ Runs steps 1-7 like run_sweep, recomputing only what changed since the run recorded in manifest_dir.
+
+        The first run (or one with other runs, outputs, carbon rasters, grid or block size) computes everything and
+        records the manifest. Later runs compare the inputs with it: only the windows whose cells changed are
+        recomputed, and only those and the windows holding a zone whose threshold changed are rewritten in the
+        outputs (all of them if the data type of an output changes).
+
+        bounds: optional (left, bottom, right, top) in the forest CRS outside of which the inputs are known not to have
+            changed, e.g. the extent of an edited ecoregion. Only the windows it touches are checksummed. Without it,
+            an edit of a persisted ecoregion grid alone (see rasterize_ecoregions) is located from the checksums of its
+            polygons.
+        read_ahead: with one worker, the number of tiles read ahead by threads (see TileScheduler).
+        zone_stats: optional dict of carbon type -> path of the zone statistics store to write (see run_sweep).
+    """
+
+    runs = [tuple(run) for run in runs]
+    carbon_types = sorted(set(carbon_type for carbon_type, percentile in runs))
+    carbon_sources = {carbon_type: [paths] if isinstance(paths, str) else list(paths)
+                      for carbon_type, paths in carbon_sources.items() if carbon_type in carbon_types}
+    inputs = (forest, carbon_sources, ecoregions)
+    scheduler = TileScheduler(workers, read_ahead=read_ahead)
+
+    opened = _Inputs(*inputs)
+    try:
+        names = sorted(_input_sources(opened))
+        pad = max(max(abs(src.transform.a), abs(src.transform.e)) for src in _input_sources(opened).values())
+        transform = opened.forest.transform
+        windows = list(iter_windows(opened.forest.width, opened.forest.height, block_size))
+        signature = {
+            "grid": [opened.forest.width, opened.forest.height, list(transform)[:6]],
+            "block_size": block_size,
+            "carbon_sources": carbon_sources,
+            "runs": runs,
+            "outputs": [os.path.abspath(output) for output in outputs],
+            "forest_remap": FOREST_REMAP,
+            "zone_class_slots": ZONE_CLASS_SLOTS,
+        }
+        signature = json.loads(json.dumps(signature))
+    finally:
+        opened.close()
+    paths = {"forest": forest, "ecoregions": ecoregions}
+    fingerprints = {name: fingerprint(paths.get(name, name)) for name in names}
+    grid_state = ecoregion_state(ecoregions)
+
+    manifest = _Manifest.load(manifest_dir)
+    if manifest is None or manifest.signature != signature or not all(os.path.exists(output) for output in outputs):
+        print(" -> No matching manifest, running every window and recording a new one...")
+        _Manifest.invalidate(manifest_dir)
+        for directory in ("tiles", "histograms"):
+            if not os.path.isdir(os.path.join(manifest_dir, directory)):
+                os.makedirs(os.path.join(manifest_dir, directory))
+        manifest = _Manifest(manifest_dir, signature, fingerprints,
+                             np.zeros((len(windows), len(names), _DIGEST_SIZE), dtype=np.uint8),
+                             np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64))
+
+        print(" -> Pass 1: checksumming windows and accumulating per-zone histograms...")
+        histograms = _HistogramSet()
+        tile_index, tile_zone_ids = [], []
+        task = functools.partial(_tile_state, names, pad)
+        with profiling.step("pass_1"):
+            for index, (checksums, tile_histograms) in enumerate(scheduler.map(_Inputs, inputs, task, windows)):
+                manifest.checksums[index] = checksums
+                manifest.save_tile(index, tile_histograms)
+                tile_zone_ids.append(_tile_zones(tile_histograms))
+                tile_index.append(np.full(tile_zone_ids[-1].size, index, dtype=np.int64))
+                histograms.merge(tile_histograms)
+        manifest.tile_index = np.concatenate(tile_index or [manifest.tile_index])
+        manifest.tile_zone_ids = np.concatenate(tile_zone_ids or [manifest.tile_zone_ids]).astype(np.int64)
+
+        thresholds = [zone_thresholds(histograms[carbon_type], percentile) for carbon_type, percentile in runs]
+        output_dtypes = [_output_dtype(histograms[carbon_type]) for carbon_type, percentile in runs]
+        print(" -> Pass 2: writing {} output(s)...".format(len(runs)))
+        with rasterio.open(forest) as forest_src:
+            dsts = _open_writers(manifest_dir, outputs, output_dtypes, forest_src, block_size, resume=False)
+        _write_tiles(inputs, runs, thresholds, dsts, windows, scheduler)
+        manifest.output_dtypes, manifest.ecoregions = _dtype_record(output_dtypes), grid_state
+        manifest.save(histograms)
+        if zone_stats:
+            save_zone_stats(histograms, zone_stats, forest, carbon_sources, ecoregions)
+        return histograms
+
+    changed_inputs = [name for name in names if manifest.fingerprints.get(name) != fingerprints[name]]
+    histograms = manifest.load_histograms(carbon_types)
+    if not changed_inputs:
+        print(" -> Inputs unchanged since the recorded run, nothing to do.")
+        if zone_stats:
+            save_zone_stats(histograms, zone_stats, forest, carbon_sources, ecoregions)
+        return histograms
+
+    edited = [bounds] if bounds is not None else None
+    if edited is None and changed_inputs == ["ecoregions"]:
+        edited = changed_bounds(manifest.ecoregions, grid_state)
+        if edited is not None:
+            print(" -> Only the ecoregion grid changed, within the extents of its edited ecoregions")
+    candidates = list(range(len(windows))) if edited is None else _edited_windows(windows, transform, pad, edited)
+    print(" -> Checksumming {} of {} windows ({} changed)...".format(
+        len(candidates), len(windows), ", ".join(os.path.basename(name) for name in changed_inputs)))
+    columns = [names.index(name) for name in changed_inputs]
+    task = functools.partial(_checksum_tile, changed_inputs, pad)
+    changed = []
+    with profiling.step("checksums"):
+        for index, checksums in zip(candidates, scheduler.map(_Inputs, inputs, task,
+                                                               [windows[i] for i in candidates])):
+            if not np.array_equal(manifest.checksums[index, columns], checksums):
+                manifest.checksums[index, columns] = checksums
+                changed.append(index)
+
+    old_thresholds = [zone_thresholds(histograms[carbon_type], percentile) for carbon_type, percentile in runs]
+    print(" -> Recomputing the per-zone histograms of {} changed window(s)...".format(len(changed)))
+    results = scheduler.map(_Inputs, inputs, _accumulate_tile, [windows[i] for i in changed])
+    with profiling.step("pass_1"):
+        for index, tile_histograms in zip(changed, results):
+            old_tile_histograms = manifest.load_tile(index, carbon_types)
+            for carbon_type in carbon_types:
+                histograms[carbon_type].subtract(old_tile_histograms[carbon_type])
+            histograms.merge(tile_histograms)
+            manifest.save_tile(index, tile_histograms)
+            manifest.set_tile_zones(index, _tile_zones(tile_histograms))
+
+    thresholds = [zone_thresholds(histograms[carbon_type], percentile) for carbon_type, percentile in runs]
+    changed_zones = np.unique(np.concatenate([_changed_zones(old, new)
+                                              for old, new in zip(old_thresholds, thresholds)]))
+    rewrite = sorted(set(changed) | manifest.tiles_with_zones(changed_zones))
+    output_dtypes = [_output_dtype(histograms[carbon_type]) for carbon_type, percentile in runs]
+    with rasterio.open(forest) as forest_src:
+        dsts = None
+        if manifest.output_dtypes == _dtype_record(output_dtypes):
+            dsts = _open_writers(manifest_dir, outputs, output_dtypes, forest_src, block_size, resume=True)
+        if dsts is None:
+            print(" -> The data type of the outputs changed (or their parts are gone), rewriting every window")
+            dsts = _open_writers(manifest_dir, outputs, output_dtypes, forest_src, block_size, resume=False)
+            rewrite = list(range(len(windows)))
+    print(" -> {} zone threshold(s) changed, rewriting {} of {} windows...".format(
+        changed_zones.size, len(rewrite), len(windows)))
+    _write_tiles(inputs, runs, thresholds, dsts, [windows[i] for i in rewrite], scheduler)
+
+    manifest.fingerprints = fingerprints
+    manifest.output_dtypes, manifest.ecoregions = _dtype_record(output_dtypes), grid_state
+    manifest.save(histograms)
+    if zone_stats:
+        save_zone_stats(histograms, zone_stats, forest, carbon_sources, ecoregions)
+    return histograms
@@ -0,0 +1,84 @@
+""" Per-block kernels for steps 1-7 of the analysis. Each kernel works on the arrays of one window of the forest grid,
+    which is the grid of the zones and of the final output.
+"""
+
+import numpy as np
+
+from .blocks import map_indices, read_indexed, window_indices
+
+# 3. Forest classes specified by Jim Strittholt (FAO structural forms 1-12 -> 1-4).
+FOREST_REMAP = ((1, 1), (2, 1), (3, 1), (4, 2), (5, 2), (6, 2), (7, 3), (8, 3), (9, 3), (10, 4), (11, 4), (12, 4))
+
+# 4. Number of forest class slots in a zone ID (zone = ecoregion * ZONE_CLASS_SLOTS + forest class).
+ZONE_CLASS_SLOTS = 8
+
+_forest_lookup = np.arange(max(old for old, new in FOREST_REMAP) + 1)
+for _old, _new in FOREST_REMAP:
+    _forest_lookup[_old] = _new
+
+
+def read_clipped_carbon(carbon_srcs, forest_src, window, forest_valid, read=read_indexed):
+
+    """ 1-2. Carbon (summed over carbon_srcs on the grid of the first one) clipped to the forest pixels, sampled onto a
+        window of the forest grid. Clipping is done on the carbon grid, like ExtractByMask with the carbon as snap
+        raster, so it matches the ArcGIS result even when the two grids are offset. read(src, rows, cols) can be
+        replaced to share reads between calls; its arrays are not modified.
+    """
+
+    rows, cols = window_indices(window)
+    carbon_rows, carbon_cols = map_indices(forest_src.transform, rows, cols, carbon_srcs[0].transform)
+    data, valid = read(carbon_srcs[0], carbon_rows, carbon_cols)
+
+    for other_src in carbon_srcs[1:]:
+        other_rows, other_cols = map_indices(carbon_srcs[0].transform, carbon_rows, carbon_cols, other_src.transform)
+        other_data, other_valid = read(other_src, other_rows, other_cols)
+        data = data.astype(np.result_type(data.dtype, other_data.dtype, np.int32)) + other_data
+        valid = valid & other_valid
+
+    mask_rows, mask_cols = map_indices(carbon_srcs[0].transform, carbon_rows, carbon_cols, forest_src.transform)
+    if np.array_equal(mask_rows, rows) and np.array_equal(mask_cols, cols):
+        valid = valid & forest_valid
+    else:
+        valid = valid & read(forest_src, mask_rows, mask_cols)[1]
+
+    return data, valid
+
+
+def reclassify_forest(forest, forest_valid):
+
+    """ 3. Applies FOREST_REMAP. Values outside the remap are kept (missing_values="DATA"). """
+
+    classes = forest.astype(np.int64)
+    remapped = forest_valid & (classes >= 0) & (classes < _forest_lookup.size)
+    classes[remapped] = _forest_lookup[classes[remapped]]
+    return classes
+
+
+def combine_zones(ecoregions, ecoregions_valid, forest_classes, forest_valid):
+
+    """ 4. Zone ID of each cell from its ecoregion and forest class. Returns (zones, valid). """
+
+    valid = ecoregions_valid & forest_valid
+    if np.any(forest_classes[valid] >= ZONE_CLASS_SLOTS) or np.any(forest_classes[valid] < 0):
+        raise ValueError("Forest classes must be between 0 and {}.".format(ZONE_CLASS_SLOTS - 1))
+    zones = ecoregions.astype(np.int64) * ZONE_CLASS_SLOTS + forest_classes
+    return zones, valid
+
+
+def decode_zones(zones):
+
+    """ Inverse of combine_zones: (ecoregion IDs, forest classes) of zone IDs. """
+
+    zones = np.asarray(zones, dtype=np.int64)
+    return zones // ZONE_CLASS_SLOTS, zones % ZONE_CLASS_SLOTS
+
+
+def carbon_above_threshold(carbon, carbon_valid, thresholds, thresholds_valid, nodata):
+
+    """ 7. Con(carbon > threshold, carbon) as float32, the type of the per-cell carbon (step 6). """
+
+    out = np.full(carbon.shape, nodata, dtype=np.float32)
+    above = carbon_valid & thresholds_valid
+    above[above] = carbon[above] > thresholds[above]
+    out[above] = carbon[above]
+    return out
@@ -0,0 +1,717 @@
+""" Fused pipeline for steps 1-7.
+
+    Instead of writing a global intermediate raster after every step, the analysis runs as two streaming passes over
+    aligned windows of the forest grid:
+
+    Pass 1 masks the carbon to the forest, reclassifies the forest, combines it with the ecoregions and accumulates the
+    per-zone carbon histograms. Pass 2 computes Con(carbon > threshold, carbon) for each window and writes it straight
+    to the final output, a Cloud Optimized GeoTIFF in the smallest data type that holds the carbon range (known from
+    the pass 1 histograms). The intermediate rasters are only written when a debug directory is given.
+
+    A sweep runs several (carbon type, percentile) combinations at once: the zones are built once, each carbon raster
+    is read once per pass and one histogram is accumulated per carbon type, so an extra percentile only costs the
+    comparison and the write of one more output in pass 2.
+
+    With a relative accuracy, pass 1 accumulates approximate per-zone sketches instead of exact histograms (for float
+    carbon products); the rank error of each zone is then written next to each output.
+
+    With an ecoregion filter, pass 1 also sums the forest carbon of each ecoregion and pass 2 writes a filtered copy of
+    each output, masked to the ecoregions the filter keeps (see filtering.py).
+
+    The per-zone histograms can also be kept as a zone statistics store (see zone_stats.py), for other percentiles and
+    summary tables without reading the rasters again.
+
+    With a checkpoint directory, both passes are journaled (see checkpoint.py): a restarted run resumes pass 1 from the
+    accumulator snapshot of its last checkpoint, and pass 2 from the last checkpointed window of the partly written
+    outputs.
+
+    With a region (see region.py), pass 2 only covers the windows of the region and the outputs only the region, and
+    pass 1 only the ecoregions that have cells in it, so a regional run takes seconds to minutes and matches the same
+    cells of a global run.
+"""
+
+import functools
+import os
+
+import numpy as np
+import rasterio
+
+from . import profiling
+from .blocks import DEFAULT_BLOCK_SIZE, ReadCache, default_nodata, iter_windows, output_profile, read_aligned, \
+    read_indexed, window_indices
+from .checkpoint import DEFAULT_INTERVAL, Checkpoint, run_signature
+from .cog import CogWriter, fit_dtype
+from .ecoregions import open_ecoregions
+from .filtering import EcoregionCarbon, apply_lookup, ecoregion_table
+from .kernels import FOREST_REMAP, ZONE_CLASS_SLOTS, carbon_above_threshold, combine_zones, decode_zones, \
+    read_clipped_carbon, reclassify_forest
+from .scheduler import DEFAULT_READ_AHEAD, TileScheduler
+from .zonal import ZonalHistogram, ZonalSketch, load_histogram, paint_zone_values, write_rank_errors
+from .zone_stats import ZoneStats, ecoregion_names
+
+# Intermediate rasters written in pass 2 when debugging (all on the forest grid). The shared ones are the same for
+# all runs of a sweep, the others are written for each run (see _debug_dtypes).
+_DEBUG_DTYPES = {
+    "forest_reclassified": np.int16,
+    "ecoregions_and_forest_zones": np.int64,
+    "carbon_clipped_to_forest": np.int32,
+    "carbon_thresholds": np.int32,
+    "carbon_in_each_forest_cell": np.float32,
+}
+_SHARED_DEBUG_OUTPUTS = ("forest_reclassified", "ecoregions_and_forest_zones")
+
+
+def percentile_label(carbon_type, percentile):
+
+    """ Version label of a run, e.g. 50th_percentile_belowground. """
+
+    number = "{:g}".format(percentile)
+    suffix = "th"
+    if not number.endswith(("11", "12", "13")):
+        suffix = {"1": "st", "2": "nd", "3": "rd"}.get(number[-1], "th")
+    return "{}{}_percentile_{}".format(number, suffix, carbon_type)
+
+
+def sweep_outputs(output_dir, runs):
+
+    """ Final output path of each (carbon type, percentile) run. """
+
+    return [os.path.join(output_dir, "high_priority_forest_carbon_" + percentile_label(*run) + ".tif") for run in runs]
+
+
+def sweep_zone_stats(output_dir, runs):
+
+    """ Zone statistics store path of each carbon type of the runs. """
+
+    return {carbon_type: os.path.join(output_dir, "high_priority_forest_carbon_zone_stats_{}.npz".format(carbon_type))
+            for carbon_type in sorted(set(carbon_type for carbon_type, percentile in runs))}
+
+
+class _Inputs:
+
+    """ Open datasets of a sweep. carbon_sources maps each carbon type to the carbon rasters to add together; a raster
+        used by several carbon types is only opened once.
+    """
+
+    def __init__(self, forest, carbon_sources, ecoregions):
+        self.forest = rasterio.open(forest)
+        self.ecoregions = open_ecoregions(ecoregions)
+        self._carbon_srcs = {}
+        for path in set(path for paths in carbon_sources.values() for path in paths):
+            self._carbon_srcs[path] = rasterio.open(path)
+        self.carbon = {carbon_type: [self._carbon_srcs[path] for path in paths]
+                       for carbon_type, paths in carbon_sources.items()}
+
+    def close(self):
+        for src in [self.forest, self.ecoregions] + list(self._carbon_srcs.values()):
+            src.close()
+
+
+class _Block:
+
+    """ Arrays of one window after steps 1-4 and 6. carbon[carbon_type] holds the (carbon, valid) of each type. """
+
+    def __init__(self, inputs, window):
+        cache = ReadCache()
+        forest, self.forest_valid = read_indexed(inputs.forest, *window_indices(window))
+        self.classes = reclassify_forest(forest, self.forest_valid)
+        self.eco_ids, self.eco_valid = read_aligned(inputs.ecoregions, inputs.forest.transform, window)
+        self.zones, self.zones_valid = combine_zones(self.eco_ids, self.eco_valid, self.classes, self.forest_valid)
+        self.carbon = {}
+        for carbon_type, carbon_srcs in inputs.carbon.items():
+            carbon, carbon_valid = read_clipped_carbon(carbon_srcs, inputs.forest, window, self.forest_valid,
+                                                       read=cache.read)
+            self.carbon[carbon_type] = carbon, carbon_valid & self.forest_valid
+
+
+class _HistogramSet(dict):
+
+    """ Zonal histogram (or sketch) of each carbon type. ecoregion_carbon holds the EcoregionCarbon of each carbon
+        type when the outputs are filtered.
+    """
+
+    def __init__(self, *args):
+        super().__init__(*args)
+        self.ecoregion_carbon = {}
+        self.ecoregion_ids = None  # The ecoregions whose zones the histograms cover, if not all (regional pass 1).
+
+    def merge(self, other):
+        for carbon_type, histogram in other.items():
+            self.setdefault(carbon_type, histogram.empty()).merge(histogram)
+        for carbon_type, totals in other.ecoregion_carbon.items():
+            self.ecoregion_carbon.setdefault(carbon_type, EcoregionCarbon()).merge(totals)
+
+    def save(self, directory):
+
+        """ Saves each histogram (and ecoregion totals) to <carbon type>.npz in directory. """
+
+        for carbon_type, histogram in self.items():
+            histogram.save(os.path.join(directory, carbon_type + ".npz"))
+        for carbon_type, totals in self.ecoregion_carbon.items():
+            totals.save(os.path.join(directory, carbon_type + "_ecoregion_carbon.npz"))
+
+    @classmethod
+    def load(cls, directory, carbon_types):
+
+        """ Loads the histograms of carbon_types saved with save(). """
+
+        histograms = cls()
+        for carbon_type in carbon_types:
+            histograms[carbon_type] = load_histogram(os.path.join(directory, carbon_type + ".npz"))
+            totals = os.path.join(directory, carbon_type + "_ecoregion_carbon.npz")
+            if os.path.exists(totals):
+                histograms.ecoregion_carbon[carbon_type] = EcoregionCarbon.load(totals)
+        return histograms
+
+
+def _new_histogram(relative_accuracy=None):
+    return ZonalSketch(relative_accuracy) if relative_accuracy else ZonalHistogram()
+
+
+def _accumulate_tile(inputs, window, relative_accuracy=None, ecoregion_totals=False, ecoregion_ids=None):
+
+    """ Pass 1 task: histogram (or sketch, with a relative accuracy) of the forest carbon in each zone of one window,
+        for each carbon type. With ecoregion_totals, also the total forest carbon of each ecoregion. With ecoregion_ids,
+        only the cells of those ecoregions count.
+    """
+
+    block = _Block(inputs, window)
+    eco_valid = block.eco_valid
+    if ecoregion_ids is not None:
+        eco_valid = eco_valid & np.isin(block.eco_ids, ecoregion_ids)
+    histograms = _HistogramSet()
+    for carbon_type, (carbon, carbon_valid) in block.carbon.items():
+        valid = block.zones_valid & carbon_valid & eco_valid
+        histograms[carbon_type] = _new_histogram(relative_accuracy)
+        histograms[carbon_type].update(block.zones[valid], carbon[valid])
+        if ecoregion_totals:
+            histograms.ecoregion_carbon[carbon_type] = EcoregionCarbon()
+            histograms.ecoregion_carbon[carbon_type].update_block(block.eco_ids, eco_valid, carbon, carbon_valid,
+                                                                  inputs.forest.transform, inputs.forest.crs, window)
+    return histograms
+
+
+def _debug_dtypes(histogram):
+
+    """ Data type of each intermediate raster of a run: float32 carbon and thresholds for sketches (float carbon), like
+        _output_dtype.
+    """
+
+    dtypes = dict(_DEBUG_DTYPES)
+    if isinstance(histogram, ZonalSketch):
+        dtypes.update(carbon_clipped_to_forest=np.float32, carbon_thresholds=np.float32)
+    return dtypes
+
+
+def _debug_array(values, valid, dtype):
+    return np.where(valid, values, default_nodata(dtype)).astype(dtype)
+
+
+def _threshold_tile(runs, thresholds, debug, inputs, window, keep=None, region=None):
+
+    """ Pass 2 task: final output of each run for one window, plus the intermediates when debugging (debug: the
+        _debug_dtypes of each run, or None). thresholds holds the (zone_ids, thresholds) of each run. With keep (the
+        ecoregion lookup table of each carbon type), the filtered output of each run follows the final outputs. With a
+        LocatedRegion, the outputs are NoData outside it.
+    """
+
+    block = _Block(inputs, window)
+    outputs, intermediates, shared = [], [], {}
+
+    for index, ((carbon_type, percentile), (zone_ids, zone_values)) in enumerate(zip(runs, thresholds)):
+        carbon, carbon_valid = block.carbon[carbon_type]
+        thresholds_nodata = default_nodata(zone_values.dtype)
+        cell_thresholds = paint_zone_values(zone_ids, zone_values, block.zones, block.zones_valid, thresholds_nodata)
+        thresholds_valid = cell_thresholds != thresholds_nodata
+        outputs.append(carbon_above_threshold(carbon, carbon_valid, cell_thresholds, thresholds_valid,
+                                              default_nodata(np.float32)))
+        if debug:
+            dtypes = debug[index]
+            intermediates.append({
+                "carbon_clipped_to_forest": _debug_array(carbon, carbon_valid, dtypes["carbon_clipped_to_forest"]),
+                "carbon_thresholds": _debug_array(cell_thresholds, thresholds_valid, dtypes["carbon_thresholds"]),
+                "carbon_in_each_forest_cell": _debug_array(carbon, carbon_valid, dtypes["carbon_in_each_forest_cell"]),
+            })
+
+    if region is not None:
+        inside = region.mask(window, block.eco_ids, block.eco_valid)
+        outputs = [np.where(inside, values, default_nodata(np.float32)) for values in outputs]
+
+    if keep:
+        kept = {carbon_type: apply_lookup(lookup, block.eco_ids, block.eco_valid)
+                for carbon_type, lookup in keep.items()}
+        outputs += [np.where(kept[carbon_type], values, default_nodata(np.float32))
+                    for (carbon_type, percentile), values in zip(runs, outputs)]
+
+    if debug:
+        shared["forest_reclassified"] = _debug_array(block.classes, block.forest_valid,
+                                                     _DEBUG_DTYPES["forest_reclassified"])
+        shared["ecoregions_and_forest_zones"] = _debug_array(block.zones, block.zones_valid,
+                                                             _DEBUG_DTYPES["ecoregions_and_forest_zones"])
+    return outputs, intermediates, shared
+
+
+def accumulate_zone_histograms(forest, carbon_sources, ecoregions, scheduler, block_size=DEFAULT_BLOCK_SIZE,
+                               relative_accuracy=None, ecoregion_totals=False, checkpoint=None, region=None):
+
+    """ Pass 1: per-zone histograms (or sketches) of the forest carbon of each carbon type, over all windows (and the
+        total forest carbon of each ecoregion, with ecoregion_totals). With a Checkpoint, the histograms are
+        snapshotted as the windows are merged, and a restarted pass carries on from the last snapshot. With a
+        LocatedRegion, only the windows and cells of the ecoregions of its pass 1 count.
+    """
+
+    with rasterio.open(forest) as forest_src:
+        windows = list(iter_windows(forest_src.width, forest_src.height, block_size))
+    ecoregion_ids = None
+    if region is not None:
+        ecoregion_ids = region.ecoregion_ids
+        all_windows, windows = len(windows), region.pass_1_windows(block_size)
+        print(" -> Pass 1 covers the {} ecoregion(s) of the region: {} of {} windows".format(
+            ecoregion_ids.size, len(windows), all_windows))
+    task = functools.partial(_accumulate_tile, relative_accuracy=relative_accuracy, ecoregion_totals=ecoregion_totals,
+                             ecoregion_ids=ecoregion_ids)
+    inputs = (forest, carbon_sources, ecoregions)
+    if checkpoint is None:
+        return scheduler.reduce(_Inputs, inputs, task, windows, _HistogramSet())
+
+    done = checkpoint.done("pass_1")
+    if not done:
+        histograms = _HistogramSet()
+    elif done == len(windows):
+        print(" -> Pass 1 is done, loading its histograms from the checkpoint")
+        return _HistogramSet.load(checkpoint.snapshot("pass_1"), carbon_sources)
+    else:
+        histograms = _HistogramSet.load(checkpoint.snapshot("pass_1"), carbon_sources)
+        print(" -> Resuming pass 1 after {} of {} windows".format(done, len(windows)))
+    for index, partial in enumerate(scheduler.map(_Inputs, inputs, task, windows[done:]), done + 1):
+        histograms.merge(partial)
+        if index == len(windows) or checkpoint.due():
+            checkpoint.save("pass_1", index, histograms.save)
+    return histograms
+
+
+def _histogram_entries(cache, forest, ecoregions, paths, relative_accuracy, ecoregion_totals, ecoregion_ids=None):
+
+    """ Cache entries of the histograms (and ecoregion totals, or None) of a carbon type, of all ecoregions or of
+        those of ecoregion_ids.
+    """
+
+    params = {"forest_remap": FOREST_REMAP, "zone_class_slots": ZONE_CLASS_SLOTS,
+              "relative_accuracy": relative_accuracy}
+    totals_params = {"cell_area": "WGS84"}
+    if ecoregion_ids is not None:
+        params["ecoregion_ids"] = totals_params["ecoregion_ids"] = [int(eco_id) for eco_id in ecoregion_ids]
+    entry = cache.entry("zone_histograms", [forest, ecoregions] + paths, params)
+    totals_entry = None
+    if ecoregion_totals:
+        totals_entry = cache.entry("ecoregion_carbon", [forest, ecoregions] + paths, totals_params)
+    return entry, totals_entry
+
+
+def cached_zone_histograms(forest, carbon_sources, ecoregions, scheduler, cache=None, block_size=DEFAULT_BLOCK_SIZE,
+                           relative_accuracy=None, ecoregion_totals=False, checkpoint=None, region=None):
+
+    """ Pass 1 with a StepCache: the histograms (and ecoregion totals) of carbon types whose inputs haven't changed are
+        loaded from the cache and pass 1 only runs for the others (not at all if every carbon type is cached). With a
+        LocatedRegion, the histograms of a global run are used if they are cached, those of the ecoregions of the
+        region otherwise.
+    """
+
+    histograms = _HistogramSet()
+    entries = {}
+    for carbon_type, paths in carbon_sources.items():
+        if cache is None:
+            break
+        entry, totals_entry = _histogram_entries(cache, forest, ecoregions, paths, relative_accuracy, ecoregion_totals)
+        if region is not None and not (entry.complete and (totals_entry is None or totals_entry.complete)):
+            entry, totals_entry = _histogram_entries(cache, forest, ecoregions, paths, relative_accuracy,
+                                                     ecoregion_totals, region.ecoregion_ids)
+            histograms.ecoregion_ids = region.ecoregion_ids
+        if entry.complete and (totals_entry is None or totals_entry.complete):
+            print(" -> Using cached per-zone histograms ({})...".format(carbon_type))
+            histograms[carbon_type] = load_histogram(entry.path("zone_histograms.npz"))
+            if totals_entry is not None:
+                histograms.ecoregion_carbon[carbon_type] = EcoregionCarbon.load(
+                    totals_entry.path("ecoregion_carbon.npz"))
+        else:
+            entries[carbon_type] = entry, totals_entry
+
+    missing = {carbon_type: paths for carbon_type, paths in carbon_sources.items() if carbon_type not in histograms}
+    if missing:
+        print(" -> Pass 1: masking, reclassifying, combining zones and accumulating per-zone histograms...")
+        if region is not None:
+            histograms.ecoregion_ids = region.ecoregion_ids
+        with profiling.step("pass_1"):
+            accumulated = accumulate_zone_histograms(forest, missing, ecoregions, scheduler, block_size,
+                                                     relative_accuracy, ecoregion_totals, checkpoint, region)
+        histograms.update(accumulated)
+        histograms.ecoregion_carbon.update(accumulated.ecoregion_carbon)
+        for carbon_type, (entry, totals_entry) in entries.items():
+            entry.create()
+            histograms[carbon_type].save(entry.path("zone_histograms.npz"))
+            entry.commit()
+            if totals_entry is not None:
+                totals_entry.create()
+                histograms.ecoregion_carbon[carbon_type].save(totals_entry.path("ecoregion_carbon.npz"))
+                totals_entry.commit()
+
+    return histograms
+
+
+def save_zone_stats(histograms, zone_stats, forest, carbon_sources, ecoregions):
+
+    """ Saves the ZoneStats of each carbon type to the path zone_stats maps it to. The metadata lists the ecoregions
+        the zones cover if they aren't all (ecoregion_ids, after a regional pass 1).
+    """
+
+    table = ecoregion_names(ecoregions)
+    ecoregion_ids = getattr(histograms, "ecoregion_ids", None)
+    for carbon_type, path in sorted(zone_stats.items()):
+        directory = os.path.dirname(os.path.abspath(path))
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        print(" -> Writing the per-zone statistics ({}) to {}...".format(carbon_type, path))
+        metadata = {"carbon_type": carbon_type, "forest": forest, "carbon": carbon_sources[carbon_type],
+                    "ecoregions": ecoregions,
+                    "ecoregion_ids": None if ecoregion_ids is None else [int(eco_id) for eco_id in ecoregion_ids]}
+        ZoneStats.from_histogram(histograms[carbon_type], table, metadata=metadata).save(path)
+
+
+def stored_zone_histograms(zone_stats_from, relative_accuracy=None, region=None):
+
+    """ Histograms of each carbon type from the zone statistics store zone_stats_from maps it to (e.g. of a global
+        run of the same inputs), instead of pass 1. A store of a regional run only holds the zones of its ecoregions,
+        so it can only stand in for a run whose LocatedRegion needs no others.
+    """
+
+    histograms = _HistogramSet()
+    for carbon_type, path in sorted(zone_stats_from.items()):
+        stats = ZoneStats.load(path)
+        if stats.relative_accuracy != relative_accuracy:
+            raise ValueError("{} holds {} histograms, the run needs {}".format(
+                path, "approximate" if stats.approximate else "exact", "approximate ones with a relative accuracy of "
+                "{}".format(relative_accuracy) if relative_accuracy else "exact ones"))
+        covered = stats.metadata.get("ecoregion_ids")
+        if covered is not None and (region is None or not np.isin(region.ecoregion_ids, covered).all()):
+            raise ValueError("{} only holds the zones of the ecoregions of a region, not all those of this run".format(
+                path))
+        print(" -> Using the per-zone histograms of {} ({})...".format(path, carbon_type))
+        histograms[carbon_type] = stats.histogram()
+    return histograms
+
+
+def zone_thresholds(histogram, percentile):
+
+    """ (zone_ids, thresholds) of the zones that hold any carbon. Carbon is integer, so AUTO_DETECT means NEAREST.
+        The thresholds of a ZonalSketch are float32.
+    """
+
+    thresholds, has_values = histogram.percentile(percentile, "NEAREST")
+    dtype = np.float32 if isinstance(histogram, ZonalSketch) else np.int32
+    return histogram.zone_ids[has_values], thresholds[has_values].astype(dtype)
+
+
+def _output_dtype(histogram):
+
+    """ (dtype, nodata) of the final output: the smallest that holds the carbon range, float32 for sketches. """
+
+    if isinstance(histogram, ZonalSketch):
+        return fit_dtype(0, 0, integer=False)
+    return fit_dtype(histogram.value_min, histogram.value_max)
+
+
+def _locate_region(region, forest, ecoregions, ecoregion_filter, table):
+
+    """ The LocatedRegion of region, or None without one. With an ecoregion filter, pass 1 also covers the ecoregions
+        of interest outside the region: the median of their totals needs all of them.
+    """
+
+    if region is None:
+        return None
+    other_ecoregions = []
+    if ecoregion_filter is not None:
+        other_ecoregions = [eco_id for eco_id, row in table.items()
+                            if row["name"] in ecoregion_filter.ecoregions_of_interest]
+    located = region.locate(forest, ecoregions, other_ecoregions)
+    print(" -> Region: {} x {} cells".format(located.width, located.height))
+    return located
+
+
+def _sweep_signature(inputs, runs, outputs, block_size, relative_accuracy, ecoregion_filter, filtered_outputs, region,
+                     zone_stats_from):
+
+    """ Checkpoint signature of a sweep (see run_signature): its inputs, outputs and the parameters they depend on. """
+
+    forest, carbon_sources, ecoregions = inputs
+    filter_params = None
+    if ecoregion_filter is not None:
+        filter_params = {"biomes": sorted(ecoregion_filter.biomes),
+                         "ecoregions_of_interest": sorted(ecoregion_filter.ecoregions_of_interest),
+                         "filtered_outputs": [os.path.abspath(path) for path in filtered_outputs]}
+    signature_inputs = [forest, ecoregions] + sorted(set(path for paths in carbon_sources.values() for path in paths))
+    if region is not None and region.polygons:
+        signature_inputs.append(region.polygons)
+    signature_inputs += sorted((zone_stats_from or {}).values())
+    return run_signature(
+        signature_inputs, outputs,
+        {"carbon_sources": carbon_sources, "runs": runs, "block_size": block_size, "forest_remap": FOREST_REMAP,
+         "zone_class_slots": ZONE_CLASS_SLOTS, "relative_accuracy": relative_accuracy, "filter": filter_params,
+         "region": region.params() if region is not None else None})
+
+
+def _run_thresholds(runs, outputs, histograms):
+
+    """ (zone_ids, thresholds) of each run. The rank errors of the runs with approximate histograms are written next
+        to their output.
+    """
+
+    thresholds = []
+    for (carbon_type, percentile), output in zip(runs, outputs):
+        histogram = histograms[carbon_type]
+        print(" -> Calculating the {} percentile of {} zones ({})...".format(
+            percentile, histogram.zone_ids.size, carbon_type))
+        thresholds.append(zone_thresholds(histogram, percentile))
+        if isinstance(histogram, ZonalSketch):
+            eco_ids, forest_classes = decode_zones(histogram.zone_ids)
+            write_rank_errors(os.path.splitext(output)[0] + "_rank_error.csv", histogram, percentile,
+                              {"ecoregion_id": eco_ids, "forest_class": forest_classes})
+    return thresholds
+
+
+def _ecoregions_to_keep(ecoregion_filter, table, histograms, carbon_types):
+
+    """ Lookup of the ecoregions the filter keeps, for each carbon type (none without a filter). """
+
+    keep = {}
+    if ecoregion_filter is not None:
+        for carbon_type in sorted(carbon_types):
+            print(" -> Selecting the ecoregions to keep ({})...".format(carbon_type))
+            keep[carbon_type] = ecoregion_filter.lookup(table, histograms.ecoregion_carbon[carbon_type])
+    return keep
+
+
+def _open_writers(outputs, dtypes, grid, block_size, done):
+
+    """ (CogWriters of the outputs, number of windows they already hold). After done windows of a checkpoint, the
+        partial outputs are resumed, or started over if they are gone.
+    """
+
+    dsts = [CogWriter(output, grid, dtype, nodata, window_size=block_size, resume=done > 0)
+            for output, (dtype, nodata) in zip(outputs, dtypes)]
+    if done and not all(dst.resumed for dst in dsts):
+        print(" -> The partial outputs of the checkpoint are gone, restarting pass 2")
+        for dst in dsts:
+            dst.abort()
+        return _open_writers(outputs, dtypes, grid, block_size, 0)
+    return dsts, done
+
+
+class _DebugOutputs:
+
+    """ The intermediate rasters of pass 2 in debug_dir, on the grid of forest_src: those of each run (run_dtypes, see
+        _debug_dtypes) suffixed with its run label, and the shared ones suffixed with label.
+    """
+
+    def __init__(self, debug_dir, forest_src, label, run_labels, run_dtypes):
+        self.debug_dir = debug_dir
+        self.label = label
+        self.run_labels = run_labels
+        self.run_dtypes = run_dtypes
+        self._profiles = {np.dtype(dtype).name: output_profile(forest_src, dtype, default_nodata(dtype))
+                          for dtypes in run_dtypes + [_DEBUG_DTYPES] for dtype in dtypes.values()}
+        self._opened = []
+        self._runs, self._shared = [], {}
+
+    def _open(self, name, suffix, dtype):
+        dst = rasterio.open(os.path.join(self.debug_dir, "{}_{}.tif".format(name, suffix)), "w",
+                            **self._profiles[np.dtype(dtype).name])
+        self._opened.append(dst)
+        return dst
+
+    def open(self):
+        for run_label, dtypes in zip(self.run_labels, self.run_dtypes):
+            self._runs.append({name: self._open(name, run_label, dtype)
+                               for name, dtype in dtypes.items() if name not in _SHARED_DEBUG_OUTPUTS})
+        self._shared = {name: self._open(name, self.label, _DEBUG_DTYPES[name]) for name in _SHARED_DEBUG_OUTPUTS}
+
+    def write(self, window, intermediates, shared):
+        for run_dsts, run_intermediates in zip(self._runs, intermediates):
+            for name, values in run_intermediates.items():
+                run_dsts[name].write(values, 1, window=window)
+        for name, values in shared.items():
+            self._shared[name].write(values, 1, window=window)
+
+    def close(self):
+        for dst in self._opened:
+            dst.close()
+
+
+def _write_pass_2(scheduler, inputs, task, windows, done, dsts, debug=None, checkpoint=None):
+
+    """ Pass 2: runs task on the (window, output window) pairs of windows after the first done, and writes the outputs
+        to dsts (and the intermediates to _DebugOutputs debug). With a Checkpoint, the outputs are flushed and the
+        progress saved as they are written, and kept for the restarted run if it fails; otherwise they are aborted.
+    """
+
+    output_nodata = default_nodata(np.float32)
+    try:
+        if debug is not None:
+            debug.open()
+        results = scheduler.map(_Inputs, inputs, task, [window for window, output_window in windows[done:]])
+        with profiling.step("pass_2"):
+            for index, ((window, output_window), (tile_outputs, intermediates, shared)) in enumerate(
+                    zip(windows[done:], results), done + 1):
+                for dst, values in zip(dsts, tile_outputs):
+                    dst.write(values, output_window, values != output_nodata)
+                if debug is not None:
+                    debug.write(window, intermediates, shared)
+                if checkpoint is not None and (index == len(windows) or checkpoint.due()):
+                    for dst in dsts:
+                        dst.flush()
+                    checkpoint.save("pass_2", index)
+    except BaseException:
+        for dst in dsts:
+            if checkpoint is not None:
+                dst.suspend()  # Kept for the restarted run.
+            else:
+                dst.abort()
+        raise
+    finally:
+        if debug is not None:
+            debug.close()
+
+
+def run_sweep(forest, carbon_sources, ecoregions, runs, outputs, debug_dir=None, label="debug", run_labels=None,
+              block_size=DEFAULT_BLOCK_SIZE, workers=1, cache=None, relative_accuracy=None, ecoregion_filter=None,
+              filtered_outputs=None, checkpoint_dir=None, checkpoint_interval=DEFAULT_INTERVAL,
+              read_ahead=DEFAULT_READ_AHEAD, zone_stats=None, region=None, zone_stats_from=None):
+
+    """ Runs steps 1-7 for several (carbon type, percentile) combinations in the same two passes.
+
+        forest: FAO structural forms raster (defines the analysis grid).
+        carbon_sources: dict of carbon type -> carbon raster, or list of carbon rasters to add together (e.g.
+            "combined": [above, below]).
+        ecoregions: rasterized ecoregions on the forest grid, or a persisted ecoregion grid (.npy, see
+            rasterize_ecoregions).
+        runs: list of (carbon type, percentile).
+        outputs: final output path of each run (see sweep_outputs).
+        debug_dir: if given, the intermediate rasters are also written there. The zones and reclassified forest are
+            suffixed with label, the others with the run label (run_labels, default percentile_label()).
+        workers: number of worker processes. The outputs are the same for any number of workers.
+        read_ahead: with one worker, the number of tiles read ahead by threads (see TileScheduler).
+        cache: optional StepCache for the per-zone histograms, so a rerun with other percentiles skips pass 1.
+        relative_accuracy: if given, approximate per-zone sketches are used instead of exact histograms (needed for
+            float carbon). The rank error of each zone is written to <output>_rank_error.csv.
+        ecoregion_filter: if given (an EcoregionFilter, needs a persisted ecoregion grid), a copy of each output masked
+            to the ecoregions it keeps is also written, to filtered_outputs (default <output>_filtered.tif).
+        zone_stats: optional dict of carbon type -> path of the zone statistics store (.npz, see ZoneStats) to write.
+        checkpoint_dir: if given, the progress of both passes is journaled there (at most every checkpoint_interval
+            seconds), and a rerun of the same sweep after a crash resumes where the journal stopped. The journal is
+            removed once the outputs are written. Can't be combined with debug_dir.
+        region: if given (a Region, needs a persisted ecoregion grid), only the region is computed and the outputs
+            cover only the region, with the values of a global run (see region.py).
+        zone_stats_from: optional dict of carbon type -> zone statistics store of a global run of the same inputs, to
+            take the per-zone histograms from instead of running pass 1. Not with ecoregion_filter.
+    """
+
+    runs = list(runs)
+    run_labels = run_labels or [percentile_label(*run) for run in runs]
+    carbon_types = set(carbon_type for carbon_type, percentile in runs)
+    carbon_sources = {carbon_type: [paths] if isinstance(paths, str) else list(paths)
+                      for carbon_type, paths in carbon_sources.items() if carbon_type in carbon_types}
+    inputs = (forest, carbon_sources, ecoregions)
+    scheduler = TileScheduler(workers, read_ahead=read_ahead)
+    table = None
+    if ecoregion_filter is not None:
+        table = ecoregion_table(ecoregions)
+        filtered_outputs = filtered_outputs or [os.path.splitext(output)[0] + "_filtered.tif" for output in outputs]
+    if zone_stats_from and ecoregion_filter is not None:
+        raise ValueError("filtering needs the ecoregion totals of pass 1, which a zone statistics store doesn't hold")
+    if checkpoint_dir and debug_dir:
+        raise ValueError("the intermediate rasters of debug_dir can't be checkpointed")
+
+    located = _locate_region(region, forest, ecoregions, ecoregion_filter, table)
+    checkpoint = None
+    if checkpoint_dir:
+        signature = _sweep_signature(inputs, runs, outputs, block_size, relative_accuracy, ecoregion_filter,
+                                     filtered_outputs, region, zone_stats_from)
+        checkpoint = Checkpoint(checkpoint_dir, signature, checkpoint_interval)
+
+    if zone_stats_from:
+        histograms = stored_zone_histograms(zone_stats_from, relative_accuracy, located)
+    else:
+        histograms = cached_zone_histograms(forest, carbon_sources, ecoregions, scheduler, cache, block_size,
+                                            relative_accuracy, ecoregion_totals=ecoregion_filter is not None,
+                                            checkpoint=checkpoint, region=located)
+    if zone_stats:
+        save_zone_stats(histograms, zone_stats, forest, carbon_sources, ecoregions)
+
+    thresholds = _run_thresholds(runs, outputs, histograms)
+    keep = _ecoregions_to_keep(ecoregion_filter, table, histograms, carbon_sources)
+    output_dtypes = [_output_dtype(histograms[carbon_type]) for carbon_type, percentile in runs]
+    if keep:
+        outputs, output_dtypes = list(outputs) + list(filtered_outputs), output_dtypes * 2
+    debug_dtypes = [_debug_dtypes(histograms[carbon_type]) for carbon_type, percentile in runs]
+
+    print(" -> Pass 2: comparing carbon to the zone thresholds and writing {} output(s)...".format(len(outputs)))
+    with rasterio.open(forest) as forest_src:
+        # (window of the forest grid, window of the outputs): the same unless the outputs only cover a region.
+        if located is not None:
+            windows, output_grid = located.output_windows(block_size), located
+        else:
+            windows = [(window, window) for window in iter_windows(forest_src.width, forest_src.height, block_size)]
+            output_grid = forest_src
+        dsts, done = _open_writers(outputs, output_dtypes, output_grid, block_size,
+                                   checkpoint.done("pass_2") if checkpoint is not None else 0)
+        if done:
+            print(" -> Resuming pass 2 after {} of {} windows".format(done, len(windows)))
+        debug = _DebugOutputs(debug_dir, forest_src, label, run_labels, debug_dtypes) if debug_dir else None
+
+    task = functools.partial(_threshold_tile, runs, thresholds, debug_dtypes if debug_dir else None, keep=keep,
+                             region=located)
+    _write_pass_2(scheduler, inputs, task, windows, done, dsts, debug, checkpoint)
+
+    print(" -> Writing {} Cloud Optimized GeoTIFF(s)...".format(len(dsts)))
+    with profiling.step("cog"):
+        for dst in dsts:
+            dst.close()
+    if checkpoint is not None:
+        checkpoint.finish()
+
+    return histograms
+
+
+def run_fused_pipeline(forest, carbon, ecoregions, percentile, output, debug_dir=None, label="debug",
+                       block_size=DEFAULT_BLOCK_SIZE, workers=1, cache=None, relative_accuracy=None,
+                       ecoregion_filter=None, filtered_output=None, checkpoint_dir=None,
+                       checkpoint_interval=DEFAULT_INTERVAL, read_ahead=DEFAULT_READ_AHEAD, zone_stats=None,
+                       region=None, zone_stats_from=None):
+
+    """ Runs steps 1-7 in two passes and writes the high priority forest carbon to output.
+
+        forest: FAO structural forms raster (defines the analysis grid).
+        carbon: carbon raster, or a list of carbon rasters to add together (combined carbon).
+        ecoregions: rasterized ecoregions on the forest grid, or a persisted ecoregion grid (.npy, see
+            rasterize_ecoregions).
+        debug_dir: if given, the intermediate rasters are also written there (suffixed with label).
+        workers: number of worker processes. The output is the same for any number of workers.
+        read_ahead: with one worker, the number of tiles read ahead by threads (see TileScheduler).
+        cache: optional StepCache for the per-zone histograms.
+        relative_accuracy: if given, approximate per-zone sketches are used (see run_sweep).
+        ecoregion_filter: if given, the output masked to the ecoregions it keeps is also written to filtered_output
+            (see run_sweep).
+        zone_stats: optional path of the zone statistics store (.npz, see ZoneStats) to write.
+        checkpoint_dir: if given, progress is journaled there so that a crashed run can be resumed (see run_sweep).
+        region: if given, only this Region is computed (see run_sweep).
+        zone_stats_from: optional zone statistics store of a global run to take the thresholds from (see run_sweep).
+    """
+
+    histograms = run_sweep(forest, {"carbon": carbon}, ecoregions, [("carbon", percentile)], [output],
+                           debug_dir=debug_dir, label=label, run_labels=[label], block_size=block_size,
+                           workers=workers, cache=cache, relative_accuracy=relative_accuracy,
+                           ecoregion_filter=ecoregion_filter,
+                           filtered_outputs=[filtered_output] if filtered_output else None,
+                           checkpoint_dir=checkpoint_dir, checkpoint_interval=checkpoint_interval,
+                           read_ahead=read_ahead, zone_stats={"carbon": zone_stats} if zone_stats else None,
+                           region=region, zone_stats_from={"carbon": zone_stats_from} if zone_stats_from else None)
+    return histograms["carbon"]
@@ -0,0 +1,279 @@
+""" Per-step resource instrumentation.
+
+    A RunProfiler records, for each step of a run, the wall time, the CPU time, the peak resident memory, the bytes
+    read and written and the number of tiles processed, and writes them to a JSON run report. CPU time, memory and I/O
+    include the worker processes: the memory of live workers is sampled, and the CPU time and I/O of workers are added
+    to the run when they exit (the I/O only on Linux). Engine functions mark their passes with step(), which records a
+    nested step while a RunProfiler is running and does nothing otherwise.
+
+    One step can also be run under cProfile; its statistics are saved next to the report (.prof, plus the top functions
+    by cumulative time as .txt). cProfile only sees the calling thread, so profile a step with workers=1 and
+    read_ahead=0, or attach a sampling profiler (py-spy record --subprocesses) to a parallel run.
+"""
+
+import contextlib
+import cProfile
+import datetime
+import io
+import json
+import os
+import platform
+import pstats
+import sys
+import threading
+import time
+
+try:
+    import psutil
+except ImportError:
+    psutil = None
+
+_active = None
+_tiles = 0
+
+
+def count_tiles(count=1):
+
+    """ Counts tiles (windows) processed, for the tiles per second of the running steps. """
+
+    global _tiles
+    _tiles += count
+
+
+def _io_bytes():
+
+    """ (bytes read, bytes written) so far by this process and the children it has waited for, or (None, None). """
+
+    if psutil is not None:
+        try:
+            counters = psutil.Process().io_counters()
+            return getattr(counters, "read_chars", counters.read_bytes), getattr(counters, "write_chars",
+                                                                                  counters.write_bytes)
+        except (AttributeError, psutil.Error):
+            pass
+    try:
+        with open("/proc/self/io") as f:
+            fields = dict(line.split(":", 1) for line in f)
+        return int(fields["rchar"]), int(fields["wchar"])
+    except (OSError, KeyError, ValueError):
+        return None, None
+
+
+def _proc_tree(pid):
+
+    """ pid and the pids of all its descendants, from /proc (Linux). """
+
+    pids = [pid]
+    with contextlib.suppress(OSError):  # The process may exit while it's being read.
+        for task in os.listdir("/proc/{}/task".format(pid)):
+            with open("/proc/{}/task/{}/children".format(pid, task)) as f:
+                children = f.read().split()
+            for child in children:
+                pids.extend(_proc_tree(int(child)))
+    return pids
+
+
+def _rss_bytes():
+
+    """ Resident memory of this process and its children now, or None if it can't be measured. """
+
+    if psutil is not None:
+        try:
+            process = psutil.Process()
+            total = process.memory_info().rss
+            for child in process.children(recursive=True):
+                with contextlib.suppress(psutil.Error):
+                    total += child.memory_info().rss
+            return total
+        except psutil.Error:
+            return None
+    if not os.path.isdir("/proc"):
+        return None
+    try:
+        total = 0
+        for pid in _proc_tree(os.getpid()):
+            with contextlib.suppress(OSError):
+                with open("/proc/{}/statm".format(pid)) as f:
+                    total += int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+        return total
+    except (OSError, ValueError, AttributeError):
+        return None
+
+
+def _cpu_seconds():
+
+    """ User + system CPU time of this process and of the children it has waited for. """
+
+    times = os.times()
+    return times.user + times.system + times.children_user + times.children_system
+
+
+def _difference(end, start):
+    return end - start if end is not None and start is not None else None
+
+
+class _Measurement:
+
+    """ Counters at the start of a step (or run), and the peak memory seen while it runs. """
+
+    def __init__(self):
+        self.wall = time.perf_counter()
+        self.cpu = _cpu_seconds()
+        self.read, self.written = _io_bytes()
+        self.tiles = _tiles
+        self.peak_rss = _rss_bytes()
+
+    def sample(self, rss):
+        if rss is not None:
+            self.peak_rss = max(self.peak_rss or 0, rss)
+
+    def result(self):
+        self.sample(_rss_bytes())
+        wall = time.perf_counter() - self.wall
+        read, written = _io_bytes()
+        tiles = _tiles - self.tiles
+        return {
+            "wall_seconds": round(wall, 3),
+            "cpu_seconds": round(_cpu_seconds() - self.cpu, 3),
+            "peak_rss_bytes": self.peak_rss,
+            "read_bytes": _difference(read, self.read),
+            "write_bytes": _difference(written, self.written),
+            "tiles": tiles,
+            "tiles_per_second": round(tiles / wall, 3) if tiles and wall > 0 else None,
+        }
+
+
+def _format_bytes(size):
+    return "{:.2f} GB".format(size / 1024 ** 3) if size is not None else "n/a"
+
+
+class RunProfiler:
+
+    """ Records the steps of a run and writes the run report to report_path (JSON) when it finishes.
+
+        config: settings of the run to include in the report (anything JSON serializable).
+        profile_step: name of a step to run under cProfile, either its own name (e.g. "pass_2") or its full name
+            (e.g. "calc_percentile_threshold/pass_1").
+        interval: seconds between memory samples.
+
+        Use as a context manager, or call start() and finish(). Steps are recorded with step() (of this module or
+        of the profiler).
+    """
+
+    def __init__(self, report_path, config=None, profile_step=None, interval=0.2):
+        self.report_path = report_path
+        self.config = config or {}
+        self.profile_step = profile_step
+        self.interval = interval
+        self.steps = []
+        self._open = []
+        self._names = []
+        self._profile_path = None
+        self._stop = threading.Event()
+        self._sampler = None
+        self._run = None
+        self._started = None
+
+    def _sample(self):
+        while not self._stop.wait(self.interval):
+            rss = _rss_bytes()
+            for measurement in [self._run] + list(self._open):
+                measurement.sample(rss)
+
+    def start(self):
+
+        """ Starts recording (and sampling memory). Returns the profiler. """
+
+        global _active
+        self._started = datetime.datetime.now()
+        self._run = _Measurement()
+        self._stop.clear()
+        self._sampler = threading.Thread(target=self._sample, name="RunProfiler", daemon=True)
+        self._sampler.start()
+        _active = self
+        return self
+
+    @contextlib.contextmanager
+    def step(self, name):
+
+        """ Records the code run in the with block as a step. Steps started inside it are recorded as name/... """
+
+        self._names.append(name)
+        full_name = "/".join(self._names)
+        profile = None
+        if self.profile_step in (name, full_name) and self._profile_path is None:
+            profile = cProfile.Profile()
+        measurement = _Measurement()
+        self._open.append(measurement)
+        try:
+            if profile is not None:
+                profile.enable()
+            try:
+                yield
+            finally:
+                if profile is not None:
+                    profile.disable()
+        finally:
+            self._open.remove(measurement)
+            self._names.pop()
+            record = dict(name=full_name, **measurement.result())
+            self.steps.append(record)
+            print(" -> {}: {:.1f} s ({:.1f} s CPU, peak memory {})".format(
+                full_name, record["wall_seconds"], record["cpu_seconds"], _format_bytes(record["peak_rss_bytes"])))
+            if profile is not None:
+                self._save_profile(profile, full_name)
+
+    def _save_profile(self, profile, name):
+        self._profile_path = os.path.splitext(self.report_path)[0] + "_profile.prof"
+        profile.dump_stats(self._profile_path)
+        text = io.StringIO()
+        pstats.Stats(profile, stream=text).sort_stats("cumulative").print_stats(40)
+        with open(os.path.splitext(self._profile_path)[0] + ".txt", "w") as f:
+            f.write("cProfile of step {}\n\n".format(name))
+            f.write(text.getvalue())
+        print(" -> Profile of {} saved to {}".format(name, self._profile_path))
+
+    def finish(self, error=None):
+
+        """ Stops recording and writes the run report. Returns the report. """
+
+        global _active
+        if _active is self:
+            _active = None
+        self._stop.set()
+        self._sampler.join()
+
+        report = dict(
+            started=self._started.isoformat(),
+            finished=datetime.datetime.now().isoformat(),
+            error=error,
+            host={"platform": platform.platform(), "python": sys.version.split()[0], "cpu_count": os.cpu_count()},
+            config=self.config,
+            profile=self._profile_path,
+            steps=self.steps,
+            **self._run.result())
+        directory = os.path.dirname(os.path.abspath(self.report_path))
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        with open(self.report_path, "w") as f:
+            json.dump(report, f, indent=1, default=str)
+        print(" -> Run report written to {}".format(self.report_path))
+        return report
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.finish(repr(exc_value) if exc_type is not None else None)
+
+
+@contextlib.contextmanager
+def step(name):
+
+    """ Records the with block as a step of the running RunProfiler, if there is one. """
+
+    if _active is None:
+        yield
+        return
+    with _active.step(name):
+        yield
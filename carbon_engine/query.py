@@ -0,0 +1,42 @@
+""" Command line queries of a zone statistics store (see zone_stats.py), e.g.:
+
+    python -m carbon_engine.query high_priority_forest_carbon_zone_stats.npz --percentiles 50 75
+        --biome "Temperate Conifer Forests" --csv zones.csv
+"""
+
+import argparse
+import csv
+import sys
+
+from .zone_stats import ZoneStats
+
+
+def main(argv=None):
+
+    parser = argparse.ArgumentParser(prog="python -m carbon_engine.query",
+                                     description="Per-zone statistics and percentiles from a zone statistics store.")
+    parser.add_argument("store", help="Zone statistics store (.npz) written by a run.")
+    parser.add_argument("--percentiles", nargs="+", type=float, default=[], help="Percentiles to add, e.g. 50 75.")
+    parser.add_argument("--ecoregion", help="Only the zones of this ecoregion (ECO_ID or ECO_NAME).")
+    parser.add_argument("--forest-class", type=int, help="Only the zones of this forest class (1-4).")
+    parser.add_argument("--biome", help="Only the zones of this biome (BIOME_NAME).")
+    parser.add_argument("--csv", help="Write the table to this CSV file instead of printing it.")
+    args = parser.parse_args(argv)
+
+    stats = ZoneStats.load(args.store)
+    ecoregion = args.ecoregion
+    if ecoregion is not None and ecoregion.lstrip("-").isdigit():
+        ecoregion = int(ecoregion)
+    rows = stats.select(ecoregion, args.forest_class, args.biome)
+    if args.csv:
+        stats.write_csv(args.csv, args.percentiles, rows)
+        print("{} zones written to {}".format(rows.size, args.csv))
+        return
+    table = stats.table(args.percentiles, rows)
+    writer = csv.DictWriter(sys.stdout, fieldnames=list(table[0]) if table else ["zone_id"])
+    writer.writeheader()
+    writer.writerows(table)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,194 @@
+""" Regional runs.
+
+    A Region (a bounding box, a list of ecoregions or a polygon layer) limits a run to the windows of the forest grid
+    that cover it: nothing outside it is written, no clipped copies of the inputs are made, and the output covers only
+    the region. The values in the region are the same as those of a global run: a cell's threshold depends on all the
+    cells of its zone (ecoregion x forest class), so pass 1 still covers the whole extent of every ecoregion that has
+    cells in the region (and only counts the cells of those ecoregions), unless the thresholds come from the zone
+    statistics store or the cached histograms of a global run.
+
+    Cells are in the region if their centres are, like ExtractByMask.
+"""
+
+import math
+
+import numpy as np
+import rasterio
+from rasterio import features, windows
+from rasterio.windows import Window
+
+from .blocks import DEFAULT_BLOCK_SIZE, iter_windows, read_aligned
+from .ecoregions import _split_feature_class, ecoregion_extents, open_ecoregions
+
+
+def _centre_window(bounds, transform, width, height):
+
+    """ Window of the cells of a grid whose centres are within bounds (left, bottom, right, top), or None. """
+
+    left, bottom, right, top = bounds
+    col_start = max(math.ceil((left - transform.c) / transform.a - 0.5), 0)
+    col_stop = min(math.floor((right - transform.c) / transform.a - 0.5) + 1, width)
+    row_start = max(math.ceil((top - transform.f) / transform.e - 0.5), 0)
+    row_stop = min(math.floor((bottom - transform.f) / transform.e - 0.5) + 1, height)
+    if col_start >= col_stop or row_start >= row_stop:
+        return None
+    return Window(col_start, row_start, col_stop - col_start, row_stop - row_start)
+
+
+def _union(window_list):
+    row_start = min(window.row_off for window in window_list)
+    col_start = min(window.col_off for window in window_list)
+    row_stop = max(window.row_off + window.height for window in window_list)
+    col_stop = max(window.col_off + window.width for window in window_list)
+    return Window(col_start, row_start, col_stop - col_start, row_stop - row_start)
+
+
+def _overlaps(a, b):
+    return (a.col_off < b.col_off + b.width and b.col_off < a.col_off + a.width and
+            a.row_off < b.row_off + b.height and b.row_off < a.row_off + a.height)
+
+
+def read_polygons(polygons, crs):
+
+    """ Geometries of a polygon layer (a feature class in a file geodatabase, a shapefile, ...) in crs. """
+
+    import fiona
+    from fiona.transform import transform_geom
+
+    dataset, layer = _split_feature_class(polygons)
+    geometries = []
+    with fiona.open(dataset, layer=layer) as src:
+        reproject = crs is not None and bool(src.crs_wkt) and rasterio.crs.CRS.from_wkt(src.crs_wkt) != crs
+        for feature in src:
+            if feature.geometry is not None:
+                geometry = dict(feature.geometry)
+                geometries.append(transform_geom(src.crs_wkt, crs.to_wkt(), geometry) if reproject else geometry)
+    return geometries
+
+
+class Region:
+
+    """ Region of interest of a run: exactly one of bounds (left, bottom, right, top in the CRS of the forest grid),
+        ecoregions (names or ECO_IDs of the ecoregion grid) or polygons (a polygon layer fiona reads, in any CRS).
+    """
+
+    def __init__(self, bounds=None, ecoregions=None, polygons=None):
+        if sum(value is not None for value in (bounds, ecoregions, polygons)) != 1:
+            raise ValueError("a region is a bounding box, a list of ecoregions or a polygon layer")
+        self.bounds = tuple(float(value) for value in bounds) if bounds is not None else None
+        self.ecoregions = list(ecoregions) if ecoregions is not None else None
+        self.polygons = polygons
+
+    def params(self):
+
+        """ The region as a dict, for run signatures and metadata. """
+
+        return {"bounds": self.bounds, "ecoregions": self.ecoregions, "polygons": self.polygons}
+
+    def locate(self, forest, ecoregions, other_ecoregions=()):
+
+        """ The region on the grid of the forest raster (see LocatedRegion). ecoregions: a persisted ecoregion grid
+            (.npy). other_ecoregions: IDs of ecoregions that pass 1 must cover as well (e.g. for filtering).
+        """
+
+        with rasterio.open(forest) as forest_src, open_ecoregions(ecoregions) as eco_src:
+            if not hasattr(eco_src, "ecoregions"):
+                raise ValueError("a region needs a persisted ecoregion grid (.npy, see rasterize_ecoregions)")
+            grid = forest_src.transform, forest_src.width, forest_src.height
+            extents = ecoregion_extents(ecoregions)
+
+            def extent_window(eco_id):
+                row_start, col_start, row_stop, col_stop = extents[eco_id]
+                extent = Window(col_start, row_start, col_stop - col_start, row_stop - row_start)
+                if eco_src.transform.almost_equals(forest_src.transform):
+                    return extent
+                return _centre_window(windows.bounds(extent, eco_src.transform), *grid)
+
+            selected, geometries = None, None
+            if self.ecoregions is not None:
+                names = {row.get("name"): eco_id for eco_id, row in eco_src.ecoregions.items()}
+                selected = []
+                for ecoregion in self.ecoregions:
+                    eco_id = ecoregion
+                    if isinstance(ecoregion, str):
+                        eco_id = names.get(ecoregion, int(ecoregion) if ecoregion.isdigit() else None)
+                    if eco_id not in eco_src.ecoregions:
+                        raise ValueError("unknown ecoregion: {}".format(ecoregion))
+                    selected.append(eco_id)
+                selected = np.unique(np.array(selected, dtype=np.int64))
+                window_list = [extent_window(eco_id) for eco_id in selected if eco_id in extents]
+                window_list = [window for window in window_list if window is not None]
+                window = _union(window_list) if window_list else None
+            elif self.polygons is not None:
+                geometries = read_polygons(self.polygons, forest_src.crs)
+                window = None
+                if geometries:
+                    bounds = np.array([features.bounds(geometry) for geometry in geometries])
+                    window = _centre_window((bounds[:, 0].min(), bounds[:, 1].min(), bounds[:, 2].max(),
+                                             bounds[:, 3].max()), *grid)
+            else:
+                window = _centre_window(self.bounds, *grid)
+            if window is None:
+                raise ValueError("the region doesn't cover any cell of the forest grid")
+
+            located = LocatedRegion(window, forest_src, selected, geometries)
+            if selected is None:
+                selected = located.ecoregions_within(eco_src)
+            located.ecoregion_ids = np.union1d(selected, np.asarray(list(other_ecoregions), dtype=np.int64))
+            footprints = [extent_window(eco_id) for eco_id in located.ecoregion_ids if eco_id in extents]
+            located.footprints = [footprint for footprint in footprints if footprint is not None]
+        return located
+
+
+class LocatedRegion:
+
+    """ A Region on the forest grid: window (of the forest grid), the width, height, crs and transform of the output
+        grid, the ecoregion_ids that pass 1 covers and their footprints (windows of the forest grid).
+    """
+
+    def __init__(self, window, forest_src, selected=None, geometries=None):
+        self.window = window
+        self.forest_transform = forest_src.transform
+        self.forest_width, self.forest_height = forest_src.width, forest_src.height
+        self.crs = forest_src.crs
+        self.width, self.height = int(window.width), int(window.height)
+        self.transform = windows.transform(window, forest_src.transform)
+        self.selected = selected
+        self.geometries = geometries
+        self.ecoregion_ids = np.zeros(0, dtype=np.int64)
+        self.footprints = []
+
+    def output_windows(self, block_size):
+
+        """ (window of the forest grid, window of the output) of each window that tiles the output. """
+
+        return [(Window(self.window.col_off + window.col_off, self.window.row_off + window.row_off, window.width,
+                        window.height), window) for window in iter_windows(self.width, self.height, block_size)]
+
+    def pass_1_windows(self, block_size):
+
+        """ The windows of the forest grid (in iter_windows order) that overlap the footprints of pass 1. """
+
+        return [window for window in iter_windows(self.forest_width, self.forest_height, block_size)
+                if any(_overlaps(window, footprint) for footprint in self.footprints)]
+
+    def mask(self, window, eco_ids, eco_valid):
+
+        """ Which cells of a window of the forest grid are in the region, given their ecoregion IDs. """
+
+        if self.selected is not None:
+            return np.isin(eco_ids, self.selected) & eco_valid
+        if self.geometries is not None:
+            return features.geometry_mask(self.geometries, (int(window.height), int(window.width)),
+                                          windows.transform(window, self.forest_transform), invert=True)
+        return np.ones((int(window.height), int(window.width)), dtype=bool)
+
+    def ecoregions_within(self, eco_src, block_size=DEFAULT_BLOCK_SIZE):
+
+        """ IDs of the ecoregions that have cells in the region. """
+
+        found = set()
+        for window, _ in self.output_windows(block_size):
+            eco_ids, eco_valid = read_aligned(eco_src, self.forest_transform, window)
+            found.update(np.unique(eco_ids[eco_valid & self.mask(window, eco_ids, eco_valid)]).tolist())
+        return np.array(sorted(found), dtype=np.int64)
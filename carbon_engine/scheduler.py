@@ -0,0 +1,135 @@
+""" Process-pool tile scheduler.
+
+    Splits the work of a pass into per-window tasks and runs them either in the calling process or in a pool of worker
+    processes. Each worker opens its own inputs once (rasterio datasets can't be shared between processes). Results
+    come back in window order, so whatever is written or reduced from them doesn't depend on the number of workers.
+
+    In the calling process, the next tiles are read ahead: while tile N is being written or merged, threads (each
+    with its own inputs) already read and process tiles N+1..N+read_ahead. GDAL releases the GIL while it reads and
+    decompresses, so the reads of the next tiles overlap the work on the current one. Worker processes don't need
+    this: the other workers read while one computes.
+"""
+
+import collections
+import concurrent.futures
+import functools
+import os
+import threading
+
+from .profiling import count_tiles
+
+_worker_context = None
+
+
+def _init_worker(setup, setup_args):
+    global _worker_context
+    _worker_context = setup(*setup_args)
+
+
+def _run_task(task, window):
+    return task(_worker_context, window)
+
+
+DEFAULT_READ_AHEAD = 2
+
+
+def default_workers():
+
+    """ Number of worker processes used when none is given: one per CPU. """
+
+    return os.cpu_count() or 1
+
+
+class TileScheduler:
+
+    """ Runs per-window tasks with a given number of worker processes (1 runs them in the calling process).
+
+        setup(*setup_args) is called once per worker to create the context (e.g. open datasets) that is passed to
+        every task as task(context, window). If the context has a close() method it is called when a serial run ends.
+        At most max_pending results are held in memory at a time. read_ahead: number of tiles read ahead by threads
+        when workers is 1 (0 runs every task in the calling thread).
+    """
+
+    def __init__(self, workers=1, max_pending=None, read_ahead=DEFAULT_READ_AHEAD):
+        self.workers = max(1, int(workers))
+        self.max_pending = max_pending or 2 * self.workers
+        self.read_ahead = max(0, int(read_ahead))
+
+    def _map_serial(self, setup, setup_args, task, windows):
+        context = setup(*setup_args)
+        try:
+            for window in windows:
+                result = task(context, window)
+                count_tiles()
+                yield result
+        finally:
+            if hasattr(context, "close"):
+                context.close()
+
+    def _map_read_ahead(self, setup, setup_args, task, windows):
+        local = threading.local()
+        contexts = []
+        lock = threading.Lock()
+
+        def run(window):
+            if not hasattr(local, "context"):
+                local.context = setup(*setup_args)
+                with lock:
+                    contexts.append(local.context)
+            return task(local.context, window)
+
+        try:
+            with concurrent.futures.ThreadPoolExecutor(self.read_ahead, thread_name_prefix="read_ahead") as pool:
+                pending = collections.deque()
+                try:
+                    for window in windows:
+                        pending.append(pool.submit(run, window))
+                        if len(pending) > self.read_ahead:
+                            result = pending.popleft().result()
+                            count_tiles()
+                            yield result
+                    while pending:
+                        result = pending.popleft().result()
+                        count_tiles()
+                        yield result
+                finally:
+                    for future in pending:
+                        future.cancel()
+        finally:
+            for context in contexts:
+                if hasattr(context, "close"):
+                    context.close()
+
+    def map(self, setup, setup_args, task, windows):
+
+        """ Yields task(context, window) for each window, in window order. """
+
+        if self.workers == 1:
+            if self.read_ahead:
+                yield from self._map_read_ahead(setup, setup_args, task, windows)
+            else:
+                yield from self._map_serial(setup, setup_args, task, windows)
+            return
+
+        run = functools.partial(_run_task, task)
+        with concurrent.futures.ProcessPoolExecutor(self.workers, initializer=_init_worker,
+                                                    initargs=(setup, setup_args)) as pool:
+            pending = collections.deque()
+            for window in windows:
+                pending.append(pool.submit(run, window))
+                if len(pending) >= self.max_pending:
+                    result = pending.popleft().result()
+                    count_tiles()
+                    yield result
+            while pending:
+                result = pending.popleft().result()
+                count_tiles()
+                yield result
+
+    def reduce(self, setup, setup_args, task, windows, accumulator):
+
+        """ Merges the partial result of each window into accumulator (which must have a merge() method). """
+
+        for partial in self.map(setup, setup_args, task, windows):
+            accumulator.merge(partial)
+        return accumulator
@@ -0,0 +1,74 @@
+r""" Local staging of inputs on network shares.
+
+    The source rasters and the RESOLVE geodatabase live on a network share (\\loxodonta\gis\...), and a run reads
+    them several times (both passes of the fused pipeline, or every step of the stepwise run). Staging copies each
+    input once to a local disk and the run reads the copy, so each source byte crosses the network once.
+
+    The staging area is a StepCache: a copy is keyed by the path, size and modification time of the source, so it's
+    reused until the source changes, and the least recently used copies are evicted once the area grows beyond its
+    size limit. Copies keep the modification time of their source, so a re-staged copy has the same identity (and the
+    results cached from it stay valid).
+"""
+
+import glob
+import os
+import shutil
+
+from .cache import IGNORED_FILES, StepCache, existing_input
+
+
+def _companions(path):
+
+    """ Files next to a file input that are read with it: those with the same name up to the extension (the .shx,
+        .dbf and .prj of a shapefile, the .aux.xml, .ovr or world file of a raster).
+    """
+
+    if not os.path.isfile(path):
+        return []
+    stem = glob.escape(os.path.splitext(path)[0])
+    return [other for other in glob.glob(stem + ".*") if other != path and os.path.isfile(other)]
+
+
+def _copy(src, dst):
+
+    """ Copies a file or directory (with the modification times), via a temporary name so a partial copy is never
+        taken for a complete one.
+    """
+
+    partial = dst + ".partial"
+    if os.path.isdir(partial):
+        shutil.rmtree(partial)
+    if os.path.isdir(src):
+        shutil.copytree(src, partial, ignore=shutil.ignore_patterns(*IGNORED_FILES))
+    else:
+        shutil.copy2(src, partial)
+    os.replace(partial, dst)
+
+
+class StagingArea:
+
+    """ Local copies of inputs under staging_dir (e.g. on a local SSD), limited to max_bytes (None for no limit). """
+
+    def __init__(self, staging_dir, max_bytes=None):
+        self.cache = StepCache(staging_dir, max_bytes=max_bytes)
+
+    def stage(self, path):
+
+        """ Path of the local copy of path, copied if there is no copy of its current version yet. A feature class or
+            raster inside a file geodatabase stages the geodatabase (without its lock files). The version is that of
+            path itself, not of its companion files. Raises FileNotFoundError if path doesn't exist (and isn't in a
+            geodatabase), rather than staging whatever directory it would be in.
+        """
+
+        existing = existing_input(path)
+        entry = self.cache.entry("stage", [path])
+        local = entry.path(os.path.basename(existing))
+        if not entry.complete:
+            print(" -> Staging {}...".format(existing))
+            entry.create()
+            _copy(existing, local)
+            for companion in _companions(existing):
+                _copy(companion, entry.path(os.path.basename(companion)))
+            entry.commit()
+        relative = os.path.relpath(os.path.abspath(path), existing)
+        return local if relative == "." else os.path.join(local, relative)
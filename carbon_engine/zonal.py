@@ -0,0 +1,370 @@
+""" Streaming exact per-zone percentiles.
+
+    Replaces the ZonalStatistics PERCENTILE pass. Carbon is integer-quantized (Mg C/ha), so a histogram of the values in
+    each zone holds everything needed for an exact percentile. Histograms are accumulated block by block, so peak
+    memory depends on the block size, the number of zones and the value range, never on the raster size.
+
+    For continuous (float) carbon, ZonalSketch is an approximate, opt-in alternative: the same per-zone histogram over
+    logarithmic buckets (as in DDSketch), so every value it returns is within a relative accuracy of a value of the
+    zone, and sketches merge across windows and workers like the exact histograms.
+"""
+
+import csv
+import os
+
+import numpy as np
+import rasterio
+
+from .blocks import DEFAULT_BLOCK_SIZE, default_nodata, iter_windows, output_profile, read_aligned, read_indexed, \
+    window_indices
+from .profiling import count_tiles
+
+
+class ZonalHistogram:
+
+    """ Per-zone histogram of integer values. Rows follow the sorted zone_ids and column i counts the cells with value
+        value_min + i.
+    """
+
+    def __init__(self):
+        self.zone_ids = np.empty(0, dtype=np.int64)
+        self.value_min = 0
+        self.counts = np.zeros((0, 0), dtype=np.int64)
+
+    @property
+    def value_max(self):
+        return self.value_min + self.counts.shape[1] - 1
+
+    def empty(self):
+
+        """ New histogram with the same settings and no counts. """
+
+        return ZonalHistogram()
+
+    def save(self, path):
+
+        """ Saves the histogram to a compressed .npz file. """
+
+        np.savez_compressed(path, zone_ids=self.zone_ids, value_min=self.value_min, counts=self.counts)
+
+    @classmethod
+    def load(cls, path):
+
+        """ Loads a histogram saved with save(). """
+
+        histogram = cls()
+        with np.load(path) as data:
+            histogram.zone_ids = data["zone_ids"]
+            histogram.value_min = int(data["value_min"])
+            histogram.counts = data["counts"]
+        return histogram
+
+    def _extend(self, zone_ids, value_min, value_max):
+
+        """ Grows the table so that it covers zone_ids and the value range value_min..value_max. """
+
+        new_zone_ids = np.union1d(self.zone_ids, zone_ids)
+        if self.counts.shape[1]:
+            value_min, value_max = min(value_min, self.value_min), max(value_max, self.value_max)
+
+        if new_zone_ids.size == self.zone_ids.size and value_min == self.value_min and value_max == self.value_max:
+            return
+
+        counts = np.zeros((new_zone_ids.size, value_max - value_min + 1), dtype=np.int64)
+        if self.counts.size:
+            rows = np.searchsorted(new_zone_ids, self.zone_ids)
+            col = self.value_min - value_min
+            counts[rows, col:col + self.counts.shape[1]] = self.counts
+
+        self.zone_ids, self.value_min, self.counts = new_zone_ids, value_min, counts
+
+    def update(self, zones, values):
+
+        """ Adds one block of (zone, value) pairs. Both arrays must only hold the cells to be counted. """
+
+        if zones.size == 0:
+            return
+        if not np.issubdtype(values.dtype, np.integer):
+            raise ValueError("Exact zonal percentiles need integer values, got {} (use a ZonalSketch for float values)."
+                             .format(values.dtype))
+
+        zones = zones.astype(np.int64, copy=False)
+        values = values.astype(np.int64, copy=False)
+
+        rows = np.searchsorted(self.zone_ids, zones)
+        known = rows < self.zone_ids.size
+        known[known] = self.zone_ids[rows[known]] == zones[known]
+        value_min, value_max = int(values.min()), int(values.max())
+        if not known.all() or not self.counts.size or value_min < self.value_min or value_max > self.value_max:
+            self._extend(np.unique(zones[~known]), value_min, value_max)
+            rows = np.searchsorted(self.zone_ids, zones)
+
+        n_bins = self.counts.shape[1]
+        row_min, row_max = int(rows.min()), int(rows.max())
+        index = (rows - row_min) * n_bins + (values - self.value_min)
+        block_counts = np.bincount(index, minlength=(row_max - row_min + 1) * n_bins)
+        self.counts[row_min:row_max + 1] += block_counts.reshape(-1, n_bins)
+
+    def merge(self, other):
+
+        """ Adds the counts of another histogram (e.g. one accumulated over other blocks). """
+
+        if not other.counts.size:
+            return
+        self._extend(other.zone_ids, other.value_min, other.value_max)
+        rows = np.searchsorted(self.zone_ids, other.zone_ids)
+        col = other.value_min - self.value_min
+        self.counts[rows, col:col + other.counts.shape[1]] += other.counts
+
+    def subtract(self, other):
+
+        """ Removes the counts of a histogram that was merged into this one (e.g. of a window that is recomputed). """
+
+        if not other.counts.size:
+            return
+        rows = np.searchsorted(self.zone_ids, other.zone_ids)
+        col = other.value_min - self.value_min
+        width = other.counts.shape[1]
+        contained = (rows < self.zone_ids.size).all() and col >= 0 and col + width <= self.counts.shape[1]
+        if not contained or not np.array_equal(self.zone_ids[rows], other.zone_ids):
+            raise ValueError("Only a histogram that was merged into this one can be subtracted from it.")
+        self.counts[rows, col:col + width] -= other.counts
+
+    def _value_at_rank(self, cumulative, rank):
+
+        """ Value of the (0-based) rank-th smallest value in each zone. """
+
+        return self.value_min + (cumulative <= rank[:, None]).sum(axis=1)
+
+    def percentile(self, percentile, interpolation="NEAREST"):
+
+        """ Returns the percentile of the values in each zone (aligned with zone_ids) and a mask of the zones that
+            hold any values. Ranks follow numpy.percentile: rank = percentile / 100 * (n - 1); NEAREST takes the value
+            at the rounded rank and LINEAR interpolates between the two surrounding values.
+        """
+
+        cumulative = np.cumsum(self.counts, axis=1)
+        n = cumulative[:, -1] if self.counts.size else np.zeros(0, dtype=np.int64)
+        has_values = n > 0
+        rank = percentile / 100.0 * np.maximum(n - 1, 0)
+
+        if interpolation == "NEAREST":
+            values = self._value_at_rank(cumulative, np.rint(rank))
+        elif interpolation == "LINEAR":
+            lower = np.floor(rank)
+            lower_values = self._value_at_rank(cumulative, lower)
+            upper_values = self._value_at_rank(cumulative, np.ceil(rank))
+            values = lower_values + (rank - lower) * (upper_values - lower_values)
+        else:
+            raise ValueError("Unknown percentile interpolation type: {}".format(interpolation))
+
+        return values, has_values
+
+
+class ZonalSketch(ZonalHistogram):
+
+    """ Approximate per-zone quantile sketch for non-negative float values. Values are counted in logarithmic buckets
+        (gamma ** (k - 1), gamma ** k] with gamma = (1 + relative_accuracy) / (1 - relative_accuracy), so a percentile
+        is within relative_accuracy of a value of the zone at (about) the right rank; rank_error() tells how far off
+        the rank can be. Values below min_value are counted as 0. The columns of the inherited table are bucket keys.
+    """
+
+    def __init__(self, relative_accuracy=0.01, min_value=0.01):
+        super().__init__()
+        if not 0 < relative_accuracy < 1:
+            raise ValueError("The relative accuracy must be between 0 and 1, got {}.".format(relative_accuracy))
+        self.relative_accuracy = relative_accuracy
+        self.min_value = min_value
+        self._gamma = (1 + relative_accuracy) / (1 - relative_accuracy)
+        self._zero_key = int(np.ceil(np.log(min_value) / np.log(self._gamma))) - 1
+
+    def empty(self):
+        return ZonalSketch(self.relative_accuracy, self.min_value)
+
+    def save(self, path):
+        np.savez_compressed(path, zone_ids=self.zone_ids, value_min=self.value_min, counts=self.counts,
+                            relative_accuracy=self.relative_accuracy, min_value=self.min_value)
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path) as data:
+            sketch = cls(float(data["relative_accuracy"]), float(data["min_value"]))
+            sketch.zone_ids = data["zone_ids"]
+            sketch.value_min = int(data["value_min"])
+            sketch.counts = data["counts"]
+        return sketch
+
+    def keys(self, values):
+
+        """ Bucket key of each value. """
+
+        values = np.asarray(values, dtype=np.float64)
+        if values.size and values.min() < 0:
+            raise ValueError("Quantile sketches need non-negative values, got {}.".format(values.min()))
+        keys = np.ceil(np.log(np.maximum(values, self.min_value)) / np.log(self._gamma)).astype(np.int64)
+        keys[values < self.min_value] = self._zero_key
+        return keys
+
+    def bucket_values(self, keys):
+
+        """ Value that represents each bucket: within relative_accuracy of any value in it. """
+
+        values = 2 * self._gamma ** np.asarray(keys, dtype=np.float64) / (self._gamma + 1)
+        return np.where(keys == self._zero_key, 0.0, values)
+
+    def update(self, zones, values):
+
+        """ Adds one block of (zone, value) pairs. Both arrays must only hold the cells to be counted. """
+
+        super().update(zones, self.keys(values))
+
+    def merge(self, other):
+        if (other.relative_accuracy, other.min_value) != (self.relative_accuracy, self.min_value):
+            raise ValueError("Only sketches with the same relative accuracy and minimum value can be merged.")
+        super().merge(other)
+
+    def _value_at_rank(self, cumulative, rank):
+        return self.bucket_values(super()._value_at_rank(cumulative, rank))
+
+    def rank_error(self, percentile):
+
+        """ Largest possible difference (as a fraction of the cells of the zone) between the rank of the NEAREST
+            percentile of each zone and the true rank of the value returned for it: the other values of its bucket.
+        """
+
+        if not self.counts.size:
+            return np.zeros(self.zone_ids.size)
+        cumulative = np.cumsum(self.counts, axis=1)
+        n = cumulative[:, -1]
+        rank = np.rint(percentile / 100.0 * np.maximum(n - 1, 0))
+        bucket = np.minimum((cumulative <= rank[:, None]).sum(axis=1), self.counts.shape[1] - 1)
+        after = np.take_along_axis(cumulative, bucket[:, None], axis=1)[:, 0]
+        before = after - np.take_along_axis(self.counts, bucket[:, None], axis=1)[:, 0]
+        return np.maximum(rank - before, after - 1 - rank) / np.maximum(n, 1)
+
+
+def load_histogram(path):
+
+    """ Loads a ZonalHistogram or a ZonalSketch saved with save(). """
+
+    with np.load(path) as data:
+        sketch = "relative_accuracy" in data.files
+    return ZonalSketch.load(path) if sketch else ZonalHistogram.load(path)
+
+
+def write_rank_errors(path, sketch, percentile, columns=None):
+
+    """ Writes the rank error of each zone of an approximate run to a CSV file and prints a summary. columns maps
+        extra column names to per-zone values (aligned with sketch.zone_ids), e.g. the decoded ecoregion IDs.
+    """
+
+    values, has_values = sketch.percentile(percentile)
+    rank_errors = sketch.rank_error(percentile)
+    cells = sketch.counts.sum(axis=1)
+    columns = columns or {}
+    with open(path, "w", newline="") as f:
+        writer = csv.writer(f)
+        writer.writerow(["zone_id"] + list(columns) + ["cells", "threshold", "rank_error"])
+        for i in np.flatnonzero(has_values):
+            writer.writerow([int(sketch.zone_ids[i])] + [int(column[i]) for column in columns.values()] +
+                            [int(cells[i]), float(values[i]), float(rank_errors[i])])
+
+    if has_values.any():
+        print(" -> Approximate {} percentile: rank error at most {:.3%} (median {:.3%}) over {} zones, see {}".format(
+            percentile, rank_errors[has_values].max(), np.median(rank_errors[has_values]), int(has_values.sum()),
+            path))
+
+
+def paint_zone_values(zone_ids, zone_values, zones, valid, nodata):
+
+    """ Writes the value of each zone to every valid cell of that zone. Cells in zones without a value get nodata. """
+
+    out = np.full(zones.shape, nodata, dtype=zone_values.dtype)
+    if not zone_ids.size:
+        return out
+
+    index = np.minimum(np.searchsorted(zone_ids, zones), zone_ids.size - 1)
+    found = valid & (zone_ids[index] == zones)
+    out[found] = zone_values[index[found]]
+    return out
+
+
+def _describe(histogram=None, relative_accuracy=None):
+
+    """ "exact histograms" or "sketches with a relative accuracy of ...", of a histogram or a relative accuracy. """
+
+    if histogram is not None:
+        relative_accuracy = getattr(histogram, "relative_accuracy", None)
+    if relative_accuracy is None:
+        return "exact histograms"
+    return "sketches with a relative accuracy of {}".format(relative_accuracy)
+
+
+def zonal_histogram(zones, values, block_size=DEFAULT_BLOCK_SIZE, relative_accuracy=None):
+
+    """ Per-zone histogram of the values raster, aligned on the grid of the zones raster (cells that are NoData in
+        either are left out), or per-zone ZonalSketches with relative_accuracy.
+    """
+
+    histogram = ZonalSketch(relative_accuracy) if relative_accuracy else ZonalHistogram()
+    with rasterio.open(zones) as zones_src, rasterio.open(values) as values_src:
+        for window in iter_windows(zones_src.width, zones_src.height, block_size):
+            count_tiles()
+            zone_block, zone_valid = read_indexed(zones_src, *window_indices(window))
+            value_block, value_valid = read_aligned(values_src, zones_src.transform, window)
+            valid = zone_valid & value_valid
+            histogram.update(zone_block[valid], value_block[valid])
+    return histogram
+
+
+def zonal_percentile(zones, values, output, percentile, interpolation="AUTO_DETECT", block_size=DEFAULT_BLOCK_SIZE,
+                     relative_accuracy=None, sketch_path=None):
+
+    """ Block-windowed equivalent of ZonalStatistics(statistics_type="PERCENTILE", ignore_nodata="DATA") with the zone
+        raster as snap raster. Writes the percentile of each zone to all of its cells on the zone grid. Needs no
+        ArcGIS license.
+
+        relative_accuracy: if given, per-zone ZonalSketches are used instead of exact histograms (e.g. for float
+            carbon). The rank error of each zone is written next to output (_rank_error.csv).
+        sketch_path: .npz file of the sketches (or histograms). If it holds those of the same kind and relative
+            accuracy they are loaded from it instead of being accumulated from the rasters, otherwise they are saved
+            to it, e.g. for a rerun with another percentile.
+    """
+
+    with rasterio.open(zones) as zones_src, rasterio.open(values) as values_src:
+
+        values_dtype = np.dtype(values_src.dtypes[0])
+        if interpolation == "AUTO_DETECT":
+            interpolation = "NEAREST" if np.issubdtype(values_dtype, np.integer) else "LINEAR"
+
+        histogram = None
+        if sketch_path and os.path.exists(sketch_path):
+            print(" -> Loading per-zone histograms from {}...".format(sketch_path))
+            histogram = load_histogram(sketch_path)
+            if getattr(histogram, "relative_accuracy", None) != relative_accuracy:
+                print(" -> {} holds {}, not {}: accumulating them again".format(
+                    sketch_path, _describe(histogram), _describe(relative_accuracy=relative_accuracy)))
+                histogram = None
+        if histogram is None:
+            print(" -> Accumulating per-zone {}...".format("sketches" if relative_accuracy else "histograms"))
+            histogram = zonal_histogram(zones, values, block_size, relative_accuracy)
+            if sketch_path:
+                histogram.save(sketch_path)
+
+        print(" -> Calculating the {} percentile of {} zones...".format(percentile, histogram.zone_ids.size))
+        thresholds, has_values = histogram.percentile(percentile, interpolation)
+        if isinstance(histogram, ZonalSketch):
+            write_rank_errors(os.path.splitext(output)[0] + "_rank_error.csv", histogram, percentile)
+        exact = interpolation == "NEAREST" and not isinstance(histogram, ZonalSketch)
+        dtype = values_dtype if exact else np.dtype(np.float32)
+        thresholds = thresholds.astype(dtype)
+        nodata = values_src.nodata if values_src.nodata is not None else default_nodata(dtype)
+        zone_ids = histogram.zone_ids[has_values]
+        thresholds = thresholds[has_values]
+
+        print(" -> Writing thresholds...")
+        with rasterio.open(output, "w", **output_profile(zones_src, dtype, nodata)) as dst:
+            for window in iter_windows(zones_src.width, zones_src.height, block_size):
+                count_tiles()
+                zone_block, zone_valid = read_indexed(zones_src, *window_indices(window))
+                dst.write(paint_zone_values(zone_ids, thresholds, zone_block, zone_valid, nodata), 1, window=window)
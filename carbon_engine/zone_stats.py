@@ -0,0 +1,245 @@
+""" Per-zone statistics store.
+
+    The per-zone histograms accumulated for the percentile thresholds hold everything needed for any other percentile
+    and for the usual summary statistics of a zone, so they are kept in a compact columnar .npz file: one row per zone
+    (ecoregion x forest class) with its decoded ecoregion ID, name and biome, forest class, cell count, sum, mean,
+    minimum and maximum, plus the non-empty bins of its histogram. ZoneStats answers lookups and recomputes percentiles
+    for all zones in milliseconds without reading the rasters again:
+
+        stats = ZoneStats.load("high_priority_forest_carbon_zone_stats.npz")
+        stats.percentile(75)                        # aligned with stats.zone_ids
+        stats.table([50, 90], stats.select(biome="Temperate Conifer Forests"))
+        stats.write_csv("zone_stats.csv", [50, 75])
+
+    or from the command line: python -m carbon_engine.query STORE --percentiles 50 75 --csv zone_stats.csv
+
+    Sums and means are of the cell values (Mg C/ha). For approximate runs (ZonalSketch) the bins are sketch buckets, so
+    the statistics and percentiles are within the relative accuracy of the sketch.
+"""
+
+import csv
+import json
+
+import numpy as np
+
+from .ecoregions import open_ecoregions
+from .kernels import ZONE_CLASS_SLOTS, decode_zones
+from .zonal import ZonalHistogram, ZonalSketch
+
+
+def ecoregion_names(ecoregions):
+
+    """ ID -> {"name", "biome"} table of an ecoregion grid, or None for a rasterized ecoregions raster (no table). """
+
+    with open_ecoregions(ecoregions) as eco_src:
+        return getattr(eco_src, "ecoregions", None)
+
+
+class ZoneStats:
+
+    """ Statistics of the zones that hold any values, sorted by zone ID.
+
+        Columns (aligned with zone_ids): ecoregion_ids and forest_classes (-1 if the zone IDs aren't ECO_ID * 8 +
+        forest class, e.g. Combine values), ecoregion_names and biomes ("" without an ecoregion table), cells, sums,
+        means, minimums and maximums. The histogram of zone i is bins[offsets[i]:offsets[i + 1]] (values, or bucket
+        keys of a sketch, ascending) with bin_counts[offsets[i]:offsets[i + 1]] cells each.
+    """
+
+    def __init__(self, zone_ids, bins, bin_counts, offsets, relative_accuracy=None, min_value=0.01, ecoregions=None,
+                 encoded=True, metadata=None):
+        self.zone_ids = np.asarray(zone_ids, dtype=np.int64)
+        self.bins = np.asarray(bins, dtype=np.int64)
+        self.bin_counts = np.asarray(bin_counts, dtype=np.int64)
+        self.offsets = np.asarray(offsets, dtype=np.int64)
+        self.relative_accuracy = relative_accuracy
+        self.min_value = min_value
+        self.encoded = encoded
+        self.metadata = metadata or {}
+
+        if encoded:
+            self.ecoregion_ids, self.forest_classes = decode_zones(self.zone_ids)
+        else:
+            self.ecoregion_ids = self.forest_classes = np.full(self.zone_ids.size, -1, dtype=np.int64)
+        ecoregions = ecoregions or {}
+        rows = [ecoregions.get(int(eco_id), {}) for eco_id in self.ecoregion_ids]
+        self.ecoregion_names = np.array([row.get("name", "") for row in rows], dtype=str)
+        self.biomes = np.array([row.get("biome", "") for row in rows], dtype=str)
+
+        self.values = self._bin_values(self.bins)
+        self._cumulative = np.cumsum(self.bin_counts)
+        starts = self.offsets[:-1]
+        if self.zone_ids.size:
+            self.cells = np.add.reduceat(self.bin_counts, starts)
+            self.sums = np.add.reduceat(self.values * self.bin_counts, starts).astype(np.float64)
+            self.minimums = self.values[starts]
+            self.maximums = self.values[self.offsets[1:] - 1]
+        else:
+            self.cells = np.zeros(0, dtype=np.int64)
+            self.sums = np.zeros(0)
+            self.minimums = self.maximums = self.values[:0]
+        self.means = self.sums / np.maximum(self.cells, 1)
+        self._before = self._cumulative[starts] - self.bin_counts[starts] if self.zone_ids.size else self.cells
+
+    @property
+    def approximate(self):
+        return self.relative_accuracy is not None
+
+    def _bin_values(self, bins):
+        if self.approximate:
+            return ZonalSketch(self.relative_accuracy, self.min_value).bucket_values(bins)
+        return bins
+
+    @classmethod
+    def from_histogram(cls, histogram, ecoregions=None, encoded=True, metadata=None):
+
+        """ Statistics of a ZonalHistogram or ZonalSketch. ecoregions: optional ID -> {"name", "biome"} table (see
+            ecoregion_names). encoded: whether the zone IDs are ECO_ID * 8 + forest class.
+        """
+
+        counts, zone_ids = np.zeros((0, 0), dtype=np.int64), histogram.zone_ids[:0]
+        if histogram.counts.size:
+            nonempty = histogram.counts.sum(axis=1) > 0
+            counts, zone_ids = histogram.counts[nonempty], histogram.zone_ids[nonempty]
+        rows, cols = np.nonzero(counts)  # Row-major: grouped by zone, ascending bins within a zone.
+        offsets = np.concatenate([[0], np.cumsum(np.count_nonzero(counts, axis=1))])
+        sketch = isinstance(histogram, ZonalSketch)
+        return cls(zone_ids, histogram.value_min + cols, counts[rows, cols], offsets,
+                   relative_accuracy=histogram.relative_accuracy if sketch else None,
+                   min_value=histogram.min_value if sketch else 0.01,
+                   ecoregions=ecoregions, encoded=encoded, metadata=metadata)
+
+    @classmethod
+    def from_combine(cls, histogram, combine_lookup, ecoregions, metadata=None):
+
+        """ Statistics of a histogram of the zones of the arcpy Combine output (keyed by Combine value), keyed like
+            those of the engine by ECO_ID * 8 + forest class. combine_lookup maps each Combine value to its
+            (ecoregion name, forest class), from the Combine and PolygonToRaster attribute tables (see zone_parity),
+            and ecoregions is the ID -> {"name", "biome"} table the names are looked up in (see read_ecoregion_table).
+        """
+
+        eco_ids = {row.get("name"): eco_id for eco_id, row in ecoregions.items()}
+        zone_ids = np.empty(histogram.zone_ids.size, dtype=np.int64)
+        for i, value in enumerate(histogram.zone_ids):
+            name, forest_class = combine_lookup[int(value)]
+            if name not in eco_ids:
+                raise ValueError("Combine value {} is in an unknown ecoregion: {}".format(value, name))
+            zone_ids[i] = eco_ids[name] * ZONE_CLASS_SLOTS + int(forest_class)
+
+        recoded = histogram.empty()
+        recoded.zone_ids = np.unique(zone_ids)
+        recoded.value_min = histogram.value_min
+        recoded.counts = np.zeros((recoded.zone_ids.size, histogram.counts.shape[1]), dtype=np.int64)
+        if histogram.counts.size:
+            np.add.at(recoded.counts, np.searchsorted(recoded.zone_ids, zone_ids), histogram.counts)
+        return cls.from_histogram(recoded, ecoregions, metadata=metadata)
+
+    def histogram(self):
+
+        """ The (dense) ZonalHistogram or ZonalSketch the statistics were made from, e.g. to merge it with others. """
+
+        histogram = ZonalSketch(self.relative_accuracy, self.min_value) if self.approximate else ZonalHistogram()
+        histogram.zone_ids = self.zone_ids.copy()
+        if self.bins.size:
+            histogram.value_min = int(self.bins.min())
+            histogram.counts = np.zeros((self.zone_ids.size, int(self.bins.max()) - histogram.value_min + 1),
+                                        dtype=np.int64)
+            rows = np.repeat(np.arange(self.zone_ids.size), np.diff(self.offsets))
+            histogram.counts[rows, self.bins - histogram.value_min] = self.bin_counts
+        return histogram
+
+    def save(self, path):
+
+        """ Saves the store to a compressed .npz file (one array per column). """
+
+        np.savez_compressed(
+            path, zone_ids=self.zone_ids, ecoregion_ids=self.ecoregion_ids, forest_classes=self.forest_classes,
+            ecoregion_names=self.ecoregion_names, biomes=self.biomes, cells=self.cells, sums=self.sums,
+            means=self.means, minimums=self.minimums, maximums=self.maximums, bins=self.bins,
+            bin_counts=self.bin_counts, offsets=self.offsets,
+            relative_accuracy=np.nan if self.relative_accuracy is None else self.relative_accuracy,
+            min_value=self.min_value, encoded=self.encoded, metadata=json.dumps(self.metadata, default=str))
+
+    @classmethod
+    def load(cls, path):
+
+        """ Loads a store saved with save(). """
+
+        with np.load(path) as data:
+            relative_accuracy = float(data["relative_accuracy"])
+            ecoregions = {int(eco_id): {"name": str(name), "biome": str(biome)}
+                          for eco_id, name, biome in zip(data["ecoregion_ids"], data["ecoregion_names"], data["biomes"])}
+            return cls(data["zone_ids"], data["bins"], data["bin_counts"], data["offsets"],
+                       relative_accuracy=None if np.isnan(relative_accuracy) else relative_accuracy,
+                       min_value=float(data["min_value"]), ecoregions=ecoregions, encoded=bool(data["encoded"]),
+                       metadata=json.loads(str(data["metadata"])))
+
+    def _value_at_rank(self, rank, rows):
+        index = np.searchsorted(self._cumulative, self._before[rows] + rank, side="right")
+        return self.values[index]
+
+    def percentile(self, percentile, interpolation="NEAREST", rows=None):
+
+        """ Percentile of the values of each zone (of the rows given, default all), like ZonalHistogram.percentile:
+            rank = percentile / 100 * (n - 1), NEAREST takes the value at the rounded rank, LINEAR interpolates.
+        """
+
+        rows = np.arange(self.zone_ids.size) if rows is None else np.asarray(rows)
+        rank = percentile / 100.0 * np.maximum(self.cells[rows] - 1, 0)
+        if interpolation == "NEAREST":
+            return self._value_at_rank(np.rint(rank), rows)
+        if interpolation == "LINEAR":
+            lower = np.floor(rank)
+            lower_values = self._value_at_rank(lower, rows)
+            return lower_values + (rank - lower) * (self._value_at_rank(np.ceil(rank), rows) - lower_values)
+        raise ValueError("Unknown percentile interpolation type: {}".format(interpolation))
+
+    def select(self, ecoregion=None, forest_class=None, biome=None):
+
+        """ Rows of the zones of an ecoregion (ID or name), forest class and/or biome. """
+
+        keep = np.ones(self.zone_ids.size, dtype=bool)
+        if ecoregion is not None:
+            if isinstance(ecoregion, str):
+                keep &= self.ecoregion_names == ecoregion
+            else:
+                keep &= self.ecoregion_ids == int(ecoregion)
+        if forest_class is not None:
+            keep &= self.forest_classes == int(forest_class)
+        if biome is not None:
+            keep &= self.biomes == biome
+        return np.flatnonzero(keep)
+
+    def zone(self, ecoregion, forest_class):
+
+        """ Row of one zone, or None if it holds no values. """
+
+        rows = self.select(ecoregion, forest_class)
+        return int(rows[0]) if rows.size else None
+
+    def table(self, percentiles=(), rows=None):
+
+        """ Statistics of the zones (of the rows given, default all) as a list of dicts, with a p<percentile> column
+            for each percentile.
+        """
+
+        rows = np.arange(self.zone_ids.size) if rows is None else np.asarray(rows)
+        columns = {
+            "zone_id": self.zone_ids[rows], "ecoregion_id": self.ecoregion_ids[rows],
+            "ecoregion_name": self.ecoregion_names[rows], "biome": self.biomes[rows],
+            "forest_class": self.forest_classes[rows], "cells": self.cells[rows], "sum": self.sums[rows],
+            "mean": self.means[rows], "min": self.minimums[rows], "max": self.maximums[rows],
+        }
+        for percentile in percentiles:
+            columns["p{:g}".format(percentile)] = self.percentile(percentile, rows=rows)
+        return [{name: values[i].item() for name, values in columns.items()} for i in range(rows.size)]
+
+    def write_csv(self, path, percentiles=(), rows=None):
+
+        """ Writes table() to a CSV file. """
+
+        table = self.table(percentiles, rows)
+        with open(path, "w", newline="") as f:
+            writer = csv.DictWriter(f, fieldnames=list(table[0]) if table else ["zone_id"])
+            writer.writeheader()
+            writer.writerows(table)
+
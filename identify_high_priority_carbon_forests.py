@@ -12,13 +12,31 @@
 # with open(script_path, 'r') as f:
 #    script_code = f.read()
 #    exec(script_code)
+#
+# Or from a standalone Python (e.g. ArcGIS Pro's propy), optionally with a run spec file overriding the settings below:
+# propy identify_high_priority_carbon_forests.py run_spec.toml
+#
+# Importing this module only defines the settings and steps; main() runs the analysis (and can be called again, each
+# call starts from the settings below).
 ########################################################################################################################
 
 import arcpy
 from arcpy.sa import Raster
+import copy
 import datetime
 import os
-import csv
+import sys
+import types
+
+# The NumPy engine (carbon_engine) lives next to this script.
+try:
+    script_dir = os.path.dirname(os.path.abspath(__file__))
+except NameError:  # exec'd from the ArcGIS Pro Python window (see above).
+    script_dir = os.path.dirname(os.path.abspath(script_path))
+sys.path.insert(0, script_dir)
+
+import carbon_engine
+import carbon_engine.batch
 
 # Source Data
 above_ground_carbon = r"\\loxodonta\gis\Source_Data\biota\global\Global_Aboveground_and_Belowground_Biomass_Carbon_Density\2010\Global_Maps_C_Density_2010_1763\data\aboveground_biomass_carbon_2010.tif"
@@ -31,8 +49,25 @@ clip_inputs_for_testing = False
 percentile_threshold = 50
 carbon_type = "belowground"  # Options: "aboveground", "belowground", or "combined"
 version_label = "50th_percentile_belowground"
-
-# For final clipping/filtering function (not used).
+percentile_engine = "numpy"  # Options: "numpy" (block-windowed, no ArcGIS license needed) or "arcpy"
+use_fused_pipeline = True  # Run steps 1-7 as two streaming passes without writing intermediate rasters.
+write_intermediates = False  # Fused pipeline only: also write the intermediate rasters (for debugging).
+sweep = []  # Fused pipeline only: (carbon_type, percentile) runs to do in one go, e.g. [("belowground", 50), ("combined", 75)]
+workers = 1  # Fused pipeline worker processes. Use more from a standalone Python (python -m carbon_engine --workers).
+read_ahead = 2  # Fused pipeline with one worker: tiles read ahead by threads while a tile is processed (0 to profile the tiles).
+staging_dir = None  # Local disk (e.g. r"D:\Staging") to copy the source data to once, instead of reading it from the share in every step.
+staging_max_gb = 500  # Size limit of staging_dir (least recently used copies are evicted first).
+cache_max_gb = 200  # Size limit of the intermediate results cache (least recently used results are evicted first).
+incremental = False  # Fused pipeline only: recompute only the tiles and zones that changed since the last incremental run.
+changed_bounds = None  # Incremental only: (left, bottom, right, top) of the edited area. Not needed when only ecoregions were edited.
+approximate_percentiles = None  # NumPy engine: e.g. 0.01 for approximate per-zone quantile sketches (float carbon products).
+check_zone_parity = False  # Stepwise only: check the zones of the NumPy engine (ECO_ID based) against the Combine output.
+filter_final_output = False  # Also write the final output filtered to the biomes and ecoregions of interest below.
+checkpoint = True  # Fused pipeline only: journal progress so that a rerun after a crash resumes where it stopped (off with write_intermediates).
+region = None  # Fused pipeline only: compute just a region, a (left, bottom, right, top) bbox, a list of ecoregion names or a polygon layer.
+profile_step = None  # Name of one step to run under cProfile, e.g. "calc_percentile_threshold" or "pass_2" (fused).
+
+# For the final filtering (filter_final_output).
 biomes_to_include = (
     "Boreal Forests/Taiga",
     "Temperate Broadleaf & Mixed Forests",
@@ -42,44 +77,126 @@ biomes_to_include = (
     "Tropical & Subtropical Moist Broadleaf Forests",
 )
 
-# For final clipping/filtering function (not used).
+# For the final filtering (filter_final_output).
 ecoregions_of_interest_csv = r"P:\Projects3\Canopy_Global_Forest_Carbon_Mapping_mike_gough\Tasks\High_Priority_Carbon_Forests_Analysis\Docs\ecoregions_of_interest.csv"
 
 # Data Directory
 data_dir = os.path.join(r"P:\Projects3\Canopy_Global_Forest_Carbon_Mapping_mike_gough\Tasks\High_Priority_Carbon_Forests_Analysis\Data")
 
-if clip_inputs_for_testing:
-    # Set Test Directory
-    data_dir = os.path.join(data_dir, "Test")
-    # Clipping Features for Testing
-    clipping_features = os.path.join(data_dir, "Inputs\Inputs.gdb\ecoregion_subset_extent")
-    # Append to version label
-    version_label += "_subset"
+# The settings above, which a run spec file can override (see configure).
+config_names = (
+    "above_ground_carbon", "below_ground_carbon", "forest", "biomes_and_ecoregions", "clip_inputs_for_testing",
+    "percentile_threshold", "carbon_type", "version_label", "percentile_engine", "use_fused_pipeline",
+    "write_intermediates", "sweep", "workers", "read_ahead", "staging_dir", "staging_max_gb", "cache_max_gb",
+    "incremental", "changed_bounds", "approximate_percentiles", "check_zone_parity", "filter_final_output",
+    "checkpoint", "region", "profile_step", "biomes_to_include", "ecoregions_of_interest_csv", "data_dir",
+)
+
+
+# Reclassification of the FAO structural forms into the forest classes specified by Jim Strittholt (step 3).
+forest_remap = "1 1;2 1;3 1;4 2;5 2;6 2;7 3;8 3;9 3;10 4;11 4;12 4"
+
+# Ecoregion fields: names for the arcpy zones (step 4), integer IDs for the NumPy engine (zone = ECO_ID * 8 + forest class).
+ecoregions_value_field = "ECO_NAME"
+ecoregions_id_field = "ECO_ID"
+
+
+def configure(spec=None):
+
+    """ The settings above, overridden by those of the run spec file spec if given (TOML, or YAML with PyYAML, e.g.
+        percentile_threshold = 75 and carbon_type = "combined"), plus the directories and outputs they lead to. Returns
+        them as a namespace and leaves the module settings as they are, so each call starts from the same defaults.
+        Batches of runs are run with carbon_engine.batch.
+    """
+
+    settings = {name: copy.deepcopy(globals()[name]) for name in config_names}
+    if spec:
+        runs = carbon_engine.batch.read_spec_file(spec)
+        if len(runs) != 1:
+            raise ValueError("{} holds {} runs, the script runs one (see python -m carbon_engine.batch)".format(
+                spec, len(runs)))
+        for name, value in runs[0][1].items():
+            if name not in config_names:
+                raise ValueError("{}: unknown setting {}".format(spec, name))
+            settings[name] = value
+    config = types.SimpleNamespace(**settings)
 
-# Data Sub-Directories
-input_dir = os.path.join(data_dir, "Inputs")
-input_gdb = os.path.join(data_dir, "Inputs")
+    config.clipping_features = None
+    if config.clip_inputs_for_testing:
+        # Set Test Directory
+        config.data_dir = os.path.join(config.data_dir, "Test")
+        # Clipping Features for Testing
+        config.clipping_features = os.path.join(config.data_dir, r"Inputs\Inputs.gdb\ecoregion_subset_extent")
+        # Append to version label
+        config.version_label += "_subset"
 
-intermediate_dir = os.path.join(data_dir, "Intermediate")
-intermediate_gdb = os.path.join(data_dir, r"Intermediate\Intermediate.gdb")
+    # Data Sub-Directories
+    config.input_dir = os.path.join(config.data_dir, "Inputs")
+    config.input_gdb = os.path.join(config.data_dir, "Inputs")
 
-output_dir = os.path.join(data_dir, "Outputs")
-output_gdb = os.path.join(data_dir, r"Outputs\Outputs.gdb")
+    config.intermediate_dir = os.path.join(config.data_dir, "Intermediate")
+    config.intermediate_gdb = os.path.join(config.data_dir, r"Intermediate\Intermediate.gdb")
 
-scratch_dir = os.path.join(data_dir, r"Inputs\Scratch")
-scratch_gdb = os.path.join(data_dir, r"Inputs\Scratch\Scratch.gdb")
+    config.output_dir = os.path.join(config.data_dir, "Outputs")
+    config.output_gdb = os.path.join(config.data_dir, r"Outputs\Outputs.gdb")
 
-# Final Output
-final_output = output_dir + os.sep + "high_priority_forest_carbon_" + version_label + ".tif"
-final_output_filtered = output_dir + os.sep + "high_priority_forest_carbon_filtered_" + version_label + ".tif"
+    config.scratch_dir = os.path.join(config.data_dir, r"Inputs\Scratch")
+    config.scratch_gdb = os.path.join(config.data_dir, r"Inputs\Scratch\Scratch.gdb")
 
-arcpy.env.overwriteOutput = True
+    # Intermediate results are cached under a hash of their inputs and parameters, so they are only rebuilt when something
+    # they depend on changes.
+    config.cache_dir = os.path.join(config.intermediate_dir, "Cache")
+    config.manifest_dir = os.path.join(config.intermediate_dir, "Manifest")
+    config.checkpoint_dir = os.path.join(config.intermediate_dir, "Checkpoint")
 
-start_time = datetime.datetime.now()
-print("\nStart Time: " + str(start_time))
+    # Final Output
+    label = config.version_label
+    config.final_output = config.output_dir + os.sep + "high_priority_forest_carbon_" + label + ".tif"
+    config.run_report = config.output_dir + os.sep + "high_priority_forest_carbon_" + label + "_run_report.json"
+    config.final_output_filtered = config.output_dir + os.sep + "high_priority_forest_carbon_filtered_" + label + ".tif"
 
+    # Per-zone statistics and histograms (query with carbon_engine.ZoneStats.load or python -m carbon_engine.query). A
+    # sweep writes one per carbon type (high_priority_forest_carbon_zone_stats_<carbon_type>.npz).
+    config.zone_stats = config.output_dir + os.sep + "high_priority_forest_carbon_zone_stats_" + label + ".npz"
+
+    # Outputs as saved by ArcGIS, before they are rewritten as Cloud Optimized GeoTIFFs.
+    config.final_output_arcgis = config.intermediate_dir + os.sep + "high_priority_forest_carbon_arcgis_" + label + ".tif"
+    return config
+
+
+def run_step(step, *args):
+
+    """ Runs a step, recording its time and resources in the run report. """
+
+    with carbon_engine.profiling.step(step.__name__):
+        return step(*args)
+
+
+def run_cached_step(cache_entry, step, *args):
+
+    """ Runs a step, unless the cache already holds its results for the same inputs and parameters. """
+
+    if cache_entry.complete:
+        print("\n* {}: using cached results (inputs and parameters unchanged)".format(step.__name__))
+        return
+
+    cache_entry.create()
+    run_step(step, *args)
+    cache_entry.commit()
+
+
+def stage_inputs(staging_dir, staging_max_gb, *paths):
+
+    """ Copies the source data to staging_dir (unless it holds a copy of the current version) and returns the paths of
+        the copies.
+    """
 
-def clip_for_testing(above_ground_carbon, below_ground_carbon, forest, clipping_features):
+    print("\nStaging the source data...")
+    staging = carbon_engine.StagingArea(staging_dir, max_bytes=staging_max_gb * 1024 ** 3)
+    return [staging.stage(path) for path in paths]
+
+
+def clip_for_testing(above_ground_carbon, below_ground_carbon, forest, clipping_features, input_dir, version_label):
 
     """ Clips the carbon and the forest pixels to a subset of ecoregions for testing on a smaller extent. """
 
@@ -111,31 +228,18 @@ def clip_for_testing(above_ground_carbon, below_ground_carbon, forest, clipping_
     return above_ground_carbon_clip, below_ground_carbon_clip, forest_clip
 
 
-if carbon_type == "combined":
-    carbon_to_use = intermediate_dir + os.sep + "combined_carbon_" + version_label + ".tif"
-
-    def combine_above_and_below_carbon(above_ground_carbon, below_ground_carbon):
-
-        """ 1. Combines above and below ground carbon by adding them together. """
+def combine_above_and_below_carbon(above_ground_carbon, below_ground_carbon, combined_carbon):
 
-        print("\n1. Combining aboveground and belowground carbon...")
+    """ 1. Combines above and below ground carbon by adding them together. """
 
-        with arcpy.EnvManager(snapRaster=above_ground_carbon):
-            combined_carbon_r = arcpy.sa.Plus(above_ground_carbon, below_ground_carbon)
-            combined_carbon_r.save(carbon_to_use)
+    print("\n1. Combining aboveground and belowground carbon...")
 
-elif carbon_type == "aboveground":
-    print("\n* Evaluating Aboveground Carbon only")
-    carbon_to_use = above_ground_carbon
-
-elif carbon_type == "belowground":
-    print("\n* Evaluating Belowground Carbon only")
-    carbon_to_use = below_ground_carbon
-
-carbon_clipped_to_forest = intermediate_dir + os.path.sep + "carbon_clipped_to_forest_" + version_label + ".tif"
+    with arcpy.EnvManager(snapRaster=above_ground_carbon):
+        combined_carbon_r = arcpy.sa.Plus(above_ground_carbon, below_ground_carbon)
+        combined_carbon_r.save(combined_carbon)
 
 
-def clip_carbon_to_forest_pixels(carbon, forest):
+def clip_carbon_to_forest_pixels(carbon, forest, carbon_clipped_to_forest):
 
     """ 2. Clips carbon to the forest pixels. Not technically necessary since unclipped version can be used for
         zonal stats.
@@ -154,11 +258,7 @@ def clip_carbon_to_forest_pixels(carbon, forest):
         forest_carbon_r.save(carbon_clipped_to_forest)
 
 
-forest_reclassified = intermediate_gdb + os.path.sep + "forest_reclassified_" + version_label
-
-
-def reclassify_forests(forest):
-
+def reclassify_forests(forest, remap, forest_reclassified):
 
     """ 3. Reclassifies the forest pixels into classes specified by Jim Strittholt. """
 
@@ -169,16 +269,44 @@ def reclassify_forests(forest):
         forest_reclassified_r = arcpy.sa.Reclassify(
             in_raster=forest,
             reclass_field="Value",
-            remap="1 1;2 1;3 1;4 2;5 2;6 2;7 3;8 3;9 3;10 4;11 4;12 4",
+            remap=remap,
             missing_values="DATA"
         )
         forest_reclassified_r.save(forest_reclassified)
 
 
-zones = intermediate_gdb + os.sep + "ecoregions_and_forest_zones_" + version_label
+def rasterize_ecoregions(biomes_and_ecoregions, value_field, forest, ecoregions_raster):
+
+    """ 4a. Converts the ecoregions to a raster on the forest grid. """
 
+    print("\n4a. Converting ecoregions to raster...")
+
+    d = arcpy.Describe(forest)
+    cell_size = d.children[0].meanCellHeight
 
-def create_zones(biomes_and_ecoregions, value_field, forest_reclassified):
+    with arcpy.EnvManager(snapRaster=forest, cellSize=cell_size):
+
+        arcpy.conversion.PolygonToRaster(
+            in_features=biomes_and_ecoregions,
+            value_field=value_field,
+            out_rasterdataset=ecoregions_raster,
+            cell_assignment="CELL_CENTER",
+            priority_field="NONE",
+            cellsize=cell_size,
+            build_rat="BUILD"
+        )
+
+
+def rasterize_ecoregion_ids(biomes_and_ecoregions, id_field, forest, ecoregion_grid, workers):
+
+    """ 4a. Burns the integer ecoregion IDs onto the forest grid with the NumPy engine (CELL_CENTER, like 4a above). """
+
+    print("\n4a. Rasterizing ecoregion IDs...")
+
+    carbon_engine.rasterize_ecoregions(biomes_and_ecoregions, forest, ecoregion_grid, id_field=id_field, workers=workers).close()
+
+
+def create_zones(ecoregions_raster, forest_reclassified, forest, zones):
 
     """ 4. Creates zones by combining rasterized ecoregions and reclassified forests. """
 
@@ -189,37 +317,69 @@ def create_zones(biomes_and_ecoregions, value_field, forest_reclassified):
 
     with arcpy.EnvManager(snapRaster=forest_reclassified, cellSize=cell_size):
 
-        ecoregions_raster = intermediate_gdb + os.sep + "ecoregions_raster_" + version_label
+        print(" -> Combining rasterized ecoregions and reclassified forests...")
 
-        if not arcpy.Exists(ecoregions_raster):
+        zones_r = arcpy.sa.Combine([ecoregions_raster, forest_reclassified])
+        zones_r.save(zones)
 
-            print(" -> Converting ecoregions to raster...")
 
-            arcpy.conversion.PolygonToRaster(
-                in_features=biomes_and_ecoregions,
-                value_field=value_field,
-                out_rasterdataset=ecoregions_raster,
-                cell_assignment="CELL_CENTER",
-                priority_field="NONE",
-                cellsize=cell_size,
-                build_rat="BUILD"
-            )
+def combine_zone_lookup(zones, ecoregions_raster, value_field):
 
-        print(" -> Combining rasterized ecoregions and reclassified forests...")
+    """ Ecoregion name and forest class of each value of the Combine output, from its attribute table and that of the
+        rasterized ecoregions.
+    """
+
+    eco_names = {value: name for value, name in arcpy.da.SearchCursor(ecoregions_raster, ["Value", value_field])}
+
+    # Combine adds one field per input raster after Count, in the order of the inputs.
+    fields = [field.name for field in arcpy.ListFields(zones)]
+    ecoregion_field, forest_field = fields[fields.index("Count") + 1:fields.index("Count") + 3]
+    combine_lookup = {}
+    with arcpy.da.SearchCursor(zones, ["Value", ecoregion_field, forest_field]) as sc:
+        for value, eco_value, forest_class in sc:
+            combine_lookup[value] = (eco_names[eco_value], forest_class)
+    return combine_lookup
 
-        zones_r = arcpy.sa.Combine([ecoregions_raster, forest_reclassified])
-        zones_r.save(zones)
 
+def check_zones_against_combine(zones, ecoregions_raster, value_field, ecoregion_grid, forest):
 
-thresholds_raster = intermediate_gdb + os.sep + "carbon_thresholds_" + version_label
+    """ 4b. Checks cell by cell that the zones of the NumPy engine (ecoregion_grid) decode to the same ecoregion and
+        forest class as the Combine output.
+    """
+
+    print("\n4b. Checking the NumPy engine zones against the Combine output...")
+
+    combine_lookup = combine_zone_lookup(zones, ecoregions_raster, value_field)
+    counts = carbon_engine.zone_parity(zones, combine_lookup, ecoregion_grid, forest)
+    print(" -> {cells} cells compared: {mismatched} mismatched, {only_combine} only zoned by Combine, {only_engine} only zoned by the engine".format(**counts))
+
+
+def calc_zone_histograms(zones, carbon, approximate_percentiles, zone_histograms):
+
+    """ 5a. Accumulates the histogram (or sketch, with approximate_percentiles) of the carbon of each zone block by
+        block, for the thresholds of the numpy engine and the zone statistics store.
+    """
 
+    print("\n5a. Accumulating the per-zone carbon histograms...")
 
-def calc_percentile_threshold(zones, zone_field, carbon, percentile_threshold):
+    carbon_engine.zonal_histogram(zones, carbon, relative_accuracy=approximate_percentiles).save(zone_histograms)
 
-    """ 5. Calculating percentile threshold within each zone using zonal statistics. """
+
+def calc_percentile_threshold(zones, zone_field, carbon, percentile_threshold, thresholds_raster, percentile_engine,
+                              approximate_percentiles, zone_histograms):
+
+    """ 5. Calculating percentile threshold within each zone using zonal statistics. The numpy engine computes the
+        same exact percentile from the per-zone histograms of zone_histograms (see 5a) instead of holding all values
+        of a zone in memory.
+    """
 
     print("\n5. Calculating percentile threshold within each zone...")
 
+    if percentile_engine == "numpy":
+        carbon_engine.zonal_percentile(zones, carbon, thresholds_raster, percentile_threshold, relative_accuracy=approximate_percentiles,
+                                       sketch_path=zone_histograms)
+        return
+
     arcpy.env.snapRaster = zones
 
     with arcpy.EnvManager(snapRaster=zones):
@@ -240,57 +400,34 @@ def calc_percentile_threshold(zones, zone_field, carbon, percentile_threshold):
         percentile_r.save(thresholds_raster)
 
 
-carbon_in_each_forest_cell = intermediate_gdb + os.sep + "carbon_in_each_forest_cell_" + version_label
+def write_zone_stats(zone_histograms, zones, ecoregions_raster, value_field, biomes_and_ecoregions, zone_stats):
 
-
-def calc_carbon_in_each_forest_cell(forest, carbon):
-
-    """ 6. Calculates carbon in each forest cell using zonal statistics (MEAN).
-        Each forest pixel must be a unique zone. Consequently, must be converted to points then to raster with a
-        unique ID.
+    """ 5b. Writes the per-zone statistics and histograms to the zone statistics store zone_stats, keyed by ecoregion
+        and forest class (ECO_ID * 8 + forest class, like the fused pipeline) rather than by Combine value.
     """
 
-    arcpy.env.snapRaster = forest
+    print("\n5b. Writing the per-zone statistics to {}...".format(zone_stats))
 
-    print("\n6. Calculating carbon in each forest cell....")
+    combine_lookup = combine_zone_lookup(zones, ecoregions_raster, value_field)
+    ecoregions = carbon_engine.read_ecoregion_table(biomes_and_ecoregions, name_field=value_field)
+    histogram = carbon_engine.load_histogram(zone_histograms)
+    metadata = {"zones": zones, "ecoregions": biomes_and_ecoregions}
+    carbon_engine.ZoneStats.from_combine(histogram, combine_lookup, ecoregions, metadata=metadata).save(zone_stats)
 
-    print(" -> Converting forest pixels to points...")
 
+def calc_carbon_in_each_forest_cell(forest, carbon, carbon_in_each_forest_cell):
 
-    forest_points = scratch_gdb + os.sep + "forest_points"
-    arcpy.conversion.RasterToPoint(
-        in_raster=forest,
-        out_point_features=forest_points,
-        raster_field="Value"
-    )
-
-    print(" -> Converting points to raster...")
-    forest_raster = scratch_gdb + os.sep + "forest_raster"
-
-    with arcpy.EnvManager(snapRaster=forest):
-        arcpy.conversion.PointToRaster(
-            in_features=forest_points,
-            value_field="OBJECTID",
-            out_rasterdataset=forest_raster,
-            cell_assignment="MOST_FREQUENT",
-            priority_field="NONE",
-            cellsize=forest,
-            build_rat="BUILD"
-        )
+    """ 6. Calculates carbon in each forest cell by aligning the carbon onto the forest grid (snap raster and cell size
+        of forest, nearest cell centre). Same result as a per-cell zonal MEAN, without converting every forest pixel
+        to a point.
+    """
 
-        print(" -> Calculating zonal statistics (carbon in each forest cell)...")
-        carbon_in_each_forest_cell_r = arcpy.sa.ZonalStatistics(
-            in_zone_data=forest_raster,
-            zone_field="Value",
-            in_value_raster=carbon,
-            statistics_type="MEAN",
-            ignore_nodata="DATA",
-        )
+    print("\n6. Calculating carbon in each forest cell....")
 
-        carbon_in_each_forest_cell_r.save(carbon_in_each_forest_cell)
+    carbon_engine.carbon_in_each_forest_cell(forest, carbon, carbon_in_each_forest_cell)
 
 
-def find_carbon_above_threshold(carbon_in_each_forest_cell, thresholds_raster):
+def find_carbon_above_threshold(carbon_in_each_forest_cell, thresholds_raster, final_output_arcgis, final_output):
 
     """ 7. Creates High Priority Forest Carbon (Final Output) by selecting carbon pixels above the threshold. """
 
@@ -299,113 +436,27 @@ def find_carbon_above_threshold(carbon_in_each_forest_cell, thresholds_raster):
     with arcpy.EnvManager(snapRaster=carbon_in_each_forest_cell):
 
         high_priority_forest_carbon_r = arcpy.sa.Con(Raster(carbon_in_each_forest_cell) > Raster(thresholds_raster), carbon_in_each_forest_cell)
-        high_priority_forest_carbon_r.save(final_output)
-
-
-def filter_output(final_output, carbon_in_each_forest_cell, biomes_to_include, ecoregions_and_biomes, ecoregions_of_interest_csv):
-
-    """ NOT USED. Filters the final output to a subset of biomes and ecoregions. Biomes and candidate ecoregions
-        provided by Jim Strittholt. Ecoregions to use are selected from the candidate ecoregions. Those with total
-        carbon > MEDIAN are kept. Carbon is first projected to an equal area projection at a 1ha resolution so that the
-        original cell value units of Mg C/ha become Mg C.
-        """
-
-    project_carbon = False  # Should only need to do once.
-    carbon_for_ecoregion_selection = os.path.join(intermediate_gdb, "carbon_in_each_forest_cell_proj_1ha_res")
-
-    if project_carbon:
-        # project to Equal Earth at 100m x 100m (1ha) resolution for calculating total forest carbon in each ecoregion.
-        arcpy.management.ProjectRaster(
-            in_raster=carbon_in_each_forest_cell,
-            out_raster=carbon_for_ecoregion_selection,
-            out_coor_system='PROJCS["WGS_1984_Equal_Earth_Greenwich",GEOGCS["GCS_WGS_1984",DATUM["D_WGS_1984",SPHEROID["WGS_1984",6378137.0,298.257223563]],PRIMEM["Greenwich",0.0],UNIT["Degree",0.0174532925199433]],PROJECTION["Equal_Earth"],PARAMETER["False_Easting",0.0],PARAMETER["False_Northing",0.0],PARAMETER["Central_Meridian",0.0],UNIT["Meter",1.0]]',
-            resampling_type="NEAREST",
-            cell_size="100 100",
-            geographic_transform=None,
-            Registration_Point=None,
-            in_coor_system='GEOGCS["GCS_WGS_1984",DATUM["D_WGS_1984",SPHEROID["WGS_1984",6378137.0,298.257223563]],PRIMEM["Greenwich",0.0],UNIT["Degree",0.0174532925199433]]',
-            vertical="NO_VERTICAL"
-        )
+        high_priority_forest_carbon_r.save(final_output_arcgis)
 
-    # Get BIOMES to use (Select biomes specified in the input parameter):
-    biomes_to_use_fc = os.path.join(intermediate_gdb, "biomes_to_use_" + version_label)
-    query = "BIOME_NAME IN {}".format(biomes_to_include)
-    arcpy.Select_analysis(ecoregions_and_biomes, biomes_to_use_fc, query)
-
-    # Get ECOREGIONS to use (Select ecoregions of interest in the CSV that have > MEDIAN combined forest carbon value among ecoregions of interest)
-
-    # Get Ecoregions of Interest from the CSV
-    ecoregions_of_interest = []
-    with open(ecoregions_of_interest_csv) as f:
-        reader = csv.reader(f)
-        for row in reader:
-            ecoregion = row[0]
-            ecoregions_of_interest.append(ecoregion)
-        print("Ecoregions of interest from CSV: " + str(ecoregions_of_interest))
-
-    ecoregions_of_interest_tuple = tuple(ecoregions_of_interest)
-
-    # Create an Ecoregions of Interest Feature Class
-    query = "ECO_NAME IN {}".format(ecoregions_of_interest_tuple)
-    ecoregions_of_interest_fc = os.path.join(intermediate_gdb, "ecoregions_of_interest_" + version_label)
-    arcpy.Select_analysis(biomes_and_ecoregions, ecoregions_of_interest_fc, query)
-
-    # Calc ZONAL STATS to get the SUM of the COMBINED FOREST CARBON DENSITY values within each ecoregion
-    ecoregions_of_interest_zonal_stats = os.path.join(intermediate_gdb, "ecoregions_of_interest_zonal_stats_" + version_label)
-    #arcpy.sa.ZonalStatisticsAsTable(ecoregions_of_interest_fc, "ECO_NAME", final_output, ecoregions_of_interest_zonal_stats, "DATA")
-    arcpy.sa.ZonalStatisticsAsTable(ecoregions_of_interest_fc, "ECO_NAME", carbon_for_ecoregion_selection, ecoregions_of_interest_zonal_stats, "DATA")
-
-    # Calculate the MEDIAN from the Zonal stats table created above (single number).
-    median_zonal_carbon_table = os.path.join(intermediate_gdb, "median_zonal_carbon_table_" + version_label)
-    arcpy.analysis.Statistics(
-        in_table=ecoregions_of_interest_zonal_stats,
-        out_table=median_zonal_carbon_table,
-        statistics_fields="SUM MEDIAN",
-        case_field=None,
-        concatenation_separator=""
-    )
-
-    # Get the MEDIAN value out of the table (table only has one record).
-    with arcpy.da.SearchCursor(median_zonal_carbon_table, "MEDIAN_SUM") as sc:  # field MEDIAN_SUM stores the MEDIAN of the SUMs
-        for row in sc:
-            median_zonal_carbon = row[0]
-        print("Median Zonal Value Threshold: " + str(median_zonal_carbon))
+    print(" -> Writing the Cloud Optimized GeoTIFF...")
+    carbon_engine.convert_to_cog(final_output_arcgis, final_output)
 
-    # Get a list of the ecoregions that are > MEDIAN
 
-    # Create a table view that has the ecoregion names of those > MEDIAN
-    query = "SUM > {}".format(median_zonal_carbon)
-    median_zonal_carbon_table_view = arcpy.MakeTableView_management(ecoregions_of_interest_zonal_stats)
-
-    ecoregions_of_interest_to_use = arcpy.management.SelectLayerByAttribute(
-        in_layer_or_view=median_zonal_carbon_table_view,
-        selection_type="NEW_SELECTION",
-        where_clause=query,
-        invert_where_clause=None
-    )
+def filter_output(final_output, carbon_in_each_forest_cell, ecoregion_grid, ecoregion_filter, final_output_filtered):
 
-    # Get a list of the ecoregion names where the SUM of the forest carbon is > MEDIAN
-    list_of_ecoregions_to_use = []
-    with arcpy.da.SearchCursor(ecoregions_of_interest_to_use, "ECO_NAME") as sc:
-        for row in sc:
-            ecoregion_region_to_use_name = row[0]
-            list_of_ecoregions_to_use.append(ecoregion_region_to_use_name)
-
-    # Ecoregions to Use: Select the ecoregions of interest where the SUM of the forest carbon > MEDIAN to create a new feature class
-    query = "ECO_NAME in {}".format(tuple(list_of_ecoregions_to_use))
-    ecoregions_of_interest_to_use_fc = os.path.join(intermediate_gdb, "ecoregions_of_interest_to_use_" + version_label)
-    arcpy.Select_analysis(biomes_and_ecoregions, ecoregions_of_interest_to_use_fc, query)
+    """ Filters the final output to a subset of biomes and ecoregions. Biomes and candidate ecoregions provided by Jim
+        Strittholt. Ecoregions to use are selected from the candidate ecoregions. Those with total carbon > MEDIAN are
+        kept. Totals (Mg C) are summed on the native grid with each cell weighted by its area in ha, so the carbon
+        doesn't need to be projected to an equal area grid first. The fused pipeline filters while it writes instead.
+    """
 
-    # Combine (Union) the Ecoregions to Use with the Biomes to use to create the final mask.
-    biome_and_ecoregion_mask = os.path.join(intermediate_gdb, "biome_and_ecoregion_mask_" + version_label)
-    arcpy.Union_analysis([biomes_to_use_fc, ecoregions_of_interest_to_use_fc], biome_and_ecoregion_mask)
+    print("\n8. Filtering the final output to the biomes and ecoregions to include...")
 
-    # Extract carbon values within the final mask.
-    final_output_filtered_l = arcpy.sa.ExtractByMask(final_output, biome_and_ecoregion_mask)
-    final_output_filtered_l.save(final_output_filtered)
+    carbon_engine.filter_output(final_output, carbon_in_each_forest_cell, ecoregion_grid, ecoregion_filter,
+                                final_output_filtered)
 
 
-def calculate_density(final_output_filtered):
+def calculate_density(final_output_filtered, intermediate_dir, output_dir, version_label):
     """ (Unused) Test function for calculating point density map from final output. """
 
     raster_to_point_fc = os.path.join(intermediate_dir, "Scratch/Scratch.gdb/raster_to_point_test")
@@ -425,43 +476,250 @@ def calculate_density(final_output_filtered):
     carbon_density_output.save(carbon_density_output_raster)
 
 
-# 0. Clip inputs for testing a smaller area.
-if clip_inputs_for_testing:
-    above_ground_carbon, below_ground_carbon, forest = clip_for_testing(above_ground_carbon, below_ground_carbon, forest, clipping_features)
+def region_of_interest(config):
+
+    """ The carbon_engine.Region of the region setting (or of the clipping features when testing), or None. """
 
-# 1. Combine Carbon (only if doing a combined above & below-ground carbon run).
-if carbon_type == "combined":
-    combine_above_and_below_carbon(above_ground_carbon, below_ground_carbon)
+    if config.clip_inputs_for_testing:
+        return carbon_engine.Region(polygons=config.clipping_features)
+    if isinstance(config.region, str):
+        return carbon_engine.Region(polygons=config.region)
+    if config.region and isinstance(config.region[0], str):
+        return carbon_engine.Region(ecoregions=config.region)
+    if config.region:
+        return carbon_engine.Region(bounds=config.region)
+    return None
 
-# 2. Remove Non-Forested Pixels from Carbon to Use (above, below, or combined).
-clip_carbon_to_forest_pixels(carbon_to_use, forest)
 
-# 3. Reclassify the forest dataset into more generalized groups
-reclassify_forests(forest)
+def run_fused(config, sources, step_cache, ecoregion_grid, ecoregion_filter):
+
+    """ 1-7. Fused pipeline: two streaming passes over aligned tiles, writing straight to the final output. sources:
+        (aboveground carbon, belowground carbon, forest) to read.
+    """
+
+    print("\n1-7. Running the fused pipeline...")
+
+    above_ground_carbon, below_ground_carbon, forest = sources
+    region = region_of_interest(config)
+    if region and config.incremental:
+        raise ValueError("incremental runs cover the whole grid (set region = None)")
+
+    carbon_sources = {
+        "aboveground": [above_ground_carbon],
+        "belowground": [below_ground_carbon],
+        "combined": [above_ground_carbon, below_ground_carbon],
+    }
+    sweep = config.sweep
+
+    debug_dir = config.intermediate_dir if config.write_intermediates else None
+    checkpoint_dir = config.checkpoint_dir if config.checkpoint else None
+    if debug_dir and checkpoint_dir:
+        print(" -> Checkpointing is off: the intermediate rasters of write_intermediates can't be resumed")
+        checkpoint_dir = None
+
+    if config.incremental:
+        carbon_engine.run_incremental(
+            forest=forest,
+            carbon_sources=carbon_sources,
+            ecoregions=ecoregion_grid,
+            runs=sweep or [(config.carbon_type, config.percentile_threshold)],
+            outputs=carbon_engine.sweep_outputs(config.output_dir, sweep) if sweep else [config.final_output],
+            manifest_dir=config.manifest_dir,
+            bounds=config.changed_bounds,
+            workers=config.workers,
+            read_ahead=config.read_ahead,
+            zone_stats=carbon_engine.sweep_zone_stats(config.output_dir, sweep) if sweep else {config.carbon_type: config.zone_stats},
+        )
+
+    elif sweep:
+        # Outputs are named high_priority_forest_carbon_<percentile>_percentile_<carbon_type>.tif
+        carbon_engine.run_sweep(
+            forest=forest,
+            carbon_sources=carbon_sources,
+            ecoregions=ecoregion_grid,
+            runs=sweep,
+            outputs=carbon_engine.sweep_outputs(config.output_dir, sweep),
+            debug_dir=debug_dir,
+            label=config.version_label,
+            workers=config.workers,
+            read_ahead=config.read_ahead,
+            cache=step_cache,
+            relative_accuracy=config.approximate_percentiles,
+            ecoregion_filter=ecoregion_filter,
+            checkpoint_dir=checkpoint_dir,
+            zone_stats=carbon_engine.sweep_zone_stats(config.output_dir, sweep),
+            region=region,
+        )
+
+    else:
+        carbon_engine.run_fused_pipeline(
+            forest=forest,
+            carbon=carbon_sources[config.carbon_type],
+            ecoregions=ecoregion_grid,
+            percentile=config.percentile_threshold,
+            output=config.final_output,
+            debug_dir=debug_dir,
+            label=config.version_label,
+            workers=config.workers,
+            read_ahead=config.read_ahead,
+            cache=step_cache,
+            relative_accuracy=config.approximate_percentiles,
+            ecoregion_filter=ecoregion_filter,
+            filtered_output=config.final_output_filtered,
+            checkpoint_dir=checkpoint_dir,
+            zone_stats=config.zone_stats,
+            region=region,
+        )
+
+
+def run_stepwise(config, sources, step_cache, ecoregion_grid_cache, ecoregion_filter):
+
+    """ Steps 1-8 one after the other, each writing its raster to the cache. sources: (aboveground carbon, belowground
+        carbon, forest, biomes and ecoregions) to read. ecoregion_grid_cache: cache entry of the NumPy ecoregion grid
+        (for the parity check and the filter).
+    """
+
+    above_ground_carbon, below_ground_carbon, forest, biomes_and_ecoregions = sources
+    ecoregion_grid = ecoregion_grid_cache.path("ecoregion_ids.npy")
 
-# 4. Create zones in which to establish carbon thresholds
-create_zones(biomes_and_ecoregions, "ECO_NAME", forest_reclassified)
+    # 1. Combine Carbon (only if doing a combined above & below-ground carbon run).
+    if config.carbon_type == "combined":
+        combined_carbon_cache = step_cache.entry("combine_above_and_below_carbon", [above_ground_carbon, below_ground_carbon])
+        carbon_to_use = combined_carbon_cache.path("combined_carbon.tif")
+        run_cached_step(combined_carbon_cache, combine_above_and_below_carbon, above_ground_carbon, below_ground_carbon, carbon_to_use)
 
-# NOTE: For functions 5 & 6, the carbon arguments were set to combined_carbon for 1st run.
-# Tested with carbon_clipped_to_forest (combined). Same result.
+    elif config.carbon_type == "aboveground":
+        print("\n* Evaluating Aboveground Carbon only")
+        carbon_to_use = above_ground_carbon
 
-# 5. Calculate the carbon threshold for each zone
-calc_percentile_threshold(zones, "Value", carbon_clipped_to_forest, percentile_threshold)
+    elif config.carbon_type == "belowground":
+        print("\n* Evaluating Belowground Carbon only")
+        carbon_to_use = below_ground_carbon
 
-# 6. Calculate the carbon density within each forest pixel
-calc_carbon_in_each_forest_cell(forest, carbon_clipped_to_forest)
+    # 2. Remove Non-Forested Pixels from Carbon to Use (above, below, or combined).
+    carbon_clipped_to_forest_cache = step_cache.entry("clip_carbon_to_forest_pixels", [carbon_to_use, forest])
+    carbon_clipped_to_forest = carbon_clipped_to_forest_cache.path("carbon_clipped_to_forest.tif")
+    run_cached_step(carbon_clipped_to_forest_cache, clip_carbon_to_forest_pixels, carbon_to_use, forest, carbon_clipped_to_forest)
 
-# 7. Final Output: Find forest pixels where the carbon density value > zone threshold
-find_carbon_above_threshold(carbon_in_each_forest_cell, thresholds_raster)
+    # 3. Reclassify the forest dataset into more generalized groups
+    forest_reclassified_cache = step_cache.entry("reclassify_forests", [forest], {"remap": forest_remap})
+    forest_reclassified = forest_reclassified_cache.path("forest_reclassified.tif")
+    run_cached_step(forest_reclassified_cache, reclassify_forests, forest, forest_remap, forest_reclassified)
 
-# Not Used. Clips final output to a subset of biomes and ecoregions.
-# filter_output(final_output, carbon_in_each_forest_cell, biomes_to_include, biomes_and_ecoregions, ecoregions_of_interest_csv)
+    # 4. Create zones in which to establish carbon thresholds
+    ecoregions_raster_cache = step_cache.entry("rasterize_ecoregions", [biomes_and_ecoregions, forest], {"value_field": ecoregions_value_field, "cell_assignment": "CELL_CENTER"})
+    ecoregions_raster = ecoregions_raster_cache.path("ecoregions_raster.tif")
+    run_cached_step(ecoregions_raster_cache, rasterize_ecoregions, biomes_and_ecoregions, ecoregions_value_field, forest, ecoregions_raster)
+
+    zones_cache = step_cache.entry("create_zones", [ecoregions_raster, forest_reclassified])
+    zones = zones_cache.path("ecoregions_and_forest_zones.tif")
+    run_cached_step(zones_cache, create_zones, ecoregions_raster, forest_reclassified, forest, zones)
+
+    if config.check_zone_parity:
+        run_cached_step(ecoregion_grid_cache, rasterize_ecoregion_ids, biomes_and_ecoregions, ecoregions_id_field, forest, ecoregion_grid, config.workers)
+        run_step(check_zones_against_combine, zones, ecoregions_raster, ecoregions_value_field, ecoregion_grid, forest)
+
+    # NOTE: For functions 5 & 6, the carbon arguments were set to combined_carbon for 1st run.
+    # Tested with carbon_clipped_to_forest (combined). Same result.
+
+    # 5a. Per-zone histograms (or sketches) of the carbon, reused by reruns with another percentile.
+    zone_histograms_cache = step_cache.entry("zone_histograms_of_zones", [zones, carbon_clipped_to_forest], {"relative_accuracy": config.approximate_percentiles})
+    zone_histograms = zone_histograms_cache.path("zone_histograms.npz")
+    run_cached_step(zone_histograms_cache, calc_zone_histograms, zones, carbon_clipped_to_forest, config.approximate_percentiles, zone_histograms)
+
+    # 5. Calculate the carbon threshold for each zone
+    thresholds_raster_cache = step_cache.entry("calc_percentile_threshold", [zones, carbon_clipped_to_forest], {"percentile": config.percentile_threshold, "engine": config.percentile_engine, "relative_accuracy": config.approximate_percentiles})
+    thresholds_raster = thresholds_raster_cache.path("carbon_thresholds.tif")
+    run_cached_step(thresholds_raster_cache, calc_percentile_threshold, zones, "Value", carbon_clipped_to_forest, config.percentile_threshold, thresholds_raster,
+                    config.percentile_engine, config.approximate_percentiles, zone_histograms)
+
+    # 5b. Zone statistics store (also when the thresholds are cached or come from the arcpy engine).
+    run_step(write_zone_stats, zone_histograms, zones, ecoregions_raster, ecoregions_value_field, biomes_and_ecoregions, config.zone_stats)
+
+    # 6. Calculate the carbon density within each forest pixel
+    carbon_in_each_forest_cell_cache = step_cache.entry("calc_carbon_in_each_forest_cell", [forest, carbon_clipped_to_forest])
+    carbon_in_each_forest_cell = carbon_in_each_forest_cell_cache.path("carbon_in_each_forest_cell.tif")
+    run_cached_step(carbon_in_each_forest_cell_cache, calc_carbon_in_each_forest_cell, forest, carbon_clipped_to_forest, carbon_in_each_forest_cell)
+
+    # 7. Final Output: Find forest pixels where the carbon density value > zone threshold
+    run_step(find_carbon_above_threshold, carbon_in_each_forest_cell, thresholds_raster, config.final_output_arcgis, config.final_output)
+
+    # 8. Filter the final output to a subset of biomes and ecoregions.
+    if config.filter_final_output:
+        run_cached_step(ecoregion_grid_cache, rasterize_ecoregion_ids, biomes_and_ecoregions, ecoregions_id_field, forest, ecoregion_grid, config.workers)
+        run_step(filter_output, config.final_output, carbon_in_each_forest_cell, ecoregion_grid, ecoregion_filter, config.final_output_filtered)
+
+    # Point Density Test
+    #calculate_density(config.final_output_filtered, config.intermediate_dir, config.output_dir, config.version_label)
+
+
+def main(spec=None):
+
+    """ Runs the analysis configured above, or by the run spec file spec (see configure). """
+
+    config = configure(spec)
+
+    arcpy.env.overwriteOutput = True
+
+    start_time = datetime.datetime.now()
+    print("\nStart Time: " + str(start_time))
+
+    # Wall time, CPU time, peak memory, I/O and tiles/s of each step, written to run_report at the end (also if a
+    # step fails, with the error).
+    profiler = carbon_engine.RunProfiler(config.run_report, profile_step=config.profile_step, config={
+        "version_label": config.version_label, "carbon_type": config.carbon_type,
+        "percentile_threshold": config.percentile_threshold, "percentile_engine": config.percentile_engine,
+        "use_fused_pipeline": config.use_fused_pipeline, "sweep": config.sweep, "workers": config.workers,
+        "incremental": config.incremental, "approximate_percentiles": config.approximate_percentiles,
+        "filter_final_output": config.filter_final_output, "clip_inputs_for_testing": config.clip_inputs_for_testing,
+        "region": config.region,
+    })
+
+    with profiler:
+
+        step_cache = carbon_engine.StepCache(config.cache_dir, max_bytes=config.cache_max_gb * 1024 ** 3)
+
+        # The source data of this run: staged and/or clipped copies replace them below, for this run only.
+        above_ground_carbon, below_ground_carbon = config.above_ground_carbon, config.below_ground_carbon
+        forest, biomes_and_ecoregions = config.forest, config.biomes_and_ecoregions
+
+        # 0. Copy the source data from the network share to a local disk, so that each byte crosses the network once.
+        if config.staging_dir:
+            above_ground_carbon, below_ground_carbon, forest, biomes_and_ecoregions = run_step(stage_inputs, config.staging_dir, config.staging_max_gb, above_ground_carbon, below_ground_carbon, forest, biomes_and_ecoregions)
+
+        # 0. Clip inputs for testing a smaller area (the fused pipeline reads just the windows of the area instead).
+        if config.clip_inputs_for_testing and not config.use_fused_pipeline:
+            above_ground_carbon, below_ground_carbon, forest = run_step(clip_for_testing, above_ground_carbon, below_ground_carbon, forest, config.clipping_features, config.input_dir, config.version_label)
+
+        # NumPy engine: integer ecoregion IDs burned onto the forest grid (zone = ECO_ID * 8 + forest class, no attribute table).
+        ecoregion_grid_cache = step_cache.entry("rasterize_ecoregion_ids", [biomes_and_ecoregions, forest], {"id_field": ecoregions_id_field})
+        ecoregion_grid = ecoregion_grid_cache.path("ecoregion_ids.npy")
+
+        ecoregion_filter = None
+        if config.filter_final_output:
+            ecoregion_filter = carbon_engine.EcoregionFilter(
+                config.biomes_to_include, carbon_engine.read_ecoregions_of_interest(config.ecoregions_of_interest_csv))
+
+        if config.use_fused_pipeline and config.incremental:
+            # Updated in place between incremental runs: an edit of a few ecoregions only burns their windows again.
+            ecoregion_grid = os.path.join(config.manifest_dir, "ecoregion_ids.npy")
+            if not os.path.isdir(config.manifest_dir):
+                os.makedirs(config.manifest_dir)
+            run_step(rasterize_ecoregion_ids, biomes_and_ecoregions, ecoregions_id_field, forest, ecoregion_grid, config.workers)
+            run_fused(config, (above_ground_carbon, below_ground_carbon, forest), step_cache, ecoregion_grid, ecoregion_filter)
+        elif config.use_fused_pipeline:
+            run_cached_step(ecoregion_grid_cache, rasterize_ecoregion_ids, biomes_and_ecoregions, ecoregions_id_field, forest, ecoregion_grid, config.workers)
+            run_fused(config, (above_ground_carbon, below_ground_carbon, forest), step_cache, ecoregion_grid, ecoregion_filter)
+        else:
+            run_stepwise(config, (above_ground_carbon, below_ground_carbon, forest, biomes_and_ecoregions), step_cache,
+                         ecoregion_grid_cache, ecoregion_filter)
+
+    end_time = datetime.datetime.now()
+    duration = end_time - start_time
+    print("Start Time: " + str(start_time))
+    print("End Time: " + str(end_time))
+    print("Duration: " + str(duration))
 
-# Point Density Test
-#calculate_density(final_output_filtered)
 
-end_time = datetime.datetime.now()
-duration = end_time - start_time
-print("Start Time: " + str(start_time))
-print("End Time: " + str(end_time))
-print("Duration: " + str(duration))
+if __name__ == "__main__":
+    main(sys.argv[1] if len(sys.argv) > 1 else None)
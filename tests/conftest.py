@@ -0,0 +1,25 @@
+""" Shared fixture: small synthetic stand-ins for the inputs of the analysis (see benchmarks/pipeline_steps.py). """
+
+import os
+
+import pytest
+
+from benchmarks.pipeline_steps import generate_inputs
+from carbon_engine import rasterize_ecoregions
+
+SIZE = 256
+BLOCK_SIZE = 64
+
+
+@pytest.fixture(scope="session")
+def inputs(tmp_path_factory):
+
+    """ Paths of the forest, aboveground and belowground carbon (on a grid offset from the forest grid) and ecoregion
+        polygons, plus "ecoregion_grid", the polygons rasterized onto the forest grid (.npy).
+    """
+
+    directory = str(tmp_path_factory.mktemp("inputs"))
+    paths = generate_inputs(directory, SIZE, seed=1, block_size=BLOCK_SIZE)
+    paths["ecoregion_grid"] = os.path.join(directory, "ecoregion_ids.npy")
+    rasterize_ecoregions(paths["ecoregions"], paths["forest"], paths["ecoregion_grid"], block_size=BLOCK_SIZE).close()
+    return paths
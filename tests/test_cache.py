@@ -0,0 +1,50 @@
+""" Cache keys of inputs and eviction of entries in use. """
+
+import os
+
+import pytest
+
+from carbon_engine import StepCache
+from carbon_engine.cache import fingerprint
+
+
+def write(path, data=b"x"):
+    with open(path, "wb") as f:
+        f.write(data)
+
+
+def test_missing_input_is_an_error(tmp_path):
+    write(tmp_path / "forest.tif")
+    with pytest.raises(FileNotFoundError):
+        fingerprint(str(tmp_path / "frest.tif"))
+
+
+def test_geodatabase_member_is_the_geodatabase_without_its_locks(tmp_path):
+    gdb = tmp_path / "Inputs.gdb"
+    gdb.mkdir()
+    write(gdb / "a00000009.gdbtable")
+    before = fingerprint(str(gdb / "ecoregions"))
+    write(gdb / "_gdb.host.1234.sr.lock")
+    assert fingerprint(str(gdb / "ecoregions")) == before
+    write(gdb / "a00000009.gdbtable", b"changed")
+    assert fingerprint(str(gdb / "ecoregions")) != before
+
+
+def fill(cache, step):
+    entry = cache.entry(step)
+    entry.create()
+    write(entry.path("result.bin"), b"x" * 1000)
+    entry.commit()
+    return entry
+
+
+def test_entries_in_use_by_another_cache_are_not_evicted(tmp_path):
+    first = StepCache(str(tmp_path), max_bytes=1500)
+    second = StepCache(str(tmp_path), max_bytes=1500)
+    used = fill(first, "first")
+    fill(second, "second")
+    assert used.complete  # Over the limit, but pinned by the first cache.
+
+    first.release()
+    fill(second, "third")
+    assert not used.complete
@@ -0,0 +1,66 @@
+""" Per-cell forest carbon against brute-force sampling at the forest cell centres. """
+
+import numpy as np
+import rasterio
+from rasterio.transform import from_origin
+
+from carbon_engine import carbon_in_each_forest_cell
+from carbon_engine.blocks import default_nodata
+
+
+def write(path, data, transform, nodata):
+    with rasterio.open(path, "w", driver="GTiff", width=data.shape[1], height=data.shape[0], count=1,
+                       dtype=data.dtype.name, crs="EPSG:4326", transform=transform, nodata=nodata) as dst:
+        dst.write(data, 1)
+
+
+def brute_force(forest, carbon):
+
+    """ Carbon at the centre of each forest cell, one cell at a time. """
+
+    with rasterio.open(forest) as forest_src, rasterio.open(carbon) as carbon_src:
+        forest_valid = forest_src.read_masks(1) > 0
+        carbon_data = carbon_src.read(1)
+        carbon_valid = carbon_src.read_masks(1) > 0
+        expected = np.full(forest_valid.shape, default_nodata(np.float32), dtype=np.float32)
+        for row in range(forest_src.height):
+            for col in range(forest_src.width):
+                if not forest_valid[row, col]:
+                    continue
+                x, y = forest_src.xy(row, col)
+                carbon_row, carbon_col = carbon_src.index(x, y)
+                if 0 <= carbon_row < carbon_src.height and 0 <= carbon_col < carbon_src.width and \
+                        carbon_valid[carbon_row, carbon_col]:
+                    expected[row, col] = carbon_data[carbon_row, carbon_col]
+    return expected
+
+
+def test_misaligned_grids_match_centre_sampling(tmp_path):
+    rng = np.random.default_rng(2)
+    res = 0.25
+    forest = rng.integers(0, 13, (37, 53)).astype(np.uint8)
+    # The carbon grid is offset by a fraction of a cell and doesn't cover the whole forest grid.
+    carbon = rng.integers(-1, 400, (35, 50)).astype(np.int16)
+    write(tmp_path / "forest.tif", forest, from_origin(10, 20, res, res), 0)
+    write(tmp_path / "carbon.tif", carbon, from_origin(10 + 0.37 * res, 20 - 0.61 * res, res, res), -1)
+
+    for block_size in (8, 2048):
+        output = tmp_path / "cells_{}.tif".format(block_size)
+        carbon_in_each_forest_cell(tmp_path / "forest.tif", tmp_path / "carbon.tif", output, block_size=block_size)
+        with rasterio.open(output) as src:
+            assert src.dtypes[0] == "float32"
+            np.testing.assert_array_equal(src.read(1), brute_force(tmp_path / "forest.tif", tmp_path / "carbon.tif"))
+
+
+def test_aligned_grids_copy_the_forest_cells(tmp_path):
+    rng = np.random.default_rng(3)
+    transform = from_origin(0, 10, 0.5, 0.5)
+    forest = rng.integers(0, 3, (20, 20)).astype(np.uint8)
+    carbon = rng.integers(0, 300, (20, 20)).astype(np.int16)
+    write(tmp_path / "forest.tif", forest, transform, 0)
+    write(tmp_path / "carbon.tif", carbon, transform, -1)
+
+    carbon_in_each_forest_cell(tmp_path / "forest.tif", tmp_path / "carbon.tif", tmp_path / "cells.tif", block_size=8)
+    with rasterio.open(tmp_path / "cells.tif") as src:
+        expected = np.where(forest > 0, carbon, default_nodata(np.float32)).astype(np.float32)
+        np.testing.assert_array_equal(src.read(1), expected)
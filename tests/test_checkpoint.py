@@ -0,0 +1,89 @@
+""" Checkpoint journal: resuming a crashed run, and leaving the other files of the checkpoint directory alone. """
+
+import hashlib
+import os
+
+import pytest
+
+from carbon_engine import Checkpoint, run_sweep
+from carbon_engine import pipeline
+from carbon_engine.cog import CogWriter
+
+from .conftest import BLOCK_SIZE
+
+
+def write_snapshot(directory):
+    with open(os.path.join(directory, "histograms.npz"), "w") as f:
+        f.write("state")
+
+
+def test_other_run_keeps_the_other_files(tmp_path):
+    (tmp_path / "important.txt").write_text("keep")
+    checkpoint = Checkpoint(str(tmp_path), {"run": 1})
+    checkpoint.save("pass_1", 3, write_snapshot)
+    assert os.path.isdir(checkpoint.snapshot("pass_1"))
+
+    other = Checkpoint(str(tmp_path), {"run": 2})
+    assert other.done("pass_1") == 0
+    assert sorted(os.listdir(tmp_path)) == ["important.txt"]
+
+    other.save("pass_1", 5, write_snapshot)
+    other.finish()
+    assert sorted(os.listdir(tmp_path)) == ["important.txt"]
+
+
+def test_finish_removes_only_a_directory_it_created(tmp_path):
+    directory = str(tmp_path / "checkpoint")
+    checkpoint = Checkpoint(directory, {"run": 1})
+    checkpoint.save("pass_1", 3, write_snapshot)
+    checkpoint.save("pass_1", 4, write_snapshot)
+    resumed = Checkpoint(directory, {"run": 1})
+    assert resumed.done("pass_1") == 4
+    resumed.finish()
+    assert not os.path.exists(directory)
+
+
+def digest(path):
+    with open(path, "rb") as f:
+        return hashlib.sha256(f.read()).hexdigest()
+
+
+def crash_after(monkeypatch, cls, name, calls):
+
+    """ Makes cls.name raise KeyboardInterrupt on its calls + 1th call. """
+
+    method = getattr(cls, name)
+    count = [0]
+
+    def crashing(*args, **kwargs):
+        count[0] += 1
+        if count[0] > calls:
+            raise KeyboardInterrupt
+        return method(*args, **kwargs)
+
+    monkeypatch.setattr(cls, name, crashing)
+
+
+@pytest.mark.parametrize("cls, name", [(pipeline._HistogramSet, "merge"), (CogWriter, "write")])
+def test_resumed_run_writes_the_same_output(inputs, tmp_path, monkeypatch, cls, name):
+    carbon_sources = {"combined": [inputs["aboveground"], inputs["belowground"]]}
+
+    def run(output, checkpoint_dir=None):
+        run_sweep(inputs["forest"], carbon_sources, inputs["ecoregion_grid"], [("combined", 50)], [output],
+                  block_size=BLOCK_SIZE, read_ahead=0, checkpoint_dir=checkpoint_dir, checkpoint_interval=0)
+
+    reference = str(tmp_path / "reference.tif")
+    run(reference)
+
+    (tmp_path / "important.txt").write_text("keep")
+    output = str(tmp_path / "resumed.tif")
+    crash_after(monkeypatch, cls, name, 5)
+    with pytest.raises(KeyboardInterrupt):
+        run(output, str(tmp_path))
+    monkeypatch.undo()
+    assert os.path.exists(tmp_path / "journal.json")
+
+    run(output, str(tmp_path))
+    assert digest(output) == digest(reference)
+    assert not os.path.exists(tmp_path / "journal.json")
+    assert (tmp_path / "important.txt").read_text() == "keep"
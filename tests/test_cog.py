@@ -0,0 +1,81 @@
+""" COG output: overviews are the means of the full resolution cells, and an interrupted writer resumes. """
+
+import hashlib
+import types
+
+import numpy as np
+import pytest
+import rasterio
+from rasterio.transform import from_origin
+
+from carbon_engine import CogWriter, iter_windows
+
+SIZE = 300
+GRID = types.SimpleNamespace(width=SIZE, height=SIZE, crs=rasterio.crs.CRS.from_epsg(4326),
+                             transform=from_origin(0, 30, 0.1, 0.1))
+NODATA = -1.0
+
+
+def sparse_values(seed=0):
+    rng = np.random.default_rng(seed)
+    values = rng.uniform(1, 500, (SIZE, SIZE))
+    values[rng.uniform(size=values.shape) < 0.7] = NODATA
+    return values
+
+
+def block_means(values, factor):
+
+    """ Mean of the valid cells of each factor x factor block (NODATA where there are none). """
+
+    padded = -(-SIZE // factor) * factor
+    sums = np.zeros((padded, padded))
+    counts = np.zeros((padded, padded))
+    valid = values != NODATA
+    sums[:SIZE, :SIZE] = np.where(valid, values, 0)
+    counts[:SIZE, :SIZE] = valid
+    shape = (padded // factor, factor, padded // factor, factor)
+    sums, counts = sums.reshape(shape).sum(axis=(1, 3)), counts.reshape(shape).sum(axis=(1, 3))
+    return np.where(counts > 0, sums / np.maximum(counts, 1), NODATA)
+
+
+@pytest.mark.parametrize("window_size", [4, 64])
+def test_overviews_are_means_of_the_full_resolution(tmp_path, window_size):
+    values = sparse_values()
+    path = str(tmp_path / "cog.tif")
+    with CogWriter(path, GRID, np.float32, NODATA, window_size=window_size, block_size=32) as dst:
+        assert dst.factors == [2, 4, 8, 16]
+        for window in iter_windows(SIZE, SIZE, window_size):
+            dst.write(values[window.toslices()], window)
+
+    with rasterio.open(path) as src:
+        np.testing.assert_array_equal(src.read(1), values.astype(np.float32))
+        assert src.overviews(1) == [2, 4, 8, 16]
+    for level, factor in enumerate([2, 4, 8, 16]):
+        with rasterio.open(path, overview_level=level) as src:
+            np.testing.assert_allclose(src.read(1), block_means(values, factor), rtol=1e-6)
+
+
+def digest(path):
+    with open(path, "rb") as f:
+        return hashlib.sha256(f.read()).hexdigest()
+
+
+def test_resumed_writer_writes_the_same_cog(tmp_path):
+    values = sparse_values(1)
+    windows = list(iter_windows(SIZE, SIZE, 4))
+
+    with CogWriter(str(tmp_path / "reference.tif"), GRID, np.float32, NODATA, window_size=4, block_size=32) as dst:
+        for window in windows:
+            dst.write(values[window.toslices()], window)
+
+    path = str(tmp_path / "resumed.tif")
+    writer = CogWriter(path, GRID, np.float32, NODATA, window_size=4, block_size=32)
+    for window in windows[:len(windows) // 2]:
+        writer.write(values[window.toslices()], window)
+    writer.suspend()
+    with CogWriter(path, GRID, np.float32, NODATA, window_size=4, block_size=32, resume=True) as dst:
+        assert dst.resumed
+        for window in windows[len(windows) // 2:]:
+            dst.write(values[window.toslices()], window)
+
+    assert digest(path) == digest(str(tmp_path / "reference.tif"))
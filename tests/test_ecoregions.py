@@ -0,0 +1,123 @@
+""" Ecoregion grid, zone IDs and the parity check against the arcpy Combine. """
+
+import json
+
+import fiona
+import numpy as np
+import rasterio
+from rasterio.transform import from_origin
+
+from carbon_engine import EcoregionGrid, rasterize_ecoregions, zone_parity
+from carbon_engine.ecoregions import sidecar_path
+from carbon_engine.kernels import ZONE_CLASS_SLOTS, combine_zones, decode_zones, reclassify_forest
+
+TRANSFORM = from_origin(0, 10, 0.1, 0.1)
+SHAPE = (100, 120)
+
+# Non-overlapping polygons (ECO_ID, name, biome, ring), with vertices off the cell centres.
+POLYGONS = [
+    (7, "Northern Woods", "Boreal Forests/Taiga", [(0.33, 9.71), (5.17, 9.42), (2.61, 5.83), (0.33, 9.71)]),
+    (12, "Delta Forest", "Mangroves", [(6.03, 9.87), (11.71, 8.04), (10.92, 3.36), (7.14, 5.21), (6.03, 9.87)]),
+    (846, "Southern Plains", "Tundra", [(0.58, 4.47), (6.66, 0.23), (5.92, 4.91), (0.58, 4.47)]),
+]
+
+
+def write_polygons(path):
+    schema = {"geometry": "Polygon", "properties": {"ECO_ID": "int", "ECO_NAME": "str", "BIOME_NAME": "str"}}
+    with fiona.open(path, "w", driver="ESRI Shapefile", crs="EPSG:4326", schema=schema) as dst:
+        for eco_id, name, biome, ring in POLYGONS:
+            dst.write({"geometry": {"type": "Polygon", "coordinates": [ring]},
+                       "properties": {"ECO_ID": eco_id, "ECO_NAME": name, "BIOME_NAME": biome}})
+
+
+def write_raster(path, data, nodata):
+    with rasterio.open(path, "w", driver="GTiff", width=SHAPE[1], height=SHAPE[0], count=1, dtype=data.dtype.name,
+                       crs="EPSG:4326", transform=TRANSFORM, nodata=nodata) as dst:
+        dst.write(data, 1)
+
+
+def inside(ring, x, y):
+
+    """ Even-odd rule point-in-polygon test of points x, y. """
+
+    result = np.zeros(x.shape, dtype=bool)
+    for (x1, y1), (x2, y2) in zip(ring[:-1], ring[1:]):
+        crosses = (y1 > y) != (y2 > y)
+        with np.errstate(divide="ignore", invalid="ignore"):
+            result ^= crosses & (x < x1 + (y - y1) * (x2 - x1) / (y2 - y1))
+    return result
+
+
+def expected_ids(nodata):
+    cols, rows = np.meshgrid(np.arange(SHAPE[1]), np.arange(SHAPE[0]))
+    x, y = TRANSFORM * (cols + 0.5, rows + 0.5)
+    ids = np.full(SHAPE, nodata, dtype=np.int64)
+    for eco_id, name, biome, ring in POLYGONS:
+        ids[inside(ring, x, y)] = eco_id
+    return ids
+
+
+def test_rasterized_ids_match_point_in_polygon(tmp_path):
+    write_polygons(str(tmp_path / "ecoregions.shp"))
+    write_raster(str(tmp_path / "forest.tif"), np.ones(SHAPE, dtype=np.uint8), 0)
+    output = str(tmp_path / "ecoregion_ids.npy")
+
+    rasterize_ecoregions(str(tmp_path / "ecoregions.shp"), str(tmp_path / "forest.tif"), output, block_size=32).close()
+    with EcoregionGrid(output) as grid:
+        ids = np.asarray(grid.ids)
+        assert grid.transform.almost_equals(TRANSFORM)
+        np.testing.assert_array_equal(ids, expected_ids(grid.nodata))
+        assert grid.ecoregions[12] == {"name": "Delta Forest", "biome": "Mangroves"}
+    with open(sidecar_path(output)) as f:
+        extents = json.load(f)["extents"]
+    for eco_id, name, biome, ring in POLYGONS:
+        rows, cols = np.nonzero(ids == eco_id)
+        assert extents[str(eco_id)] == [rows.min(), cols.min(), rows.max() + 1, cols.max() + 1]
+
+
+def test_zone_ids_round_trip():
+    rng = np.random.default_rng(0)
+    eco_ids = rng.integers(0, 100000, (50, 60))
+    classes = rng.integers(0, ZONE_CLASS_SLOTS, (50, 60))
+    valid = rng.uniform(size=(50, 60)) < 0.8
+    zones, zones_valid = combine_zones(eco_ids, valid, classes, np.ones_like(valid))
+    np.testing.assert_array_equal(zones_valid, valid)
+    decoded_ids, decoded_classes = decode_zones(zones)
+    np.testing.assert_array_equal(decoded_ids, eco_ids)
+    np.testing.assert_array_equal(decoded_classes, classes)
+
+
+def test_zone_parity_counts_an_injected_mismatch(tmp_path):
+    write_polygons(str(tmp_path / "ecoregions.shp"))
+    rng = np.random.default_rng(1)
+    forest = rng.integers(0, 13, SHAPE).astype(np.uint8)
+    write_raster(str(tmp_path / "forest.tif"), forest, 0)
+    ecoregions = str(tmp_path / "ecoregion_ids.npy")
+    rasterize_ecoregions(str(tmp_path / "ecoregions.shp"), str(tmp_path / "forest.tif"), ecoregions).close()
+
+    # A Combine of the ECO_NAME raster and the reclassified forest: arbitrary values, numbered in order of appearance.
+    with EcoregionGrid(ecoregions) as grid:
+        ids = np.asarray(grid.ids)
+        names = {eco_id: row["name"] for eco_id, row in grid.ecoregions.items()}
+        eco_valid = ids != grid.nodata
+    classes = reclassify_forest(forest, forest > 0)
+    zones_valid = eco_valid & (forest > 0)
+    pairs = sorted(set(zip(ids[zones_valid].tolist(), classes[zones_valid].tolist())))
+    combine_value = {pair: value for value, pair in enumerate(pairs, start=1)}
+    combine = np.zeros(SHAPE, dtype=np.int32)
+    for (eco_id, forest_class), value in combine_value.items():
+        combine[zones_valid & (ids == eco_id) & (classes == forest_class)] = value
+    lookup = {value: (names[eco_id], forest_class) for (eco_id, forest_class), value in combine_value.items()}
+
+    # Injected differences: one Combine value decodes to another forest class, one zone cell is missing.
+    wrong = combine_value[(12, 3)]
+    lookup[wrong] = ("Delta Forest", 4)
+    missing = tuple(np.argwhere(zones_valid)[0])
+    combine[missing] = 0
+    write_raster(str(tmp_path / "combine.tif"), combine, 0)
+
+    counts = zone_parity(str(tmp_path / "combine.tif"), lookup, ecoregions, str(tmp_path / "forest.tif"),
+                         block_size=32)
+    assert counts == {"cells": int(zones_valid.sum()) - 1, "mismatched": int((combine == wrong).sum()),
+                      "only_combine": 0, "only_engine": 1}
+    assert counts["mismatched"] > 0
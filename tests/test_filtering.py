@@ -0,0 +1,138 @@
+""" Ecoregion filter: cell areas against the WGS84 ellipsoid and the median rule against a brute-force selection. """
+
+import numpy as np
+import pytest
+from rasterio.crs import CRS
+from rasterio.transform import from_origin
+from rasterio.windows import Window
+
+from carbon_engine import EcoregionFilter
+from carbon_engine.filtering import EcoregionCarbon, row_areas_ha
+
+WGS84 = CRS.from_epsg(4326)
+SEMI_MAJOR_AXIS = 6378137.0
+FLATTENING = 1 / 298.257223563
+# Surface area of the WGS84 ellipsoid (NIMA TR8350.2), in ha.
+ELLIPSOID_AREA_HA = 5.10065621724e14 / 1e4
+
+
+def band_area_ha(south, north, degrees_of_longitude, samples=20001):
+
+    """ Area of a latitude band of the ellipsoid by integrating M(lat) N(lat) cos(lat) (Simpson's rule). """
+
+    e2 = FLATTENING * (2 - FLATTENING)
+    latitudes = np.radians(np.linspace(south, north, samples))
+    w = 1 - e2 * np.sin(latitudes) ** 2
+    integrand = SEMI_MAJOR_AXIS ** 2 * (1 - e2) / w ** 2 * np.cos(latitudes)
+    step = (latitudes[-1] - latitudes[0]) / (samples - 1)
+    integral = step / 3 * (integrand[0] + integrand[-1] + 4 * integrand[1:-1:2].sum() + 2 * integrand[2:-1:2].sum())
+    return integral * np.radians(degrees_of_longitude) / 1e4
+
+
+def test_the_rows_of_a_global_grid_cover_the_ellipsoid():
+    res = 0.25
+    areas = row_areas_ha(from_origin(-180, 90, res, res), WGS84, 0, int(180 / res))
+    assert areas.sum() * 360 / res == pytest.approx(ELLIPSOID_AREA_HA, rel=1e-9)
+    np.testing.assert_allclose(areas, areas[::-1])
+
+
+@pytest.mark.parametrize("north, res", [(1.0, 1.0), (45.5, 0.5), (80.0, 1 / 120), (-60.25, 0.25)])
+def test_row_areas_match_the_ellipsoid_band(north, res):
+    transform = from_origin(17.0, north, res, res)
+    rows = 4
+    areas = row_areas_ha(transform, WGS84, 0, rows)
+    for row, area in enumerate(areas):
+        top = north - row * res
+        assert area == pytest.approx(band_area_ha(top - res, top, res), rel=1e-9)
+    # The rows of a window are those of the grid.
+    np.testing.assert_allclose(row_areas_ha(transform, WGS84, 2, 2), areas[2:])
+
+
+def test_equal_area_cells_all_have_the_same_area():
+    areas = row_areas_ha(from_origin(0, 0, 1000, 1000), CRS.from_epsg(6933), 5, 3)
+    np.testing.assert_allclose(areas, 100.0)
+
+
+def test_ecoregion_totals_weight_the_carbon_by_cell_area():
+    res = 0.5
+    transform = from_origin(10, 30, res, res)
+    eco_ids = np.array([[1, 1, 2], [2, 2, -1]])
+    carbon = np.array([[10.0, 20.0, 5.0], [1.0, 1.0, 99.0]])
+    valid = np.array([[True, True, True], [True, False, True]])
+    totals = EcoregionCarbon()
+    totals.update_block(eco_ids, np.ones(eco_ids.shape, dtype=bool), carbon, valid, transform, WGS84,
+                        Window(0, 0, 3, 2))
+    top, bottom = band_area_ha(29.5, 30, res), band_area_ha(29, 29.5, res)
+    np.testing.assert_allclose(totals.totals, [0, 30 * top, 5 * top + 1 * bottom], rtol=1e-9)
+    np.testing.assert_array_equal(totals.cells, [0, 2, 2])
+
+
+def carbon_of(totals, cells):
+    carbon = EcoregionCarbon()
+    carbon.totals, carbon.cells = np.array(totals, dtype=np.float64), np.array(cells, dtype=np.int64)
+    return carbon
+
+
+def brute_force(table, carbon, biomes, interest):
+
+    """ IDs kept: those in the biomes and the ecoregions of interest (with carbon) above the median of their totals. """
+
+    name_totals = {}
+    for eco_id, row in table.items():
+        if row["name"] in interest and carbon.cells[eco_id] > 0:
+            name_totals[row["name"]] = name_totals.get(row["name"], 0.0) + carbon.totals[eco_id]
+    values = sorted(name_totals.values())
+    n = len(values)
+    median = None
+    if n:
+        median = values[n // 2] if n % 2 else (values[n // 2 - 1] + values[n // 2]) / 2
+    return {eco_id for eco_id, row in table.items() if row["biome"] in biomes or
+            (row["name"] in name_totals and name_totals[row["name"]] > median)}
+
+
+def kept(lookup):
+    return set(np.flatnonzero(lookup).tolist())
+
+
+TABLE = {
+    1: {"name": "A", "biome": "Boreal"},
+    2: {"name": "B", "biome": "Tundra"},
+    3: {"name": "C", "biome": "Tundra"},
+    4: {"name": "D", "biome": "Desert"},
+    5: {"name": "E", "biome": "Desert"},
+    6: {"name": "F", "biome": "Boreal"},
+}
+
+
+@pytest.mark.parametrize("totals, cells, interest, expected", [
+    # Even count: the median is the mean of the middle two (20), ties with it are not above it.
+    ([0, 99, 10, 20, 20, 30, 0], [0, 1, 1, 1, 1, 1, 0], "BCDE", {5}),
+    # Odd count with a tie at the median: nothing is above it but the largest.
+    ([0, 0, 5, 7, 7, 8, 0], [0, 0, 1, 1, 1, 1, 0], "BCDE", {5}),
+    # Odd count where the median is tied with the largest: none above it.
+    ([0, 0, 5, 7, 7, 0, 0], [0, 0, 1, 1, 1, 0, 0], "BCD", set()),
+    # Ecoregions of interest without carbon cells don't count towards the median.
+    ([0, 0, 10, 30, 0, 0, 0], [0, 0, 1, 1, 0, 0, 0], "BCDE", {3}),
+    # Ecoregions of interest in excluded biomes are only kept if they are above the median.
+    ([0, 0, 1, 2, 3, 4, 0], [0, 0, 1, 1, 1, 1, 0], "BCDEX", {4, 5}),
+])
+def test_median_rule_on_known_totals(totals, cells, interest, expected):
+    carbon = carbon_of(totals, cells)
+    lookup = EcoregionFilter(["Boreal"], list(interest)).lookup(TABLE, carbon)
+    assert kept(lookup) == expected | {1, 6}
+    assert kept(lookup) == brute_force(TABLE, carbon, {"Boreal"}, set(interest))
+
+
+def test_median_rule_matches_a_brute_force_selection():
+    rng = np.random.default_rng(8)
+    biomes = ["Boreal", "Tundra", "Desert", "Mangroves"]
+    for trial in range(50):
+        size = int(rng.integers(1, 40))
+        # Several IDs can share a name (e.g. the parts of one ecoregion); the totals have ties.
+        table = {eco_id: {"name": "Ecoregion {}".format(rng.integers(0, size)), "biome": rng.choice(biomes)}
+                 for eco_id in rng.choice(np.arange(1, 60), size, replace=False).tolist()}
+        carbon = carbon_of(rng.integers(0, 6, 60) * 10.0, rng.integers(0, 3, 60))
+        include = set(rng.choice(biomes, int(rng.integers(0, 3)), replace=False).tolist())
+        interest = {"Ecoregion {}".format(i) for i in rng.choice(size + 3, int(rng.integers(0, size + 3)))}
+        lookup = EcoregionFilter(include, interest).lookup(table, carbon)
+        assert kept(lookup) == brute_force(table, carbon, include, interest)
@@ -0,0 +1,180 @@
+""" Incremental recompute against a full recompute of the changed inputs. """
+
+import json
+import os
+import re
+import shutil
+
+import fiona
+import numpy as np
+import pytest
+import rasterio
+from rasterio.windows import Window
+
+from carbon_engine import rasterize_ecoregions, run_incremental, run_sweep
+from carbon_engine.ecoregions import sidecar_path
+from carbon_engine.incremental import _Manifest
+
+from .conftest import BLOCK_SIZE
+
+RUNS = [("combined", 50), ("aboveground", 75)]
+
+
+@pytest.fixture
+def edited_inputs(inputs, tmp_path):
+
+    """ Copies of the inputs whose aboveground carbon can be edited in place. """
+
+    paths = dict(inputs)
+    for name in ("aboveground", "belowground", "forest"):
+        paths[name] = str(tmp_path / "{}.tif".format(name))
+        shutil.copy(inputs[name], paths[name])
+    return paths
+
+
+def carbon_sources(paths):
+    return {"combined": [paths["aboveground"], paths["belowground"]], "aboveground": paths["aboveground"]}
+
+
+def edit_carbon(path):
+    with rasterio.open(path, "r+") as dst:
+        window = Window(50, 100, 60, 80)  # Across four windows of the forest grid.
+        dst.write(dst.read(1, window=window) + 150, 1, window=window)
+        return rasterio.windows.bounds(window, dst.transform)
+
+
+def assert_same_values(output, reference):
+
+    """ output is a COG of the same data type and values as reference. """
+
+    with rasterio.open(output) as src, rasterio.open(reference) as ref:
+        assert src.tags(ns="IMAGE_STRUCTURE").get("LAYOUT") == "COG"
+        assert src.dtypes == ref.dtypes
+        values, expected = src.read(1, masked=True), ref.read(1, masked=True)
+        np.testing.assert_array_equal(np.ma.getmaskarray(values), np.ma.getmaskarray(expected))
+        np.testing.assert_array_equal(values.compressed(), expected.compressed())
+
+
+def full_recompute(paths, tmp_path, ecoregion_grid=None):
+    references = [str(tmp_path / "full_{}.tif".format(i)) for i in range(len(RUNS))]
+    run_sweep(paths["forest"], carbon_sources(paths), ecoregion_grid or paths["ecoregion_grid"], RUNS, references,
+              block_size=BLOCK_SIZE, read_ahead=0)
+    return references
+
+
+@pytest.mark.parametrize("bounds", [False, True])
+def test_incremental_matches_full_recompute(edited_inputs, tmp_path, bounds):
+    paths = edited_inputs
+    outputs = [str(tmp_path / "incremental_{}.tif".format(i)) for i in range(len(RUNS))]
+
+    def incremental(edited_bounds=None):
+        return run_incremental(paths["forest"], carbon_sources(paths), paths["ecoregion_grid"], RUNS, outputs,
+                               str(tmp_path / "manifest"), bounds=edited_bounds, block_size=BLOCK_SIZE, read_ahead=0)
+
+    incremental()
+    edited_bounds = edit_carbon(paths["aboveground"])
+    incremental(edited_bounds if bounds else None)
+    for output, reference in zip(outputs, full_recompute(paths, tmp_path)):
+        assert_same_values(output, reference)
+
+
+def test_outputs_without_their_parts_are_rewritten(edited_inputs, tmp_path, capsys):
+    paths = edited_inputs
+    outputs = [str(tmp_path / "incremental_{}.tif".format(i)) for i in range(len(RUNS))]
+
+    def incremental():
+        run_incremental(paths["forest"], carbon_sources(paths), paths["ecoregion_grid"], RUNS, outputs,
+                        str(tmp_path / "manifest"), block_size=BLOCK_SIZE, read_ahead=0)
+
+    incremental()
+    shutil.rmtree(str(tmp_path / "manifest" / "outputs" / "1"))
+    edit_carbon(paths["aboveground"])
+    capsys.readouterr()
+    incremental()
+    assert "rewriting 16 of 16 windows" in capsys.readouterr().out
+    for output, reference in zip(outputs, full_recompute(paths, tmp_path)):
+        assert_same_values(output, reference)
+
+
+def test_interrupted_update_is_redone(edited_inputs, tmp_path, monkeypatch):
+    paths = edited_inputs
+    outputs = [str(tmp_path / "incremental_{}.tif".format(i)) for i in range(len(RUNS))]
+
+    def incremental():
+        run_incremental(paths["forest"], carbon_sources(paths), paths["ecoregion_grid"], RUNS, outputs,
+                        str(tmp_path / "manifest"), block_size=BLOCK_SIZE, read_ahead=0)
+
+    incremental()
+    edit_carbon(paths["aboveground"])
+
+    save_tile = _Manifest.save_tile
+    saved = []
+
+    def crash_after_one_tile(self, index, histograms):
+        if saved:
+            raise KeyboardInterrupt
+        saved.append(index)
+        save_tile(self, index, histograms)
+
+    monkeypatch.setattr(_Manifest, "save_tile", crash_after_one_tile)
+    with pytest.raises(KeyboardInterrupt):
+        incremental()
+    monkeypatch.undo()
+
+    incremental()
+    for output, reference in zip(outputs, full_recompute(paths, tmp_path)):
+        assert_same_values(output, reference)
+
+
+def write_polygons(source, path, shrink=None, factor=0.6):
+
+    """ Copies the ecoregion polygons, with those of ECO_ID shrink scaled by factor around their centre. """
+
+    with fiona.open(source) as src:
+        schema, crs = src.schema, src.crs
+        features = [(feature.geometry.__geo_interface__, dict(feature.properties)) for feature in src]
+    for extension in (".shp", ".shx", ".dbf", ".prj", ".cpg"):
+        if os.path.exists(os.path.splitext(path)[0] + extension):
+            os.remove(os.path.splitext(path)[0] + extension)
+    with fiona.open(path, "w", driver="ESRI Shapefile", crs=crs, schema=schema) as dst:
+        for geometry, properties in features:
+            if properties["ECO_ID"] == shrink:
+                ring = np.array(geometry["coordinates"][0])
+                centre = ring[:-1].mean(axis=0)
+                ring = centre + (ring - centre) * factor
+                geometry = {"type": "Polygon", "coordinates": [[tuple(map(float, xy)) for xy in ring]]}
+            dst.write({"geometry": geometry, "properties": properties})
+
+
+def test_an_ecoregion_edit_is_located_from_the_grid(inputs, tmp_path, capsys):
+    polygons, grid = str(tmp_path / "ecoregions.shp"), str(tmp_path / "ecoregion_ids.npy")
+    write_polygons(inputs["ecoregions"], polygons)
+    rasterize_ecoregions(polygons, inputs["forest"], grid, block_size=BLOCK_SIZE).close()
+    outputs = [str(tmp_path / "incremental_{}.tif".format(i)) for i in range(len(RUNS))]
+
+    def incremental():
+        run_incremental(inputs["forest"], carbon_sources(inputs), grid, RUNS, outputs, str(tmp_path / "manifest"),
+                        block_size=BLOCK_SIZE, read_ahead=0)
+        return capsys.readouterr().out
+
+    incremental()
+    write_polygons(inputs["ecoregions"], polygons, shrink=15 * 29 + 15)
+    rasterize_ecoregions(polygons, inputs["forest"], grid, block_size=BLOCK_SIZE).close()
+    rasterized = re.search(r"Rasterizing the 1 ecoregion\(s\) whose polygons changed: (\d+) window",
+                           capsys.readouterr().out)
+    assert 0 < int(rasterized.group(1)) <= 4  # Of 16.
+
+    # The grid updated in place is the grid of the edited polygons.
+    fresh = str(tmp_path / "fresh_ids.npy")
+    rasterize_ecoregions(polygons, inputs["forest"], fresh, block_size=BLOCK_SIZE).close()
+    np.testing.assert_array_equal(np.load(grid), np.load(fresh))
+    with open(sidecar_path(grid)) as f, open(sidecar_path(fresh)) as fresh_f:
+        updated, expected = json.load(f), json.load(fresh_f)
+    assert (updated["extents"], updated["checksums"]) == (expected["extents"], expected["checksums"])
+
+    out = incremental()
+    checksummed, total = map(int, re.search(r"Checksumming (\d+) of (\d+) windows", out).groups())
+    assert 0 < checksummed < total
+    assert int(re.search(r"(\d+) zone threshold\(s\) changed", out).group(1)) > 0
+    for output, reference in zip(outputs, full_recompute(inputs, tmp_path, fresh)):
+        assert_same_values(output, reference)
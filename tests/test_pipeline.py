@@ -0,0 +1,127 @@
+""" Fused pipeline: intermediates, stepwise equality, regions and checkpoints. """
+
+import os
+
+import numpy as np
+import pytest
+import rasterio
+
+from benchmarks.pipeline_steps import BIOMES_TO_INCLUDE, LATTICE, mask_step, reclassify_step, threshold_step, \
+    zones_step
+from carbon_engine import EcoregionFilter, EcoregionGrid, Region, carbon_in_each_forest_cell, filter_output, \
+    run_sweep, zonal_percentile
+
+from .conftest import BLOCK_SIZE
+
+ECOREGION_FILTER = EcoregionFilter(BIOMES_TO_INCLUDE, ["Ecoregion {}".format(eco_id)
+                                                       for eco_id in range(1, LATTICE * LATTICE + 1, 7)])
+
+
+def read(path):
+    with rasterio.open(path) as src:
+        return src.read(1, masked=True)
+
+
+def test_approximate_intermediates_match_the_output(inputs, tmp_path):
+    debug_dir = str(tmp_path / "debug")
+    os.makedirs(debug_dir)
+    output = str(tmp_path / "approximate.tif")
+    run_sweep(inputs["forest"], {"combined": [inputs["aboveground"], inputs["belowground"]]},
+              inputs["ecoregion_grid"], [("combined", 50)], [output], debug_dir=debug_dir, run_labels=["run"],
+              block_size=BLOCK_SIZE, relative_accuracy=0.01)
+
+    thresholds = read(os.path.join(debug_dir, "carbon_thresholds_run.tif"))
+    carbon = read(os.path.join(debug_dir, "carbon_in_each_forest_cell_run.tif"))
+    assert thresholds.dtype == np.float32
+    assert read(os.path.join(debug_dir, "carbon_clipped_to_forest_run.tif")).dtype == np.float32
+    assert np.any(thresholds.compressed() != np.rint(thresholds.compressed()))
+    above = ~np.ma.getmaskarray(carbon) & ~np.ma.getmaskarray(thresholds)
+    above[above] = carbon.data[above] > thresholds.data[above]
+    values = read(output)
+    np.testing.assert_array_equal(~np.ma.getmaskarray(values), above)
+    np.testing.assert_array_equal(values.data[above], carbon.data[above])
+
+
+def combined(inputs):
+    return {"combined": [inputs["aboveground"], inputs["belowground"]]}
+
+
+def assert_same_values(values, expected):
+    np.testing.assert_array_equal(np.ma.getmaskarray(values), np.ma.getmaskarray(expected))
+    np.testing.assert_array_equal(values.compressed(), expected.compressed())
+
+
+def test_fused_matches_the_stepwise_steps(inputs, tmp_path):
+    def path(name):
+        return str(tmp_path / name)
+
+    mask_step(inputs, path("carbon_clipped_to_forest.tif"), BLOCK_SIZE)
+    reclassify_step(inputs, path("forest_reclassified.tif"), BLOCK_SIZE)
+    zones_step(inputs, path("ecoregion_ids.npy"), path("forest_reclassified.tif"), path("zones.tif"), BLOCK_SIZE, 1)
+    zonal_percentile(path("zones.tif"), path("carbon_clipped_to_forest.tif"), path("thresholds.tif"), 75,
+                     block_size=BLOCK_SIZE)
+    carbon_in_each_forest_cell(inputs["forest"], path("carbon_clipped_to_forest.tif"), path("cells.tif"), BLOCK_SIZE)
+    threshold_step(path("cells.tif"), path("thresholds.tif"), path("stepwise.tif"), BLOCK_SIZE)
+    filter_output(path("stepwise.tif"), path("cells.tif"), path("ecoregion_ids.npy"), ECOREGION_FILTER,
+                  path("stepwise_filtered.tif"), BLOCK_SIZE)
+
+    run_sweep(inputs["forest"], combined(inputs), inputs["ecoregion_grid"], [("combined", 75)], [path("fused.tif")],
+              block_size=BLOCK_SIZE, ecoregion_filter=ECOREGION_FILTER)
+
+    stepwise = read(path("stepwise.tif"))
+    assert stepwise.count() > 0
+    assert_same_values(read(path("fused.tif")), stepwise)
+    filtered = read(path("stepwise_filtered.tif"))
+    assert 0 < filtered.count() < stepwise.count()
+    assert_same_values(read(path("fused_filtered.tif")), filtered)
+
+
+@pytest.fixture(scope="module")
+def global_run(inputs, tmp_path_factory):
+
+    """ Output and zone statistics store of a global run at the 60th percentile. """
+
+    directory = tmp_path_factory.mktemp("global")
+    paths = {"output": str(directory / "global.tif"), "zone_stats": str(directory / "zone_stats.npz")}
+    run_sweep(inputs["forest"], combined(inputs), inputs["ecoregion_grid"], [("combined", 60)], [paths["output"]],
+              block_size=BLOCK_SIZE, zone_stats={"combined": paths["zone_stats"]})
+    return paths
+
+
+def regional_values(path, global_path):
+
+    """ The values of a regional output and those of the same cells of the global output. """
+
+    with rasterio.open(path) as src, rasterio.open(global_path) as global_src:
+        col_off = round((src.transform.c - global_src.transform.c) / global_src.transform.a)
+        row_off = round((src.transform.f - global_src.transform.f) / global_src.transform.e)
+        window = rasterio.windows.Window(col_off, row_off, src.width, src.height)
+        return src.read(1, masked=True), global_src.read(1, window=window, masked=True), window
+
+
+@pytest.mark.parametrize("from_store", [False, True])
+def test_bounding_box_matches_the_global_run(inputs, global_run, tmp_path, from_store):
+    output = str(tmp_path / "regional.tif")
+    run_sweep(inputs["forest"], combined(inputs), inputs["ecoregion_grid"], [("combined", 60)], [output],
+              block_size=BLOCK_SIZE, region=Region(bounds=(-30.2, -20.6, 25.1, 40.3)),
+              zone_stats_from={"combined": global_run["zone_stats"]} if from_store else None)
+
+    values, expected, window = regional_values(output, global_run["output"])
+    assert 0 < window.width < 256 and 0 < window.height < 256
+    assert expected.count() > 0
+    assert_same_values(values, expected)
+
+
+def test_ecoregions_match_the_global_run(inputs, global_run, tmp_path):
+    output = str(tmp_path / "regional.tif")
+    selected = [421, 425]
+    run_sweep(inputs["forest"], combined(inputs), inputs["ecoregion_grid"], [("combined", 60)], [output],
+              block_size=BLOCK_SIZE, region=Region(ecoregions=["Ecoregion {}".format(eco_id) for eco_id in selected]))
+
+    values, expected, window = regional_values(output, global_run["output"])
+    grid = EcoregionGrid(inputs["ecoregion_grid"])
+    in_region = np.isin(grid.read(1, window=window), selected)
+    grid.close()
+    expected = np.ma.masked_where(~in_region, expected)
+    assert expected.count() > 0
+    assert_same_values(values, expected)
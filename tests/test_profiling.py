@@ -0,0 +1,81 @@
+""" Run report: what RunProfiler records for each step. """
+
+import json
+import os
+
+import numpy as np
+import pytest
+
+from carbon_engine import RunProfiler, profiling
+
+
+def read_and_write(directory, size, tiles):
+
+    """ A small step: writes size bytes to a file, reads them back and counts tiles. """
+
+    path = os.path.join(directory, "data.bin")
+    with open(path, "wb") as f:
+        f.write(os.urandom(size))
+    with open(path, "rb") as f:
+        assert len(f.read()) == size
+    np.sort(np.random.default_rng(0).random(200000))
+    profiling.count_tiles(tiles)
+
+
+def test_the_report_records_each_step(tmp_path):
+    report_path = str(tmp_path / "reports" / "run_report.json")
+    size = 4 * 1024 ** 2
+    with RunProfiler(report_path, config={"workers": 1}, interval=0.01):
+        with profiling.step("outer"):
+            with profiling.step("inner"):
+                read_and_write(str(tmp_path), size, 12)
+
+    with open(report_path) as f:
+        report = json.load(f)
+    assert report["error"] is None
+    assert report["config"] == {"workers": 1}
+    assert [step["name"] for step in report["steps"]] == ["outer/inner", "outer"]
+    for record in report["steps"] + [report]:
+        assert record["wall_seconds"] > 0
+        assert record["cpu_seconds"] >= 0
+        assert record["peak_rss_bytes"] > 0
+        assert record["read_bytes"] >= size
+        assert record["write_bytes"] >= size
+        assert record["tiles"] == 12
+        assert record["tiles_per_second"] > 0
+    assert profiling._active is None
+
+
+def test_a_failed_step_is_reported(tmp_path):
+    report_path = str(tmp_path / "run_report.json")
+    with pytest.raises(RuntimeError):
+        with RunProfiler(report_path):
+            with profiling.step("failing"):
+                raise RuntimeError("disk full")
+
+    with open(report_path) as f:
+        report = json.load(f)
+    assert "disk full" in report["error"]
+    assert [step["name"] for step in report["steps"]] == ["failing"]
+    assert profiling._active is None
+
+
+def test_steps_without_a_profiler_do_nothing():
+    with profiling.step("alone"):
+        pass
+    assert profiling._active is None
+
+
+def test_a_step_can_be_profiled(tmp_path):
+    report_path = str(tmp_path / "run_report.json")
+    with RunProfiler(report_path, profile_step="inner"):
+        with profiling.step("outer"):
+            with profiling.step("inner"):
+                read_and_write(str(tmp_path), 1024, 1)
+
+    with open(report_path) as f:
+        report = json.load(f)
+    assert report["profile"] == str(tmp_path / "run_report_profile.prof")
+    assert os.path.getsize(report["profile"]) > 0
+    with open(str(tmp_path / "run_report_profile.txt")) as f:
+        assert f.readline().startswith("cProfile of step outer/inner")
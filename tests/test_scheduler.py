@@ -0,0 +1,30 @@
+""" The outputs don't depend on the number of workers or on reading ahead. """
+
+import hashlib
+
+import rasterio
+
+from carbon_engine import run_sweep
+
+from .conftest import BLOCK_SIZE
+
+
+def digest(path):
+    with open(path, "rb") as f:
+        return hashlib.sha256(f.read()).hexdigest()
+
+
+def test_outputs_are_byte_identical(inputs, tmp_path):
+    carbon_sources = {"combined": [inputs["aboveground"], inputs["belowground"]],
+                      "aboveground": inputs["aboveground"]}
+    runs = [("combined", 50), ("aboveground", 75)]
+    digests = {}
+    for name, workers, read_ahead in (("serial", 1, 0), ("workers", 2, 2), ("read_ahead", 1, 2)):
+        outputs = [str(tmp_path / "{}_{}.tif".format(name, i)) for i in range(len(runs))]
+        run_sweep(inputs["forest"], carbon_sources, inputs["ecoregion_grid"], runs, outputs, block_size=BLOCK_SIZE,
+                  workers=workers, read_ahead=read_ahead, zone_stats=None)
+        digests[name] = [digest(output) for output in outputs]
+    with rasterio.open(outputs[0]) as src:
+        assert src.read_masks(1).any()
+    assert digests["workers"] == digests["serial"]
+    assert digests["read_ahead"] == digests["serial"]
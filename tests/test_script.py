@@ -0,0 +1,94 @@
+""" The ArcGIS script's settings and fused pipeline driver, with a stand-in for arcpy (which they don't call). """
+
+import importlib.util
+import json
+import os
+import sys
+import types
+
+import pytest
+import rasterio
+
+from carbon_engine import StepCache
+
+SCRIPT = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+                      "identify_high_priority_carbon_forests.py")
+
+
+@pytest.fixture
+def script(monkeypatch):
+
+    """ The script imported as a module, with (almost) empty arcpy and arcpy.sa modules. """
+
+    arcpy = types.ModuleType("arcpy")
+    arcpy.env = types.SimpleNamespace()
+    arcpy.sa = types.ModuleType("arcpy.sa")
+    arcpy.sa.Raster = None
+    monkeypatch.setitem(sys.modules, "arcpy", arcpy)
+    monkeypatch.setitem(sys.modules, "arcpy.sa", arcpy.sa)
+    monkeypatch.setattr(sys, "path", list(sys.path))
+    spec = importlib.util.spec_from_file_location("identify_high_priority_carbon_forests", SCRIPT)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def local_config(script, inputs, tmp_path, **settings):
+
+    """ The default settings with the synthetic inputs and data_dir in tmp_path (its directories created). """
+
+    config = script.configure()
+    config.above_ground_carbon, config.below_ground_carbon = inputs["aboveground"], inputs["belowground"]
+    config.forest, config.biomes_and_ecoregions = inputs["forest"], inputs["ecoregions"]
+    data_dir = str(tmp_path / "Data")
+    for name in ("intermediate_dir", "output_dir", "cache_dir", "manifest_dir", "checkpoint_dir", "final_output",
+                 "run_report", "final_output_filtered", "zone_stats", "final_output_arcgis"):
+        setattr(config, name, getattr(config, name).replace(config.data_dir, data_dir, 1))
+    config.data_dir = data_dir
+    for directory in (config.intermediate_dir, config.output_dir):
+        os.makedirs(directory)
+    vars(config).update(settings)
+    return config
+
+
+def test_configure_leaves_the_module_settings_alone(script):
+    defaults = script.version_label, script.data_dir
+    first = script.configure()
+    first.version_label += "_changed"
+    second = script.configure()
+    assert second.version_label == defaults[0]
+    assert (script.version_label, script.data_dir) == defaults
+
+
+def test_intermediates_turn_checkpointing_off(script, inputs, tmp_path, capsys):
+    config = local_config(script, inputs, tmp_path, write_intermediates=True)
+    assert config.checkpoint
+    step_cache = StepCache(config.cache_dir)
+    script.run_fused(config, (config.above_ground_carbon, config.below_ground_carbon, config.forest), step_cache,
+                     inputs["ecoregion_grid"], None)
+
+    assert "Checkpointing is off" in capsys.readouterr().out
+    with rasterio.open(config.final_output) as src:
+        assert src.read(1, masked=True).count() > 0
+    suffix = config.version_label + ".tif"
+    assert os.path.exists(os.path.join(config.intermediate_dir, "carbon_in_each_forest_cell_" + suffix))
+    assert not os.path.exists(config.checkpoint_dir)
+
+
+def test_a_failed_run_writes_its_report(script, inputs, tmp_path):
+    spec = tmp_path / "outside.toml"
+    settings = {"data_dir": str(tmp_path / "Data"), "version_label": "outside", "forest": inputs["forest"],
+                "biomes_and_ecoregions": inputs["ecoregions"], "above_ground_carbon": inputs["aboveground"],
+                "below_ground_carbon": inputs["belowground"]}
+    spec.write_text("".join("{} = {}\n".format(name, json.dumps(value)) for name, value in settings.items()) +
+                    "region = [120.0, 10.0, 130.0, 20.0]\n")
+
+    with pytest.raises(ValueError, match="doesn't cover any cell"):
+        script.main(str(spec))
+
+    config = script.configure(str(spec))
+    with open(config.run_report) as f:
+        report = json.load(f)
+    assert "doesn't cover any cell" in report["error"]
+    assert [step["name"] for step in report["steps"]] == ["rasterize_ecoregion_ids"]
+    assert script.carbon_engine.profiling._active is None
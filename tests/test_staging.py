@@ -0,0 +1,49 @@
+""" Local staging of inputs. """
+
+import os
+
+import pytest
+
+from carbon_engine import StagingArea
+
+
+def write(path, data="x"):
+    with open(path, "w") as f:
+        f.write(data)
+
+
+@pytest.fixture
+def share(tmp_path):
+    share = tmp_path / "share"
+    share.mkdir()
+    write(share / "forest.tif")
+    write(share / "forest.tif.aux.xml")
+    write(share / "unrelated.tif")
+    gdb = share / "Inputs.gdb"
+    gdb.mkdir()
+    write(gdb / "a00000009.gdbtable")
+    write(gdb / "_gdb.host.1234.sr.lock")
+    return share
+
+
+def test_missing_input_is_not_staged(share, tmp_path):
+    staging = StagingArea(str(tmp_path / "staging"))
+    with pytest.raises(FileNotFoundError):
+        staging.stage(str(share / "frest.tif"))
+    assert not any(name.startswith("stage_") for name in os.listdir(tmp_path / "staging"))
+
+
+def test_file_is_staged_with_its_companions(share, tmp_path):
+    staging = StagingArea(str(tmp_path / "staging"))
+    local = staging.stage(str(share / "forest.tif"))
+    assert os.path.isfile(local) and os.path.isfile(local + ".aux.xml")
+    assert not os.path.exists(os.path.join(os.path.dirname(local), "unrelated.tif"))
+    assert staging.stage(str(share / "forest.tif")) == local
+
+
+def test_geodatabase_member_stages_the_geodatabase_without_locks(share, tmp_path):
+    staging = StagingArea(str(tmp_path / "staging"))
+    local = staging.stage(str(share / "Inputs.gdb" / "ecoregions"))
+    gdb = os.path.dirname(local)
+    assert os.path.basename(local) == "ecoregions" and os.path.basename(gdb) == "Inputs.gdb"
+    assert sorted(os.listdir(gdb)) == ["a00000009.gdbtable"]
@@ -0,0 +1,137 @@
+""" Zonal percentile thresholds against a brute-force per-zone numpy.percentile (ZonalStatistics PERCENTILE with
+    ignore_nodata="DATA" and the zone raster as snap raster).
+"""
+
+import numpy as np
+import pytest
+import rasterio
+from rasterio.transform import from_origin
+
+from carbon_engine import load_histogram, zonal_percentile
+
+ZONES_NODATA = -9999
+RES = 0.5
+SHAPE = (41, 57)
+
+
+def write(path, data, transform, nodata):
+    with rasterio.open(path, "w", driver="GTiff", width=data.shape[1], height=data.shape[0], count=1,
+                       dtype=data.dtype.name, crs="EPSG:4326", transform=transform, nodata=nodata) as dst:
+        dst.write(data, 1)
+
+
+def write_inputs(tmp_path, aligned, float_values):
+
+    """ Zones with NoData and an empty zone (7: NoData values in all its cells), and values with NoData, on the zone
+        grid or on a grid offset by a fraction of a cell that doesn't cover all of it.
+    """
+
+    rng = np.random.default_rng(11)
+    zones = rng.choice(np.array([3, 5, 9, 1000, ZONES_NODATA], dtype=np.int32), SHAPE, p=[0.3, 0.3, 0.2, 0.1, 0.1])
+    zones[:4, :4] = 7
+    zones[20, 30] = 12  # A zone of a single cell.
+    zones_transform = from_origin(100, 50, RES, RES)
+    write(tmp_path / "zones.tif", zones, zones_transform, ZONES_NODATA)
+
+    if aligned:
+        values_shape, values_transform = SHAPE, zones_transform
+    else:
+        values_shape = (SHAPE[0] - 1, SHAPE[1] - 2)
+        values_transform = from_origin(100 + 0.41 * RES, 50 - 0.28 * RES, RES, RES)
+    if float_values:
+        values = rng.gamma(2.0, 50.0, values_shape).astype(np.float32)
+        values[rng.random(values_shape) < 0.02] = 0
+        nodata = -1.0
+    else:
+        values = rng.integers(0, 500, values_shape).astype(np.int16)
+        nodata = -1
+    values[rng.random(values_shape) < 0.15] = nodata
+    values[:5, :5] = nodata
+    write(tmp_path / "values.tif", values, values_transform, nodata)
+    return str(tmp_path / "zones.tif"), str(tmp_path / "values.tif")
+
+
+def brute_force(zones, values, percentile, method):
+
+    """ {zone: percentile} of the values at the centres of its cells, one cell at a time, and the zone of each cell. """
+
+    with rasterio.open(zones) as zones_src, rasterio.open(values) as values_src:
+        zone_data = zones_src.read(1)
+        value_data = values_src.read(1)
+        value_valid = values_src.read_masks(1) > 0
+        samples = {}
+        for row in range(zones_src.height):
+            for col in range(zones_src.width):
+                if zone_data[row, col] == ZONES_NODATA:
+                    continue
+                value_row, value_col = values_src.index(*zones_src.xy(row, col))
+                if 0 <= value_row < values_src.height and 0 <= value_col < values_src.width and \
+                        value_valid[value_row, value_col]:
+                    samples.setdefault(int(zone_data[row, col]), []).append(value_data[value_row, value_col])
+    return {zone: np.percentile(zone_values, percentile, method=method) for zone, zone_values in samples.items()}, \
+        zone_data
+
+
+def expected_raster(thresholds, zone_data, nodata, dtype):
+    expected = np.full(zone_data.shape, nodata, dtype=dtype)
+    for zone, threshold in thresholds.items():
+        expected[zone_data == zone] = threshold
+    return expected
+
+
+@pytest.mark.parametrize("aligned", [True, False])
+@pytest.mark.parametrize("percentile", [0, 25, 50, 90, 100])
+def test_integer_thresholds_match_numpy(tmp_path, aligned, percentile):
+    zones, values = write_inputs(tmp_path, aligned, float_values=False)
+    output = str(tmp_path / "thresholds.tif")
+    zonal_percentile(zones, values, output, percentile, block_size=16)
+
+    thresholds, zone_data = brute_force(zones, values, percentile, "nearest")
+    assert 7 not in thresholds and 12 in thresholds
+    with rasterio.open(output) as src:
+        assert src.dtypes[0] == "int16" and src.nodata == -1
+        np.testing.assert_array_equal(src.read(1), expected_raster(thresholds, zone_data, -1, np.int16))
+
+
+@pytest.mark.parametrize("aligned", [True, False])
+def test_float_thresholds_are_within_the_relative_accuracy(tmp_path, aligned):
+    zones, values = write_inputs(tmp_path, aligned, float_values=True)
+    output = str(tmp_path / "thresholds.tif")
+    zonal_percentile(zones, values, output, 60, block_size=16, relative_accuracy=0.01)
+
+    # AUTO_DETECT interpolates float values linearly.
+    thresholds, zone_data = brute_force(zones, values, 60, "linear")
+    with rasterio.open(output) as src:
+        assert src.dtypes[0] == "float32"
+        result = src.read(1)
+        expected = expected_raster(thresholds, zone_data, src.nodata, np.float32)
+    np.testing.assert_array_equal(result == -1.0, expected == -1.0)
+    np.testing.assert_allclose(result, expected, rtol=0.01, atol=0.01)
+
+
+def test_histograms_are_reused_for_another_percentile(tmp_path):
+    zones, values = write_inputs(tmp_path, aligned=False, float_values=False)
+    sketch_path = str(tmp_path / "histograms.npz")
+    zonal_percentile(zones, values, str(tmp_path / "first.tif"), 50, block_size=16, sketch_path=sketch_path)
+    zonal_percentile(zones, values, str(tmp_path / "second.tif"), 75, block_size=16, sketch_path=sketch_path)
+    zonal_percentile(zones, values, str(tmp_path / "direct.tif"), 75, block_size=64)
+
+    with rasterio.open(str(tmp_path / "second.tif")) as second, rasterio.open(str(tmp_path / "direct.tif")) as direct:
+        np.testing.assert_array_equal(second.read(1), direct.read(1))
+
+
+def test_histograms_of_another_kind_are_not_reused(tmp_path):
+    zones, values = write_inputs(tmp_path, aligned=True, float_values=False)
+    sketch_path = str(tmp_path / "histograms.npz")
+
+    def run(name, relative_accuracy, path=sketch_path):
+        output = str(tmp_path / "{}.tif".format(name))
+        zonal_percentile(zones, values, output, 50, block_size=16, relative_accuracy=relative_accuracy,
+                         sketch_path=path)
+        with rasterio.open(output) as src:
+            return src.read(1)
+
+    for name, relative_accuracy in (("exact", None), ("coarse", 0.05), ("fine", 0.01), ("exact_again", None)):
+        result = run(name, relative_accuracy)
+        assert getattr(load_histogram(sketch_path), "relative_accuracy", None) == relative_accuracy
+        np.testing.assert_array_equal(result, run(name + "_direct", relative_accuracy, path=None))
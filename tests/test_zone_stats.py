@@ -0,0 +1,122 @@
+""" Zone statistics store: the same percentiles and histograms as the ZonalHistogram it was made from. """
+
+import numpy as np
+import pytest
+
+from carbon_engine import ZoneStats, run_sweep
+from carbon_engine.kernels import ZONE_CLASS_SLOTS
+from carbon_engine.zonal import ZonalHistogram, ZonalSketch, load_histogram
+
+from .conftest import BLOCK_SIZE
+
+PERCENTILES = (0, 10, 37.5, 50, 75, 99, 100)
+
+
+def random_zones(rng, n):
+
+    """ Zone IDs (ECO_ID * 8 + forest class) of n cells, including zones of a single cell. """
+
+    zones = rng.integers(1, 30, n) * ZONE_CLASS_SLOTS + rng.integers(1, 5, n)
+    zones[:3] = [40 * ZONE_CLASS_SLOTS + 1, 41 * ZONE_CLASS_SLOTS + 2, 41 * ZONE_CLASS_SLOTS + 2]
+    return zones
+
+
+def histogram_of_blocks(histogram, zones, values, blocks=4):
+    for zone_block, value_block in zip(np.array_split(zones, blocks), np.array_split(values, blocks)):
+        histogram.update(zone_block, value_block)
+    return histogram
+
+
+@pytest.mark.parametrize("interpolation", ["NEAREST", "LINEAR"])
+def test_exact_percentiles_match_the_histogram(tmp_path, interpolation):
+    rng = np.random.default_rng(3)
+    zones = random_zones(rng, 5000)
+    values = rng.integers(-5, 400, zones.size)
+    histogram = histogram_of_blocks(ZonalHistogram(), zones, values)
+    path = str(tmp_path / "zone_stats.npz")
+    ZoneStats.from_histogram(histogram).save(path)
+    stats = ZoneStats.load(path)
+
+    np.testing.assert_array_equal(stats.zone_ids, np.unique(zones))
+    for percentile in PERCENTILES:
+        expected, has_values = histogram.percentile(percentile, interpolation)
+        np.testing.assert_array_equal(stats.percentile(percentile, interpolation), expected[has_values])
+        # Both follow numpy.percentile ("nearest" rounds half to even, like np.rint).
+        method = "nearest" if interpolation == "NEAREST" else "linear"
+        np.testing.assert_allclose(expected, [np.percentile(values[zones == zone_id], percentile, method=method)
+                                              for zone_id in histogram.zone_ids])
+
+    rows = stats.select(forest_class=2)
+    np.testing.assert_array_equal(stats.percentile(60, interpolation, rows=rows),
+                                  stats.percentile(60, interpolation)[rows])
+    for row, zone_id in enumerate(stats.zone_ids):
+        zone_values = values[zones == zone_id]
+        assert stats.cells[row] == zone_values.size
+        assert stats.sums[row] == zone_values.sum()
+        assert (stats.minimums[row], stats.maximums[row]) == (zone_values.min(), zone_values.max())
+
+
+def test_sketch_percentiles_match_the_sketch():
+    rng = np.random.default_rng(4)
+    zones = random_zones(rng, 5000)
+    values = rng.gamma(2.0, 60.0, zones.size)
+    values[:50] = 0.0
+    sketch = histogram_of_blocks(ZonalSketch(0.01), zones, values)
+    stats = ZoneStats.from_histogram(sketch)
+
+    assert stats.approximate
+    for percentile in PERCENTILES:
+        expected, has_values = sketch.percentile(percentile)
+        np.testing.assert_array_equal(stats.percentile(percentile), expected[has_values])
+
+    restored = stats.histogram()
+    assert isinstance(restored, ZonalSketch)
+    expected, has_values = sketch.percentile(50)
+    np.testing.assert_array_equal(restored.percentile(50)[0], expected[has_values])
+
+
+def test_the_store_of_a_run_holds_its_histograms(inputs, tmp_path):
+    output, store = str(tmp_path / "output.tif"), str(tmp_path / "zone_stats.npz")
+    histograms = run_sweep(inputs["forest"], {"combined": [inputs["aboveground"], inputs["belowground"]]},
+                           inputs["ecoregion_grid"], [("combined", 50)], [output], block_size=BLOCK_SIZE,
+                           zone_stats={"combined": store})
+    histogram = histograms["combined"]
+    stats = ZoneStats.load(store)
+
+    expected, has_values = histogram.percentile(50)
+    np.testing.assert_array_equal(stats.zone_ids, histogram.zone_ids[has_values])
+    np.testing.assert_array_equal(stats.percentile(50), expected[has_values])
+    assert list(stats.ecoregion_names) == ["Ecoregion {}".format(eco_id) for eco_id in stats.ecoregion_ids]
+    restored = tmp_path / "restored.npz"
+    stats.histogram().save(str(restored))
+    np.testing.assert_array_equal(load_histogram(str(restored)).percentile(75)[0],
+                                  histogram.percentile(75)[0][has_values])
+
+
+def test_combine_zones_are_keyed_by_ecoregion_and_forest_class():
+    rng = np.random.default_rng(5)
+    zones = random_zones(rng, 3000)
+    values = rng.integers(0, 300, zones.size)
+    ecoregions = {eco_id: {"name": "Ecoregion {}".format(eco_id), "biome": "Biome {}".format(eco_id % 3)}
+                  for eco_id in range(1, 42)}
+    # Combine numbers its zones 1, 2, ... in no particular order.
+    encoded = np.unique(zones)
+    combine_values = rng.permutation(encoded.size) + 1
+    combine_lookup = {int(value): ("Ecoregion {}".format(zone_id // ZONE_CLASS_SLOTS), int(zone_id % ZONE_CLASS_SLOTS))
+                      for value, zone_id in zip(combine_values, encoded)}
+    combine_zones = combine_values[np.searchsorted(encoded, zones)]
+
+    stats = ZoneStats.from_combine(histogram_of_blocks(ZonalHistogram(), combine_zones, values), combine_lookup,
+                                   ecoregions)
+    expected = ZoneStats.from_histogram(histogram_of_blocks(ZonalHistogram(), zones, values), ecoregions)
+    np.testing.assert_array_equal(stats.zone_ids, expected.zone_ids)
+    np.testing.assert_array_equal(stats.ecoregion_ids, encoded // ZONE_CLASS_SLOTS)
+    np.testing.assert_array_equal(stats.forest_classes, encoded % ZONE_CLASS_SLOTS)
+    np.testing.assert_array_equal(stats.biomes, expected.biomes)
+    np.testing.assert_array_equal(stats.percentile(75), expected.percentile(75))
+    np.testing.assert_array_equal(stats.bin_counts, expected.bin_counts)
+
+    combine_lookup[int(combine_values[0])] = ("Nowhere", 1)
+    with pytest.raises(ValueError, match="unknown ecoregion: Nowhere"):
+        ZoneStats.from_combine(histogram_of_blocks(ZonalHistogram(), combine_zones, values), combine_lookup,
+                               ecoregions)